@@ -0,0 +1,175 @@
+import sys
+import time
+import threading
+import Queue
+from fabric.api import env
+import fabrix.editor
+import fabrix.ioutil
+import fabrix.system
+from fabrix.context import _snapshot, _restore_context
+
+
+_DEFAULT_WORKERS = 32
+
+
+class Future(object):
+    """Result of asynchronous operation."""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._done = False
+        self._value = None
+        self._exc_info = None
+        self._callbacks = list()
+
+    def done(self):
+        """Is operation finished?
+
+        Returns:
+            True if operation is finished, False otherwise.
+        """
+        with self._condition:
+            return self._done
+
+    def result(self, timeout=None):
+        """Wait for operation and return its result.
+
+        Args:
+            timeout: Maximum time of waiting in seconds, None means wait forever.
+
+        Returns:
+            value returned by operation.
+
+        Raises:
+            Exception raised by operation, including :class:`~exceptions.SystemExit` from :func:`~fabric.api.abort`.
+        """
+        self._wait(timeout)
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._value
+
+    def exception(self, timeout=None):
+        """Wait for operation and return exception raised by it.
+
+        Args:
+            timeout: Maximum time of waiting in seconds, None means wait forever.
+
+        Returns:
+            exception raised by operation or None if operation finished successfully.
+        """
+        self._wait(timeout)
+        if self._exc_info is not None:
+            return self._exc_info[1]
+        return None
+
+    def add_done_callback(self, callback):
+        """Call ``callback(future)`` when operation is finished, or immediately if it is already finished."""
+        with self._condition:
+            if not self._done:
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def _wait(self, timeout):
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while not self._done:
+                delay = 0.1
+                if deadline is not None:
+                    delay = min(delay, deadline - time.time())
+                    if delay <= 0:
+                        raise RuntimeError('operation is not finished in %s seconds' % timeout)
+                self._condition.wait(delay)
+
+    def _finish(self, value, exc_info):
+        with self._condition:
+            self._value = value
+            self._exc_info = exc_info
+            self._done = True
+            self._condition.notify_all()
+            callbacks = self._callbacks
+            self._callbacks = list()
+        for callback in callbacks:
+            callback(self)
+
+
+_queue = Queue.Queue()
+
+_workers = list()
+
+_workers_lock = threading.Lock()
+
+
+def _worker():
+    while True:
+        future, function, args, kwargs, context = _queue.get()
+        try:
+            with _restore_context(context):
+                value = function(*args, **kwargs)
+        except (SystemExit, Exception):  # pylint: disable=broad-except
+            future._finish(None, sys.exc_info())  # pylint: disable=protected-access
+        else:
+            future._finish(value, None)  # pylint: disable=protected-access
+
+
+def submit(function, *args, **kwargs):
+    """Execute ``function(*args, **kwargs)`` asynchronously on current host.
+
+    Function is executed with Fabric settings of caller, for example, ``warn_only``, ``cd()`` directory or ``hide()`` state.
+
+    Args:
+        function: any function, which works with current host, for example, fabfile task.
+
+    Returns:
+        :class:`~Future` object.
+    """
+    future = Future()
+    _queue.put((future, function, args, kwargs, _snapshot()))
+    with _workers_lock:
+        if len(_workers) < env.get('fabrix_aio_workers', _DEFAULT_WORKERS):
+            thread = threading.Thread(target=_worker)
+            thread.daemon = True
+            thread.start()
+            _workers.append(thread)
+    return future
+
+
+def gather(*futures):
+    """Wait for all operations.
+
+    Returns:
+        list of results of operations, in the same order as ``futures``.
+
+    Raises:
+        Exception raised by first failed operation, after all operations are finished.
+    """
+    for future in futures:
+        future.exception()
+    return [future.result() for future in futures]
+
+
+def _asynchronous(module, name):
+    def asynchronous(*args, **kwargs):
+        return submit(getattr(module, name), *args, **kwargs)
+    asynchronous.__name__ = name
+    asynchronous.__doc__ = 'Asynchronous version of :func:`~%s.%s`, returns :class:`~Future` object.' % (module.__name__, name)
+    return asynchronous
+
+
+run = _asynchronous(fabrix.ioutil, 'run')
+read_file = _asynchronous(fabrix.ioutil, 'read_file')
+write_file = _asynchronous(fabrix.ioutil, 'write_file')
+is_file_exists = _asynchronous(fabrix.ioutil, 'is_file_exists')
+edit_file = _asynchronous(fabrix.editor, 'edit_file')
+systemctl_start = _asynchronous(fabrix.system, 'systemctl_start')
+systemctl_stop = _asynchronous(fabrix.system, 'systemctl_stop')
+systemctl_reload = _asynchronous(fabrix.system, 'systemctl_reload')
+systemctl_restart = _asynchronous(fabrix.system, 'systemctl_restart')
+systemctl_enable = _asynchronous(fabrix.system, 'systemctl_enable')
+systemctl_disable = _asynchronous(fabrix.system, 'systemctl_disable')
+systemctl_mask = _asynchronous(fabrix.system, 'systemctl_mask')
+systemctl_unmask = _asynchronous(fabrix.system, 'systemctl_unmask')
+systemctl_preset = _asynchronous(fabrix.system, 'systemctl_preset')
+systemctl_edit = _asynchronous(fabrix.system, 'systemctl_edit')
+systemctl_get_default = _asynchronous(fabrix.system, 'systemctl_get_default')
+systemctl_set_default = _asynchronous(fabrix.system, 'systemctl_set_default')
@@ -1,21 +1,29 @@
 from fabrix.config import conf, local_conf, read_config
+from fabrix.context import host_context, current_host
 from fabrix.editor import edit_file, edit_local_file, edit_ini_section, edit_text, strip_text
 from fabrix.editor import insert_line, delete_line, prepend_line, append_line, replace_line, substitute_line, strip_line
+from fabrix.editor import set_ini_value, IniDocument, edit_files
 from fabrix.ioutil import read_file, read_local_file, write_file, write_local_file, copy_file, rsync, chown, chmod
 from fabrix.ioutil import remove_file, remove_directory, create_file, create_directory, name, warn, run, debug_print
 from fabrix.ioutil import is_file_exists, is_directory_exists, is_file_not_exists, is_directory_not_exists
+from fabrix.ioutil import batch, fill_stat_cache, clear_stat_cache, iter_file_lines, sync_files, rsync_parallel
+from fabrix.ioutil import memoize, clear_memo_cache, memo_cache_stats, prefetch_files
+from fabrix.parallel import execute_parallel, execute_rolling
 from fabrix.passwd import is_user_exists, is_user_not_exists, create_user, remove_user
 from fabrix.passwd import is_group_exists, is_group_not_exists, create_group, remove_group
 from fabrix.passwd import is_user_in_group, is_user_not_in_group, add_user_to_group, delete_user_from_group
 from fabrix.passwd import get_user_home_directory, add_user_ssh_authorized_keys
 from fabrix.render import render, render_template
 from fabrix.rpmyum import yum_install, yum_remove, yum_update
+from fabrix.steps import step, run_steps
 from fabrix.system import systemctl_enable, systemctl_disable, systemctl_mask, systemctl_unmask
 from fabrix.system import systemctl_start, systemctl_stop, systemctl_reload, systemctl_restart
 from fabrix.system import systemctl_edit, is_reboot_required, reboot_and_wait, disable_selinux
 from fabrix.system import systemctl_get_default, systemctl_set_default, systemctl_preset
 from fabrix.system import localectl_set_locale, timedatectl_set_timezone
 from fabrix.system import get_virtualization_type
+from fabrix.timing import enable_timing, timing_report, write_timing_json
+from fabrix.tracing import enable_tracing, disable_tracing, add_trace_hook, write_trace
 
 # flake8: noqa
 
@@ -0,0 +1,148 @@
+import threading
+import contextlib
+import fabric.state
+import fabric.thread_handling
+from fabric.api import env, settings
+
+
+_thread_local = threading.local()
+
+
+def _overlay(obj):
+    overlays = getattr(_thread_local, 'overlays', None)
+    if overlays is None:
+        return None
+    return overlays.get(id(obj))
+
+
+def _overlay_method(name):
+    method = getattr(dict, name)
+
+    def overlay_method(self, *args, **kwargs):
+        overlay = _overlay(self)
+        if overlay is None:
+            return method(self, *args, **kwargs)
+        return getattr(overlay, name)(*args, **kwargs)
+    overlay_method.__name__ = name
+    return overlay_method
+
+
+class _ThreadLocalDict(dict):
+    """Dict, which content can be replaced by thread-local overlay dict.
+
+    Fabric ``env`` and ``output`` are process-wide globals, which are read and changed by Fabric itself,
+    for example, by ``settings()`` and ``hide()`` context managers. While at least one :func:`~host_context`
+    block is active in any thread, class of these objects is replaced by subclass of ``_ThreadLocalDict``,
+    so inside :func:`~host_context` each thread works with own copy of them, and outside of :func:`~host_context`
+    original objects are used as before. Original class is restored when last block is finished.
+
+    Fabric reads ``env`` and ``output`` also in own I/O threads, started by ``ThreadHandler`` for each command,
+    so these threads get copy of ``env`` and ``output`` of thread, which started them.
+    """
+
+
+for _name in ('__getitem__', '__setitem__', '__delitem__', '__contains__', '__iter__', '__len__', '__repr__',
+              'get', 'has_key', 'keys', 'values', 'items', 'iterkeys', 'itervalues', 'iteritems',
+              'update', 'setdefault', 'pop', 'popitem', 'clear', 'copy'):
+    setattr(_ThreadLocalDict, _name, _overlay_method(_name))
+del _name
+
+
+_install_lock = threading.Lock()
+
+_installed = dict(count=0, classes=dict(), thread_handler_init=None)
+
+
+def _inherit_context(target):
+    if _overlay(fabric.state.env) is None:
+        return target
+    snapshot = _snapshot()
+
+    def inherited_target(*args, **kwargs):
+        with _restore_context(snapshot):
+            return target(*args, **kwargs)
+    return inherited_target
+
+
+def _thread_handler_init(self, name, target, *args, **kwargs):
+    _installed['thread_handler_init'](self, name, _inherit_context(target), *args, **kwargs)
+
+
+def _install_thread_local_state():
+    with _install_lock:
+        if _installed['count'] == 0:
+            for obj in (fabric.state.env, fabric.state.output):
+                cls = type(obj)
+                _installed['classes'][id(obj)] = cls
+                thread_local_cls = type('_ThreadLocal' + cls.__name__.lstrip('_'), (cls, _ThreadLocalDict), {})
+                dict.__setattr__(obj, '__class__', thread_local_cls)
+            thread_handler = fabric.thread_handling.ThreadHandler
+            _installed['thread_handler_init'] = thread_handler.__dict__['__init__']
+            thread_handler.__init__ = _thread_handler_init
+        _installed['count'] += 1
+
+
+def _uninstall_thread_local_state():
+    with _install_lock:
+        _installed['count'] -= 1
+        if _installed['count'] == 0:
+            for obj in (fabric.state.env, fabric.state.output):
+                dict.__setattr__(obj, '__class__', _installed['classes'].pop(id(obj)))
+            fabric.thread_handling.ThreadHandler.__init__ = _installed['thread_handler_init']
+            _installed['thread_handler_init'] = None
+
+
+def _snapshot():
+    return dict(fabric.state.env.items()), dict(fabric.state.output.items())
+
+
+@contextlib.contextmanager
+def _restore_context(snapshot):
+    env_items, output_items = snapshot
+    _install_thread_local_state()
+    old_overlays = getattr(_thread_local, 'overlays', None)
+    _thread_local.overlays = {id(fabric.state.env): dict(env_items), id(fabric.state.output): dict(output_items)}
+    try:
+        yield
+    finally:
+        _thread_local.overlays = old_overlays
+        _uninstall_thread_local_state()
+
+
+@contextlib.contextmanager
+def host_context(host_string):
+    """Bind current thread to host.
+
+    Inside ``with host_context(host_string):`` block ``env.host_string`` is equal to ``host_string``,
+    so :obj:`~fabrix.config.conf` and all fabrix functions work with this host.
+    All other Fabric ``env`` and ``output`` settings are copied when block is entered,
+    and changes of them inside block, for example, by ``settings()`` or ``hide()``, are visible only in current thread.
+
+    Outside of any ``host_context`` block global ``env.host_string`` is used as usual.
+    Blocks can be nested, inner block binds thread to other host until it is finished.
+
+    Args:
+        host_string: Host string, like items of ``env.hosts`` list.
+
+    Example:
+
+    .. code-block:: python
+
+        def worker(host):
+            with host_context(host):
+                if conf.role == 'db':
+                    yum_install('postgresql-server')
+
+        threads = [threading.Thread(target=worker, args=(host,)) for host in env.hosts]
+    """
+    with _restore_context(_snapshot()), settings(host_string=host_string):
+        yield
+
+
+def current_host():
+    """Get host, to which current thread is bound.
+
+    Returns:
+        host string, bound by :func:`~host_context` in current thread, or global ``env.host_string`` otherwise.
+    """
+    return env.host_string
@@ -1,7 +1,8 @@
+import os
 import re
 import inspect
-from fabric.api import abort
-from fabrix.ioutil import read_local_file, read_file, _atomic_write_local_file, _atomic_write_file
+from fabric.api import env, abort
+from fabrix.ioutil import read_local_file, read_file, prefetch_files, _atomic_write_local_file, _atomic_write_file
 
 
 def _full_line(pattern):
@@ -12,6 +13,29 @@ def _full_line(pattern):
     return pattern
 
 
+def _line_editor(edit_lines, line_rule=None):
+    def editor(text):
+        lines = text.split('\n')
+        edit_lines(lines)
+        return '\n'.join(lines)
+    editor.__name__ = edit_lines.__name__
+    editor.edit_lines = edit_lines
+    if line_rule is not None:
+        editor.line_rule = line_rule
+    return editor
+
+
+def _caller():
+    for frame in inspect.stack()[1:]:
+        if frame[0].f_globals.get('__name__') != __name__:
+            return str(frame[1]), str(frame[2])
+    return None, None
+
+
+def _resplit(lines):
+    lines[:] = '\n'.join(lines).split('\n')
+
+
 def insert_line(line_to_insert, **kwargs):
     """Insert line editor.
 
@@ -49,41 +73,35 @@ def insert_line(line_to_insert, **kwargs):
         nline = str(inspect.stack()[1][2])
         abort('insert_line: must be defined \'before\' or \'after\' argument in file %s line %s' % (fname, nline))
 
-    def insert_line_editor(text):
-        regex = re.compile(anchor_pattern)
-        text_lines = text.split('\n')
+    regex = re.compile(anchor_pattern)
+
+    def insert_line_editor(lines):
         line_already_inserted = False
         anchor_lines = 0
-        for line in text_lines:
+        anchor_index = None
+        for index, line in enumerate(lines):
             match = regex.match(line)
             if match:
                 anchor_lines += 1
+                anchor_index = index
             if line == line_to_insert:
                 line_already_inserted = True
         if anchor_lines == 0:
-            fname = str(inspect.stack()[3][1])
-            nline = str(inspect.stack()[3][2])
+            fname, nline = _caller()
             abort('insert_line: anchor pattern \'%s\' not found in file %s line %s' % (anchor_pattern, fname, nline))
         elif anchor_lines > 1:
-            fname = str(inspect.stack()[3][1])
-            nline = str(inspect.stack()[3][2])
+            fname, nline = _caller()
             abort('insert_line: anchor pattern \'%s\' found %d times, must be only one in file %s line %s' % (anchor_pattern, anchor_lines, fname, nline))
-        out = list()
-        for line in text_lines:
-            match = regex.match(line)
-            if match and not line_already_inserted:
-                if insert_type == 'before':
-                    out.append(line_to_insert)
-                    out.append(line)
-                    continue
-                else:  # insert_type == 'after':
-                    out.append(line)
-                    out.append(line_to_insert)
-                    continue
-            else:
-                out.append(line)
-        return '\n'.join(out)
-    return insert_line_editor
+        if line_already_inserted:
+            return False
+        if insert_type == 'before':
+            lines.insert(anchor_index, line_to_insert)
+        else:  # insert_type == 'after':
+            lines.insert(anchor_index + 1, line_to_insert)
+        if '\n' in line_to_insert:
+            _resplit(lines)
+        return True
+    return _line_editor(insert_line_editor)
 
 
 def prepend_line(line_to_prepend, insert_empty_line_after=False):
@@ -100,15 +118,16 @@ def prepend_line(line_to_prepend, insert_empty_line_after=False):
         closure function, which acts as text editor, parameterized by :func:`~prepend_line` arguments.
     """
 
-    def prepend_line_editor(text):
-        text_lines = text.split('\n')
-        if line_to_prepend in text_lines:
-            return text
+    def prepend_line_editor(lines):
+        if line_to_prepend in lines:
+            return False
         if insert_empty_line_after:
-            text_lines.insert(0, '')
-        text_lines.insert(0, line_to_prepend)
-        return '\n'.join(text_lines)
-    return prepend_line_editor
+            lines.insert(0, '')
+        lines.insert(0, line_to_prepend)
+        if '\n' in line_to_prepend:
+            _resplit(lines)
+        return True
+    return _line_editor(prepend_line_editor)
 
 
 def append_line(line_to_append, insert_empty_line_before=False):
@@ -125,22 +144,23 @@ def append_line(line_to_append, insert_empty_line_before=False):
         closure function, which acts as text editor, parameterized by :func:`~append_line` arguments.
     """
 
-    def append_line_editor(text):
-        text_lines = text.split('\n')
-        if line_to_append in text_lines:
-            return text
-        if text_lines[-1] == '':
+    def append_line_editor(lines):
+        if line_to_append in lines:
+            return False
+        if lines[-1] == '':
             if insert_empty_line_before:
-                text_lines.append(line_to_append)
+                lines.append(line_to_append)
             else:
-                text_lines[-1] = line_to_append
+                lines[-1] = line_to_append
         else:
             if insert_empty_line_before:
-                text_lines.append('')
-            text_lines.append(line_to_append)
-        text_lines.append('')
-        return '\n'.join(text_lines)
-    return append_line_editor
+                lines.append('')
+            lines.append(line_to_append)
+        lines.append('')
+        if '\n' in line_to_append:
+            _resplit(lines)
+        return True
+    return _line_editor(append_line_editor)
 
 
 def delete_line(pattern):
@@ -154,18 +174,15 @@ def delete_line(pattern):
     Returns:
         closure function, which acts as text editor, parameterized by :func:`~delete_line` arguments.
     """
-    pattern = _full_line(pattern)
+    regex = re.compile(_full_line(pattern))
 
-    def delete_line_editor(text):
-        regex = re.compile(pattern)
-        out = list()
-        for line in text.split('\n'):
-            match = regex.match(line)
-            if match:
-                continue
-            out.append(line)
-        return '\n'.join(out)
-    return delete_line_editor
+    def delete_line_editor(lines):
+        kept = [line for line in lines if not regex.match(line)]
+        if len(kept) == len(lines):
+            return False
+        lines[:] = kept or ['']
+        return True
+    return _line_editor(delete_line_editor, (regex, None, 'delete'))
 
 
 def replace_line(pattern, repl, flags=0):
@@ -189,18 +206,21 @@ def replace_line(pattern, repl, flags=0):
     Returns:
         closure function, which acts as text editor, parameterized by :func:`~replace_line` arguments.
     """
-    pattern = _full_line(pattern)
+    regex = re.compile(_full_line(pattern), flags)
 
-    def replace_line_editor(text):
-        regex = re.compile(pattern, flags)
-        out = list()
-        for line in text.split('\n'):
+    def replace_line_editor(lines):
+        changed = False
+        resplit = False
+        for index, line in enumerate(lines):
             match = regex.match(line)
             if match:
-                line = regex.sub(repl, line)
-            out.append(line)
-        return '\n'.join(out)
-    return replace_line_editor
+                lines[index] = regex.sub(repl, line)
+                changed = changed or lines[index] != line
+                resplit = resplit or '\n' in lines[index]
+        if resplit:
+            _resplit(lines)
+        return changed
+    return _line_editor(replace_line_editor, (regex, repl, 'replace'))
 
 
 def substitute_line(pattern, repl, flags=0):
@@ -223,17 +243,21 @@ def substitute_line(pattern, repl, flags=0):
     Returns:
         closure function, which acts as text editor, parameterized by :func:`~substitute_line` arguments.
     """
+    regex = re.compile(pattern, flags)
 
-    def substitute_editor(text):
-        regex = re.compile(pattern, flags)
-        out = list()
-        for line in text.split('\n'):
+    def substitute_editor(lines):
+        changed = False
+        resplit = False
+        for index, line in enumerate(lines):
             found = regex.search(line)
             if found:
-                line = regex.sub(repl, line)
-            out.append(line)
-        return '\n'.join(out)
-    return substitute_editor
+                lines[index] = regex.sub(repl, line)
+                changed = changed or lines[index] != line
+                resplit = resplit or '\n' in lines[index]
+        if resplit:
+            _resplit(lines)
+        return changed
+    return _line_editor(substitute_editor, (regex, repl, 'substitute'))
 
 
 def strip_line(chars=None):
@@ -252,13 +276,115 @@ def strip_line(chars=None):
 
     """
 
-    def strip_editor(text):
-        out = list()
-        for line in text.split('\n'):
-            line = line.strip(chars)
+    def strip_editor(lines):
+        stripped_lines = [line.strip(chars) for line in lines]
+        changed = stripped_lines != lines
+        lines[:] = stripped_lines
+        return changed
+    return _line_editor(strip_editor)
+
+
+_BACKREFERENCE = re.compile(r'\\[1-9]|\(\?P=')
+
+
+def _combined_regex(rules):
+    flags = rules[0][0].flags
+    patterns = list()
+    for regex, dummy_repl, dummy_kind in rules:
+        if regex.flags != flags or _BACKREFERENCE.search(regex.pattern):
+            return None
+        patterns.append('(?:' + regex.pattern + ')')
+    try:
+        return re.compile('|'.join(patterns), flags)
+    except re.error:
+        return None
+
+
+def _apply_line_rules(line, rules, start):
+    for index in range(start, len(rules)):
+        regex, repl, kind = rules[index]
+        found = regex.search(line) if kind == 'substitute' else regex.match(line)
+        if not found:
+            continue
+        if kind == 'delete':
+            return list()
+        line = regex.sub(repl, line)
+        if '\n' in line:
+            out = list()
+            for part in line.split('\n'):
+                out.extend(_apply_line_rules(part, rules, index + 1))
+            return out
+    return [line]
+
+
+def _apply_fused_editors(lines, rules, changed_lines=None):
+    combined = _combined_regex(rules)
+    changed = False
+    out = list()
+    for line in lines:
+        if combined is not None and not combined.search(line):
             out.append(line)
-        return '\n'.join(out)
-    return strip_editor
+            continue
+        new_lines = _apply_line_rules(line, rules, 0)
+        if new_lines != [line]:
+            changed = True
+            if changed_lines is not None:
+                changed_lines.update(new_lines)
+        out.extend(new_lines)
+    lines[:] = out or ['']
+    return changed
+
+
+def _apply_line_editors(lines, editors):
+    changed = False
+    index = 0
+    while index < len(editors):
+        rules = list()
+        while index + len(rules) < len(editors) and hasattr(editors[index + len(rules)], 'line_rule'):
+            rules.append(editors[index + len(rules)].line_rule)
+        if len(rules) > 1:
+            changed = _apply_fused_editors(lines, rules) or changed
+            index += len(rules)
+            continue
+        ini_edits = list()
+        while index + len(ini_edits) < len(editors) and hasattr(editors[index + len(ini_edits)], 'ini_edit'):
+            ini_edits.append(editors[index + len(ini_edits)].ini_edit)
+        if len(ini_edits) > 1:
+            changed = _apply_ini_editors(lines, ini_edits) or changed
+            index += len(ini_edits)
+            continue
+        editor = editors[index]
+        edit_lines = getattr(editor, 'edit_lines', None)
+        if edit_lines is not None:
+            changed = edit_lines(lines) is not False or changed
+        else:
+            text = '\n'.join(lines)
+            new_text = editor(text)
+            if new_text != text:
+                lines[:] = new_text.split('\n')
+                changed = True
+        index += 1
+    return changed
+
+
+def _edit_lines(lines, editors):
+    strict = env.get('fabrix_strict_editors', False)
+    if not strict and all([hasattr(editor, 'line_rule') for editor in editors]):
+        rules = [editor.line_rule for editor in editors]
+        changed_lines = set()
+        changed = _apply_fused_editors(lines, rules, changed_lines)
+        idempotent = all([_apply_line_rules(line, rules, 0) == [line] for line in changed_lines])
+    else:
+        changed = _apply_line_editors(lines, editors)
+        idempotent = not strict and not changed
+        if not idempotent:
+            lines_after_second_pass = list(lines)
+            _apply_line_editors(lines_after_second_pass, editors)
+            idempotent = lines == lines_after_second_pass
+    if not idempotent:
+        fname, nline = _caller()
+        abort('editors is not idempotent in file %s line %s' % (fname, nline))
+    return changed
 
 
 def _apply_editors(old_text, *editors):
@@ -266,28 +392,216 @@ def _apply_editors(old_text, *editors):
         fname = str(inspect.stack()[2][1])
         nline = str(inspect.stack()[2][2])
         abort('editors can\'t be empty in file %s line %s' % (fname, nline))
-    text = old_text
-    for editor in editors:
-        text = editor(text)
-    text_after_first_pass = text
-    for editor in editors:
-        text = editor(text)
-    text_after_second_pass = text
-    if text_after_first_pass != text_after_second_pass:
-        fname = str(inspect.stack()[2][1])
-        nline = str(inspect.stack()[2][2])
-        abort('editors is not idempotent in file %s line %s' % (fname, nline))
-    new_text = text_after_second_pass
+    lines = old_text.split('\n')
+    _edit_lines(lines, editors)
+    new_text = '\n'.join(lines)
     changed = new_text != old_text
     return changed, new_text
 
 
+_INI_SECTION_REGEX = re.compile(r'^\s*\[(.*)\]\s*$')
+
+_INI_KEY_REGEX = re.compile(r'^(\s*([^#;=\s\[][^=]*?)\s*=\s*)(.*?)\s*$')
+
+
+class IniDocument(object):
+    """Parsed ini file.
+
+    Text is parsed only once. Document keeps lines of each section and index of keys,
+    so many sections and keys can be read and changed without scanning text again.
+    Comments, empty lines and order of sections and keys are preserved.
+
+    Sections are named in form '[section_name]', ``None`` is name of lines before first section.
+
+    Args:
+        text: Text of ini file, must be string.
+
+    Raises:
+        :class:`~exceptions.SystemExit`: When section is duplicated.
+
+    Example:
+
+    .. code-block:: python
+
+        document = IniDocument(read_file('/etc/yum.repos.d/zfs.repo'))
+        if document.get('[zfs-kmod]', 'enabled') != '1':
+            ...
+    """
+
+    def __init__(self, text):
+        self._parse(text.split('\n'), 'IniDocument')
+
+    @classmethod
+    def _from_lines(cls, lines, caller):
+        document = cls.__new__(cls)
+        document._parse(lines, caller)  # pylint: disable=protected-access
+        return document
+
+    def _parse(self, lines, caller):
+        self._order = [None]
+        self._headers = dict()
+        self._sections = {None: list()}
+        self._keys = dict()
+        current_section_lines = self._sections[None]
+        for line in lines:
+            match = _INI_SECTION_REGEX.match(line)
+            if match:
+                section_name = '[' + match.group(1) + ']'
+                if section_name in self._sections:
+                    fname, nline = _caller()
+                    abort('%s: bad ini file, section \'%s\' duplicated in file %s line %s' % (caller, section_name, fname, nline))
+                self._order.append(section_name)
+                self._headers[section_name] = line
+                current_section_lines = self._sections[section_name] = list()
+            else:
+                current_section_lines.append(line)
+
+    def _section_lines(self, section_name, caller):
+        if section_name not in self._sections:
+            fname, nline = _caller()
+            abort('%s: section \'%s\' not found in file %s line %s' % (caller, section_name, fname, nline))
+        return self._sections[section_name]
+
+    def _key_index(self, section_name):
+        if section_name not in self._keys:
+            keys = dict()
+            for index, line in enumerate(self._sections[section_name]):
+                match = _INI_KEY_REGEX.match(line)
+                if match and match.group(2) not in keys:
+                    keys[match.group(2)] = index
+            self._keys[section_name] = keys
+        return self._keys[section_name]
+
+    def sections(self):
+        """Names of sections in order of ini file, without ``None``."""
+        return self._order[1:]
+
+    def has_section(self, section_name):
+        """Is section exists?"""
+        return section_name in self._sections
+
+    def get(self, section_name, key, default=None):
+        """Get value of key.
+
+        Args:
+            section_name: Name of section, must be in form '[section_name]'.
+            key: Name of key.
+            default: Value returned if section or key is not exists.
+
+        Returns:
+            value of key, stripped, or ``default``.
+        """
+        if section_name not in self._sections:
+            return default
+        index = self._key_index(section_name).get(key)
+        if index is None:
+            return default
+        return _INI_KEY_REGEX.match(self._sections[section_name][index]).group(3)
+
+    def set(self, section_name, key, value):
+        """Set value of key.
+
+        Existing key is changed in place, spacing around '=' is preserved.
+        New key is added as ``key=value`` after last non-empty line of section.
+
+        Args:
+            section_name: Name of existing section, must be in form '[section_name]'.
+            key: Name of key.
+            value: New value of key, must be string.
+
+        Returns:
+            True if document is changed, False otherwise.
+
+        Raises:
+            :class:`~exceptions.SystemExit`: When section not found.
+        """
+        return self._set(section_name, key, value, 'IniDocument.set')
+
+    def _set(self, section_name, key, value, caller):
+        lines = self._section_lines(section_name, caller)
+        keys = self._key_index(section_name)
+        index = keys.get(key)
+        if index is not None:
+            match = _INI_KEY_REGEX.match(lines[index])
+            if match.group(3) == value:
+                return False
+            lines[index] = match.group(1) + value
+            return True
+        position = len(lines)
+        while position > 0 and not lines[position - 1].strip():
+            position -= 1
+        lines.insert(position, key + '=' + value)
+        del self._keys[section_name]
+        return True
+
+    def edit_section(self, section_name, *editors):
+        """Apply editors to lines of section, see :func:`~edit_ini_section`.
+
+        Args:
+            section_name: Name of existing section, must be in form '[section_name]'.
+            editors: List of line editors.
+
+        Returns:
+            True if document is changed, False otherwise.
+
+        Raises:
+            :class:`~exceptions.SystemExit`: When section not found or editors are not idempotent.
+        """
+        return self._edit_section(section_name, editors, 'IniDocument.edit_section')
+
+    def _edit_section(self, section_name, editors, caller):
+        lines = self._section_lines(section_name, caller) or ['']
+        changed = _edit_lines(lines, editors)
+        if changed:
+            self._sections[section_name] = lines
+            self._keys.pop(section_name, None)
+        return changed
+
+    def lines(self):
+        """Lines of document."""
+        lines = list()
+        for section_name in self._order:
+            if section_name is not None:
+                lines.append(self._headers[section_name])
+            lines.extend(self._sections[section_name])
+        return lines
+
+    def text(self):
+        """Text of document."""
+        return '\n'.join(self.lines())
+
+
+def _ini_editor(ini_edit):
+    def ini_editor(lines):
+        document = IniDocument._from_lines(lines, ini_edit[0])  # pylint: disable=protected-access
+        if not ini_edit[1](document):
+            return False
+        lines[:] = document.lines()
+        return True
+    editor = _line_editor(ini_editor)
+    editor.ini_edit = ini_edit
+    return editor
+
+
+def _apply_ini_editors(lines, ini_edits):
+    document = IniDocument._from_lines(lines, ini_edits[0][0])  # pylint: disable=protected-access
+    changed = False
+    for dummy_caller, ini_edit in ini_edits:
+        changed = ini_edit(document) or changed
+    if changed:
+        lines[:] = document.lines()
+    return changed
+
+
 def edit_ini_section(section_name_to_edit, *editors):
     """Edit ini section text editor.
 
     Apply all editors from list ``editors`` to section named ``section_name_to_edit``.
     ``editors`` is any combination of **line** editors: :func:`~insert_line`, :func:`~delete_line`, :func:`~replace_line` and so on.
 
+    Many consecutive :func:`~edit_ini_section` and :func:`~set_ini_value` editors share one parsed :class:`~IniDocument`,
+    so ini file is parsed and serialized only once.
+
     Args:
         section_name_to_edit: Name of section to edit, must be in form '[section_name]'.
         editors: List of editors to apply for selected ini section.
@@ -303,48 +617,45 @@ def edit_ini_section(section_name_to_edit, *editors):
             fname = str(inspect.stack()[1][1])
             nline = str(inspect.stack()[1][2])
             abort('edit_ini_section: section name must be in form [section_name] in file %s line %s' % (fname, nline))
-        section_name_to_edit = section_name_to_edit[1:-1]
-
-    def ini_section_editor(text):  # pylint: disable=too-many-locals
-        pattern = r'^\s*\[(.*)\]\s*$'
-        regex = re.compile(pattern)
-        current_section_name = None
-        current_section_text = list()
-        section_content = dict()
-        section_order = list()
-        for line in text.split('\n'):
-            match = regex.match(line)
-            if match:
-                new_section_name = match.group(1)
-                if new_section_name in section_content or new_section_name == current_section_name:
-                    fname = str(inspect.stack()[3][1])
-                    nline = str(inspect.stack()[3][2])
-                    abort('edit_ini_section: bad ini file, section \'[%s]\' duplicated in file %s line %s' % (new_section_name, fname, nline))
-                section_content[current_section_name] = current_section_text
-                section_order.append(current_section_name)
-                current_section_name = new_section_name
-                current_section_text = list()
-            else:
-                current_section_text.append(line)
-        section_content[current_section_name] = current_section_text
-        section_order.append(current_section_name)
-        if section_name_to_edit in section_content:
-            old_text = '\n'.join(section_content[section_name_to_edit])
-            changed, new_text = _apply_editors(old_text, *editors)
-            if changed:
-                section_content[section_name_to_edit] = new_text.split('\n')
-        else:
-            fname = str(inspect.stack()[3][1])
-            nline = str(inspect.stack()[3][2])
-            abort('edit_ini_section: section \'[%s]\' not found in file %s line %s' % (section_name_to_edit, fname, nline))
-        out = list()
-        for section_name in section_order:
-            if section_name is not None:
-                out.append('[' + section_name + ']')
-            section_text = section_content[section_name]
-            out.extend(section_text)
-        return '\n'.join(out)
-    return ini_section_editor
+
+    if not editors:
+        fname = str(inspect.stack()[1][1])
+        nline = str(inspect.stack()[1][2])
+        abort('editors can\'t be empty in file %s line %s' % (fname, nline))
+
+    def ini_section_edit(document):
+        return document._edit_section(section_name_to_edit, editors, 'edit_ini_section')  # pylint: disable=protected-access
+    return _ini_editor(('edit_ini_section', ini_section_edit))
+
+
+def set_ini_value(section_name, key, value):
+    """Set ini value text editor.
+
+    Sets value of ``key`` in section ``section_name``, see :meth:`~IniDocument.set`.
+
+    Args:
+        section_name: Name of section, must be in form '[section_name]'.
+        key: Name of key.
+        value: New value of key, must be string.
+
+    Returns:
+        closure function, which acts as text editor, parameterized by :func:`~set_ini_value` arguments.
+
+    Raises:
+        :class:`~exceptions.SystemExit`: When error occurred.
+    """
+    if section_name is not None and (section_name[0] != '[' or section_name[-1] != ']'):
+        fname = str(inspect.stack()[1][1])
+        nline = str(inspect.stack()[1][2])
+        abort('set_ini_value: section name must be in form [section_name] in file %s line %s' % (fname, nline))
+    if '\n' in key or '\n' in value:
+        fname = str(inspect.stack()[1][1])
+        nline = str(inspect.stack()[1][2])
+        abort('set_ini_value: key and value must be one line in file %s line %s' % (fname, nline))
+
+    def ini_value_edit(document):
+        return document._set(section_name, key, value, 'set_ini_value')  # pylint: disable=protected-access
+    return _ini_editor(('set_ini_value', ini_value_edit))
 
 
 def edit_local_file(local_filename, *editors):
@@ -395,10 +706,61 @@ def edit_file(remote_filename, *editors):
     old_text = read_file(remote_filename)
     changed, new_text = _apply_editors(old_text, *editors)
     if changed:
-        _atomic_write_file(remote_filename, new_text)
+        _atomic_write_file(remote_filename, new_text, old_text)
     return changed
 
 
+def edit_files(files):
+    """Edit many remote files text editor.
+
+    Apply editors to text of each **remote** file, like :func:`~edit_file` does, but much faster:
+    all files are downloaded in one archive stream, see :func:`~fabrix.ioutil.prefetch_files`,
+    and all changed files are uploaded together and installed in one remote command.
+    If editors of any file failed - no files are changed.
+
+    Args:
+        files: dict, which maps name of **remote** file, must be absolute, to list of editors for this file.
+
+    Returns:
+        dict, which maps name of remote file to True if file is changed, else False.
+
+    Raises:
+        :class:`~exceptions.SystemExit`: When error occurred.
+
+    Example:
+
+    .. code-block:: python
+
+        edit_files({
+            '/etc/ssh/sshd_config': [replace_line(r'^#?UseDNS .*', 'UseDNS no')],
+            '/etc/default/grub': [replace_line(r'^GRUB_TIMEOUT=.*', 'GRUB_TIMEOUT=1')],
+        })
+    """
+    if not isinstance(files, dict):
+        fname = str(inspect.stack()[1][1])
+        nline = str(inspect.stack()[1][2])
+        abort('edit_files: dict expected in file %s line %s' % (fname, nline))
+    remote_filenames = sorted(files)
+    for remote_filename in remote_filenames:
+        if not os.path.isabs(remote_filename):
+            fname = str(inspect.stack()[1][1])
+            nline = str(inspect.stack()[1][2])
+            abort('edit_files: remote filename must be absolute, "%s" given in file %s line %s' % (remote_filename, fname, nline))
+        if not files[remote_filename]:
+            fname = str(inspect.stack()[1][1])
+            nline = str(inspect.stack()[1][2])
+            abort('editors can\'t be empty in file %s line %s' % (fname, nline))
+    changed_files = dict()
+    with prefetch_files(*remote_filenames, write_back=True):
+        old_texts = [read_file(remote_filename) for remote_filename in remote_filenames]
+        results = [_apply_editors(old_text, *files[remote_filename]) for remote_filename, old_text in zip(remote_filenames, old_texts)]
+        for remote_filename, old_text, (changed, new_text) in zip(remote_filenames, old_texts, results):
+            if changed:
+                _atomic_write_file(remote_filename, new_text, old_text)
+            changed_files[remote_filename] = changed
+    return changed_files
+
+
 def edit_text(text, *editors):
     """Edit text editor.
 
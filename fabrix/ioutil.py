@@ -3,21 +3,43 @@ import os
 import os.path
 import re
 import uuid
+import base64
 import StringIO
 import pprint
 import inspect
 import numbers
+import operator
+import difflib
+import hashlib
+import pipes
+import posixpath
+import atexit
+import tarfile
+import time
+import tempfile
+import errno
+import stat
+import shutil
+import subprocess
+import threading
+import contextlib
+import collections
+import paramiko
 import fabric.state
 import fabric.api
 from fabric.colors import red
-from fabric.api import env, abort, local, get, put, settings
+from fabric.operations import _AttributeString
+from fabric.api import env, abort, local, settings
+from fabric.state import connections
 from fabric.network import key_filenames, normalize
+from fabrix.timing import _start_section, _command_class, _current_command_class, _record, _timed
 
 
 def name(description):
     """Print one line description about running action
     """
     print "[%s] * %s" % (env.host_string, description)
+    _start_section(description)
 
 
 def warn(message):
@@ -29,12 +51,511 @@ def warn(message):
 def run(*args, **kwargs):
     """Run command with settings hide('everything')
 
+    Inside :func:`~batch` command is not executed immediately, but queued for execution with other commands.
+
+    Command can change anything on remote host, so remote filesystem stat cache is cleared, see :func:`~fill_stat_cache`.
+
+    Result of read-only command, registered by :func:`~memoize`, is cached and returned without execution next time,
+    until any other command is executed on the same host.
+
     Returns:
         Result of :func:`~fabric.operations.run` execution.
+        Inside :func:`~batch` - :class:`~BatchResult` object, which will be set to result of command execution.
 
     """
-    with settings(fabric.api.hide('everything')):
-        return fabric.api.run(*args, **kwargs)
+    if _is_memoizable(*args, **kwargs):
+        memo_cache = _memo_cache()
+        if args[0] in memo_cache:
+            with _memo_stats_lock:
+                _memo_stats['hits'] += 1
+            return memo_cache[args[0]]
+        with _memo_stats_lock:
+            _memo_stats['misses'] += 1
+        with settings(fabric.api.hide('everything')), _timed('run', 'query', args[0]) as counter:
+            stdout = fabric.api.run(*args, **kwargs)
+            counter['bytes'] = len(args[0]) + len(stdout)
+        if stdout.succeeded:
+            memo_cache[args[0]] = stdout
+        return stdout
+    if not _stat_cache_keepers() and not (args and args[0] in _memoized_commands):
+        _flush_writes()
+        _stat_cache().clear()
+        _memo_cache().clear()
+        _content_cache().clear()
+    current_batch = _current_batch()
+    if current_batch is not None:
+        if current_batch.is_batchable(*args, **kwargs):
+            return current_batch.queue(args[0])
+        current_batch.flush()
+    command_class = _current_command_class()
+    if command_class is None:
+        command_class = 'query' if _stat_cache_keepers() or (args and args[0] in _memoized_commands) else 'mutation'
+    command = args[0] if args else kwargs.get('command')
+    with settings(fabric.api.hide('everything')), _timed('run', command_class, command) as counter:
+        stdout = fabric.api.run(*args, **kwargs)
+        counter['bytes'] = len(command or '') + len(stdout)
+    return stdout
+
+
+_memoized_commands = set()
+
+_memo_caches = dict()
+
+_memo_stats = dict(hits=0, misses=0)
+
+_memo_stats_lock = threading.Lock()
+
+
+def _memo_cache():
+    if env.host_string not in _memo_caches:
+        _memo_caches[env.host_string] = dict()
+    return _memo_caches[env.host_string]
+
+
+def _is_memoizable(*args, **kwargs):
+    if len(args) != 1 or kwargs or args[0] not in _memoized_commands or _current_batch() is not None:
+        return False
+    if env.cwd or env.command_prefixes or env.shell_env or env.path:
+        return False
+    return True
+
+
+def memoize(*commands):
+    """Register read-only commands, results of which are cached by :func:`~run`.
+
+    Command is cached per host, when it is executed successfully. Cache of host is cleared
+    when any not registered command is executed on this host, or when files are written or synced to it,
+    so only commands, which don't change anything on remote host, should be registered.
+
+    Example:
+
+    .. code-block:: python
+
+        memoize('getent passwd', 'getent group', 'hostnamectl status')
+
+    Args:
+        *commands: commands, exactly as they are passed to :func:`~run`.
+
+    Returns:
+        None
+    """
+    _memoized_commands.update(commands)
+
+
+def clear_memo_cache():
+    """Clear cache of read-only commands of current host, see :func:`~memoize`.
+
+    Returns:
+        None
+    """
+    _memo_cache().clear()
+
+
+def memo_cache_stats():
+    """Get statistics of cache of read-only commands, see :func:`~memoize`.
+
+    Returns:
+        dict with keys ``hits`` and ``misses``, number of cache hits and misses of all hosts.
+    """
+    with _memo_stats_lock:
+        return dict(_memo_stats)
+
+
+class BatchResult(object):
+    """Deferred result of operation queued inside :func:`~batch`.
+
+    Result of operation is available via attribute ``value`` after all queued operations are executed.
+    If ``value`` is requested before this moment - all queued operations are executed immediately.
+
+    ``BatchResult`` object can be used in boolean context, compared with other values,
+    used with ``in``, ``+``, ``%``, ``len()``, iteration, indexing and string methods,
+    in all these cases all queued operations are executed and it works like ``value``.
+    Use ``value`` when real object is required, for example, for ``isinstance()``.
+    """
+
+    def __init__(self, current_batch):
+        self._batch = current_batch
+        self._converters = list()
+        self._ready = False
+        self._value = None
+
+    @property
+    def value(self):
+        """Result of queued operation."""
+        if not self._ready:
+            self._batch.flush()
+        return self._value
+
+    def _set(self, value):
+        for convert in self._converters:
+            value = convert(value)
+        self._value = value
+        self._ready = True
+
+    def __nonzero__(self):
+        return bool(self.value)
+
+    def __eq__(self, other):
+        return self.value == other
+
+    def __ne__(self, other):
+        return self.value != other
+
+    def __str__(self):
+        return str(self.value)
+
+    def __repr__(self):
+        return repr(self.value)
+
+    def __unicode__(self):
+        return unicode(self.value)
+
+    def __hash__(self):
+        return hash(self.value)
+
+    def __radd__(self, other):
+        return other + self.value
+
+    def __rmul__(self, other):
+        return other * self.value
+
+    def __rmod__(self, other):
+        return other % self.value
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.value, name)
+
+
+def _deferred_operator(function):
+    def deferred_operator(self, *args):
+        return function(self.value, *args)
+    deferred_operator.__name__ = function.__name__
+    return deferred_operator
+
+
+for _name, _function in (('__lt__', operator.lt), ('__le__', operator.le), ('__gt__', operator.gt), ('__ge__', operator.ge),
+                         ('__contains__', operator.contains), ('__getitem__', operator.getitem), ('__add__', operator.add),
+                         ('__mul__', operator.mul), ('__mod__', operator.mod), ('__len__', len), ('__iter__', iter),
+                         ('__int__', int), ('__float__', float)):
+    setattr(BatchResult, _name, _deferred_operator(_function))
+del _name, _function
+
+
+class _Batch(object):
+
+    def __init__(self, host_string):
+        self.host_string = host_string
+        self.operations = list()
+
+    def is_batchable(self, *args, **kwargs):
+        if len(args) != 1 or kwargs or env.host_string != self.host_string:
+            return False
+        if env.cwd or env.command_prefixes or env.shell_env or env.path:
+            return False
+        return True
+
+    def queue(self, command):
+        result = BatchResult(self)
+        self.operations.append((command, env.warn_only, list(env.ok_ret_codes), result))
+        return result
+
+    def flush(self):
+        operations = self.operations
+        self.operations = list()
+        if not operations:
+            return
+        marker = '__fabrix_batch_' + uuid.uuid4().hex
+        script = list()
+        for index, (command, warn_only, dummy_ok_ret_codes, dummy_result) in enumerate(operations):
+            script.append('echo %s_%d_begin' % (marker, index))
+            script.append('( ' + command + '\n)')
+            script.append('rc=$? ; echo ; echo %s_%d_end $rc' % (marker, index))
+            if not warn_only:
+                script.append('if [ $rc -ne 0 ] ; then exit $rc ; fi')
+        with settings(fabric.api.hide('everything'), host_string=self.host_string, warn_only=True):
+            with _timed('batch', 'mutation', '\n'.join(script)) as counter:
+                stdout = fabric.api.run('\n'.join(script))
+                counter['bytes'] = len('\n'.join(script)) + len(stdout)
+        outputs = _parse_batch_output(stdout, marker)
+        for index, (command, warn_only, ok_ret_codes, result) in enumerate(operations):
+            if index not in outputs:
+                abort('batch: command \'%s\' was not executed on host %s' % (command, self.host_string))
+            return_code, text = outputs[index]
+            out = _AttributeString(text)
+            out.command = command
+            out.return_code = return_code
+            out.failed = return_code not in ok_ret_codes
+            out.succeeded = not out.failed
+            if out.failed and not warn_only:
+                abort('batch: command \'%s\' received nonzero return code %d on host %s' % (command, return_code, self.host_string))
+            result._set(out)  # pylint: disable=protected-access
+
+
+def _parse_batch_output(stdout, marker):
+    begin_regexp = re.compile('^' + marker + r'_(\d+)_begin$')
+    end_regexp = re.compile('^' + marker + r'_(\d+)_end (\d+)$')
+    outputs = dict()
+    lines = None
+    for line in stdout.splitlines():
+        match = begin_regexp.match(line.strip())
+        if match:
+            lines = list()
+            continue
+        match = end_regexp.match(line.strip())
+        if match and lines is not None:
+            outputs[int(match.group(1))] = (int(match.group(2)), '\n'.join(lines).strip())
+            lines = None
+            continue
+        if lines is not None:
+            lines.append(line)
+    return outputs
+
+
+_thread_local = threading.local()
+
+
+def _batches():
+    return _thread_local.__dict__.setdefault('batches', list())
+
+
+def _current_batch():
+    batches = _batches()
+    if batches:
+        return batches[-1]
+    return None
+
+
+def _flush_batch():
+    current_batch = _current_batch()
+    if current_batch is not None:
+        current_batch.flush()
+
+
+def _deferred(result, convert):
+    if isinstance(result, BatchResult):
+        if result._ready:  # pylint: disable=protected-access
+            result._value = convert(result._value)  # pylint: disable=protected-access
+        else:
+            result._converters.append(convert)  # pylint: disable=protected-access
+        return result
+    return convert(result)
+
+
+@contextlib.contextmanager
+def batch():
+    """Execute remote operations in batch.
+
+    All :func:`~run` calls inside ``with batch():`` block, including calls from functions
+    :func:`~is_file_exists`, :func:`~create_directory`, :func:`~remove_file`, :func:`~chmod`, :func:`~chown`,
+    ``systemctl_*`` and so on, are queued and executed on remote host as one shell script,
+    when block is finished. So many operations cost only one round trip to remote host.
+
+    Functions called inside block return :class:`~BatchResult` objects instead of values,
+    result of each operation is available via attribute ``value`` after block is finished.
+
+    Functions which transfer files, like :func:`~read_file` or :func:`~write_file`,
+    execute all queued operations before transfer. Request of ``value`` before block is finished
+    also execute all queued operations immediately. So order of operations is always preserved.
+
+    If exception raised inside block - queued operations are not executed.
+
+    Example:
+
+    .. code-block:: python
+
+        with batch():
+            changed1 = create_directory('/etc/example')
+            changed2 = chmod('/etc/example', 0700)
+            systemctl_restart('example')
+        if changed1.value or changed2.value:
+            name('directory created')
+    """
+    current_batch = _current_batch()
+    if current_batch is not None and current_batch.host_string == env.host_string:
+        yield
+        return
+    current_batch = _Batch(env.host_string)
+    _batches().append(current_batch)
+    try:
+        yield
+    finally:
+        _batches().pop()
+    current_batch.flush()
+
+
+def _immediate(value):
+    current_batch = _current_batch()
+    if current_batch is None:
+        return value
+    result = BatchResult(current_batch)
+    result._set(value)  # pylint: disable=protected-access
+    return result
+
+
+_UNKNOWN = object()
+
+
+class _StatCache(object):
+
+    def __init__(self):
+        self.kinds = dict()
+        self.listed_directories = set()
+        self.generation = 0
+
+    def lookup(self, path):
+        path = posixpath.normpath(path)
+        if path in self.kinds:
+            return self.kinds[path]
+        if posixpath.dirname(path) in self.listed_directories:
+            return None
+        return _UNKNOWN
+
+    def store(self, path, kind, generation=None):
+        if generation is not None and generation != self.generation:
+            return
+        path = posixpath.normpath(path)
+        self.kinds[path] = kind
+        if kind != 'directory':
+            self.listed_directories.discard(path)
+
+    def forget(self, path):
+        self.store(path, _UNKNOWN)
+
+    def clear(self):
+        self.kinds.clear()
+        self.listed_directories.clear()
+        self.generation += 1
+
+
+_stat_caches = dict()
+
+
+def _stat_cache_keepers():
+    return _thread_local.__dict__.setdefault('stat_cache_keepers', list())
+
+
+def _stat_cache():
+    if env.host_string not in _stat_caches:
+        _stat_caches[env.host_string] = _StatCache()
+    return _stat_caches[env.host_string]
+
+
+@contextlib.contextmanager
+def _keep_stat_cache():
+    _stat_cache_keepers().append(True)
+    try:
+        yield
+    finally:
+        _stat_cache_keepers().pop()
+
+
+_STAT_KINDS = {'f': 'file', 'd': 'directory', 'o': 'other', 'n': None}
+
+_FIND_KINDS = {'f': 'file', 'd': 'directory', 'l': None}
+
+
+def _stat_command(path):
+    path = pipes.quote(path)
+    return ('if [ -f ' + path + ' ] ; then echo f ; elif [ -d ' + path + ' ] ; then echo d ; '
+            'elif [ -e ' + path + ' ] ; then echo o ; else echo n ; fi')
+
+
+def _stat(path, caller):
+    kind = _stat_cache().lookup(path)
+    if kind is not _UNKNOWN:
+        return _immediate(kind)
+    generation = _stat_cache().generation
+
+    def convert(stdout):
+        if stdout not in _STAT_KINDS:
+            abort('%s: unexpected output \'%s\' of stat command for path \'%s\' on host %s' % (caller, stdout, path, env.host_string))
+        kind = _STAT_KINDS[stdout]
+        _stat_cache().store(path, kind, generation)
+        return kind
+    with _keep_stat_cache():
+        return _deferred(run(_stat_command(path)), convert)
+
+
+def _mutate(path, command, result, changed_kind, not_changed_kind):
+    _flush_writes()
+    _forget_content(path)
+    stat_cache = _stat_cache()
+    stat_cache.forget(path)
+    generation = stat_cache.generation
+
+    def convert_and_store(stdout):
+        changed = stdout == result
+        kind = changed_kind if changed else not_changed_kind
+        if kind is not _UNKNOWN:
+            stat_cache.store(path, kind, generation)
+        if changed and kind == 'directory' and generation == stat_cache.generation:
+            # just created directory is empty
+            stat_cache.listed_directories.add(posixpath.normpath(path))
+        return changed
+    _memo_cache().clear()
+    with _keep_stat_cache(), _command_class('mutation'):
+        return _deferred(run(command), convert_and_store)
+
+
+def fill_stat_cache(*paths):
+    """Fill remote filesystem stat cache.
+
+    Functions :func:`~is_file_exists`, :func:`~is_directory_exists`, :func:`~create_file`, :func:`~remove_file`
+    and so on use per-host cache of remote filesystem objects, so repeated checks of same paths cost nothing.
+    Cache is updated by these functions and cleared by any other :func:`~run` call.
+
+    :func:`~fill_stat_cache` with one remote command stats all ``paths``
+    and lists entries of all ``paths`` which are directories, so any checks of these paths
+    or of files inside these directories are answered from cache without remote commands.
+
+    Args:
+        paths: Remote paths, files or directories, must be absolute.
+
+    Returns:
+        None
+    """
+    for path in paths:
+        if not os.path.isabs(path):
+            fname = str(inspect.stack()[1][1])
+            nline = str(inspect.stack()[1][2])
+            abort('fill_stat_cache: remote path \'%s\' must be absolute in file %s line %s' % (path, fname, nline))
+    if not paths:
+        return
+    quoted_paths = ' '.join([pipes.quote(posixpath.normpath(path)) for path in paths])
+    command = ('for path in ' + quoted_paths + ' ; do '
+               'if [ -f "$path" ] ; then echo "pf $path" ; '
+               'elif [ -d "$path" ] ; then echo "pd $path" ; '
+               'find -L "$path" -mindepth 1 -maxdepth 1 -printf \'c%y %p\\n\' 2>/dev/null && echo "ld $path" ; '
+               'elif [ -e "$path" ] ; then echo "po $path" ; else echo "pn $path" ; fi ; done')
+    _flush_batch()
+    with _keep_stat_cache():
+        stdout = run(command)
+    stat_cache = _stat_cache()
+    for line in stdout.splitlines():
+        line = line.rstrip('\r')
+        if len(line) < 4 or line[2] != ' ':
+            continue
+        source, kind, path = line[0], line[1], posixpath.normpath(line[3:])
+        if source == 'p' and kind in _STAT_KINDS:
+            stat_cache.store(path, _STAT_KINDS[kind])
+        elif source == 'c':
+            stat_cache.store(path, _FIND_KINDS.get(kind, 'other'))
+        elif source == 'l':
+            stat_cache.listed_directories.add(path)
+
+
+def clear_stat_cache():
+    """Clear remote filesystem stat cache of current host.
+
+    .. seealso::
+        :func:`~fill_stat_cache`
+
+    Returns:
+        None
+    """
+    _stat_cache().clear()
 
 
 def debug_print(*args):
@@ -92,19 +613,308 @@ def read_file(remote_filename, abort_on_error=True):
     Returns:
         content of file or ``None`` if errors encountered and abort_on_error is False.
     """
-    with settings(fabric.api.hide('everything')):
-        file_like_object = StringIO.StringIO()
-        with settings(warn_only=True):
-            if get(local_path=file_like_object, remote_path=remote_filename).failed:
-                file_like_object.close()
-                if abort_on_error:
-                    abort('downloading file ' + remote_filename + ' from host %s failed' % env.host_string)
-                else:
-                    return None
-            file_like_object.seek(0)
-            content = file_like_object.read()
-            file_like_object.close()
-        return content
+    content_cache = _content_cache()
+    if posixpath.normpath(remote_filename) in content_cache:
+        return content_cache[posixpath.normpath(remote_filename)]
+    _flush_batch()
+    _flush_writes()
+    file_like_object = StringIO.StringIO()
+    if not _sftp_get(local_path=file_like_object, remote_path=remote_filename):
+        file_like_object.close()
+        if abort_on_error:
+            abort('downloading file ' + remote_filename + ' from host %s failed' % env.host_string)
+        else:
+            return None
+    file_like_object.seek(0)
+    content = file_like_object.read()
+    file_like_object.close()
+    return content
+
+
+def iter_file_lines(remote_filename, chunk_size=65536, offset=0):
+    """Iterate over lines of remote file.
+
+    Unlike :func:`~read_file` remote file is not read into memory, it is read by chunks of ``chunk_size`` bytes,
+    so even very large files can be processed with bounded memory usage.
+
+    Args:
+        remote_filename: Remote file name, must be absolute.
+        chunk_size: Size of chunk in bytes, which is read from remote file at once.
+        offset: Position in file, from which lines are read. If offset is negative - it is counted from the end of file,
+            for example, ``offset=-65536`` reads only last 64 KiB of file, like ``tail`` command.
+            In this case first line, if it is incomplete, is skipped.
+
+    Returns:
+        generator, which yields lines of remote file without trailing newline characters.
+
+    Raises:
+        :class:`~exceptions.SystemExit`: When error occurred during reading file.
+    """
+    if not os.path.isabs(remote_filename):
+        fname = str(inspect.stack()[1][1])
+        nline = str(inspect.stack()[1][2])
+        abort('iter_file_lines: remote filename must be absolute, "%s" given in file %s line %s' % (remote_filename, fname, nline))
+    return _iter_file_lines(remote_filename, chunk_size, offset)
+
+
+def _iter_file_lines(remote_filename, chunk_size, offset):
+    _flush_batch()
+    _flush_writes()
+    try:
+        with _sftp_lock(env.host_string):
+            remote_file = _sftp().open(remote_filename, 'r')
+    except (IOError, OSError, EOFError, paramiko.SSHException):
+        abort('downloading file ' + remote_filename + ' from host %s failed' % env.host_string)
+    try:
+        skip_first_line = False
+        if offset < 0:
+            size = remote_file.stat().st_size
+            if size > -offset:
+                remote_file.seek(size + offset - 1)
+                skip_first_line = True
+        elif offset > 0:
+            remote_file.seek(offset)
+        tail = ''
+        while True:
+            try:
+                chunk = remote_file.read(chunk_size)
+            except (IOError, OSError, EOFError, paramiko.SSHException):
+                abort('downloading file ' + remote_filename + ' from host %s failed' % env.host_string)
+            if not chunk:
+                break
+            lines = (tail + chunk).split('\n')
+            tail = lines.pop()
+            if skip_first_line and lines:
+                lines.pop(0)
+                skip_first_line = False
+            for line in lines:
+                yield line
+        if tail and not skip_first_line:
+            yield tail
+    finally:
+        remote_file.close()
+
+
+_content_caches = dict()
+
+_write_backs = dict()
+
+_prefetch_depths = dict()
+
+
+def _prefetch_scope():
+    # concurrent steps on the same host must not share prefetched content and pending writes
+    return env.host_string, threading.current_thread().ident
+
+
+def _content_cache():
+    return _content_caches.get(_prefetch_scope(), dict())
+
+
+def _forget_content(path):
+    path = posixpath.normpath(path)
+    prefix = path.rstrip('/') + '/'
+    content_cache = _content_cache()
+    for filename in list(content_cache):
+        if filename == path or filename.startswith(prefix):
+            del content_cache[filename]
+
+
+@contextlib.contextmanager
+def prefetch_files(*remote_filenames, **kwargs):
+    """Download many remote files in one tar stream and read them from local cache.
+
+    Inside ``with prefetch_files(...):`` block :func:`~read_file` and :func:`~fabrix.editor.edit_file`
+    get content of prefetched files from cache of current host without any round trip.
+    Files, which not exist or are not regular files, are not prefetched.
+
+    If ``write_back`` is True, files written by :func:`~write_file` and :func:`~fabrix.editor.edit_file` inside block
+    are not uploaded immediately, but stored in cache, and all of them are uploaded as one tar stream
+    and atomically installed in one remote command, when block is finished. Pending files are also written
+    before any :func:`~run` command, which can depend on them, and before any other operation, which reads, checksums
+    or changes remote files, for example, :func:`~remove_file` or :func:`~iter_file_lines`.
+    If exception raised inside block - pending files are not written.
+
+    Cache and pending files are kept separately for each host and each thread,
+    so concurrent steps of :func:`~fabrix.steps.run_steps` on the same host don't see pending files of each other.
+
+    Blocks can be nested. Cache is cleared when outermost block of current host is finished
+    or when :func:`~run` executes command, which can change anything on remote host.
+    Cached file is forgotten when it is changed by :func:`~create_file`, :func:`~remove_file` and similar functions.
+
+    Args:
+        *remote_filenames: Remote file names, must be absolute.
+        write_back: Defer writing of prefetched files and write them in one batch.
+
+    Example:
+
+    .. code-block:: python
+
+        with prefetch_files('/etc/ssh/sshd_config', '/etc/chrony.conf', write_back=True):
+            edit_file('/etc/ssh/sshd_config', replace_line(r'^#?UseDNS .*', 'UseDNS no'))
+            edit_file('/etc/chrony.conf', replace_line(r'^server .*', 'server ntp.example.com iburst'))
+    """
+    write_back = kwargs.pop('write_back', False)
+    for remote_filename in remote_filenames:
+        if not os.path.isabs(remote_filename):
+            fname = str(inspect.stack()[2][1])
+            nline = str(inspect.stack()[2][2])
+            abort('prefetch_files: remote filename must be absolute, "%s" given in file %s line %s' % (remote_filename, fname, nline))
+    _flush_batch()
+    scope = _prefetch_scope()
+    _prefetch_depths[scope] = _prefetch_depths.get(scope, 0) + 1
+    _content_caches.setdefault(scope, dict())
+    owns_write_back = write_back and scope not in _write_backs
+    try:
+        _fetch_files(remote_filenames)
+        if owns_write_back:
+            _write_backs[scope] = collections.OrderedDict()
+        yield
+        if owns_write_back:
+            _flush_writes()
+    finally:
+        if owns_write_back:
+            _write_backs.pop(scope, None)
+        _prefetch_depths[scope] -= 1
+        if _prefetch_depths[scope] == 0:
+            del _prefetch_depths[scope]
+            _content_caches.pop(scope, None)
+
+
+def _fetch_files(remote_filenames):
+    if not remote_filenames:
+        return
+    _flush_writes()
+    quoted_filenames = ' '.join([pipes.quote(remote_filename) for remote_filename in remote_filenames])
+    command = 'files=() ; for f in ' + quoted_filenames + ' ; do if [ -f "$f" ] ; then files+=("$f") ; fi ; done ; ' + \
+        'if [ ${#files[@]} -gt 0 ] ; then tar -czhf - -- "${files[@]}" 2> /dev/null | base64 ; fi'
+    with settings(warn_only=True), _keep_stat_cache():
+        stdout = run(command)
+    if stdout.failed:
+        abort('prefetch_files: downloading files from host %s failed' % env.host_string)
+    archive_content = base64.b64decode(''.join(stdout.split()))
+    if not archive_content:
+        return
+    content_cache = _content_cache()
+    archive = tarfile.open(fileobj=StringIO.StringIO(archive_content), mode='r:gz')
+    for member in archive:
+        if member.isfile():
+            content_cache[posixpath.normpath('/' + member.name)] = archive.extractfile(member).read()
+    archive.close()
+
+
+def _flush_writes():
+    pending_writes = _write_backs.get(_prefetch_scope())
+    if not pending_writes:
+        return
+    files = pending_writes.items()
+    pending_writes.clear()
+    content_cache = _content_cache()
+    cached_files = dict(content_cache)
+    uploads = [(index, remote_filename, content, list()) for index, (remote_filename, content) in enumerate(files)]
+    statuses = _install_files(uploads, list())
+    for index, (remote_filename, dummy_content) in enumerate(files):
+        _check_install_status('prefetch_files', remote_filename, statuses.get(index, ''))
+    # only pending files are written, so other prefetched files are still valid
+    content_cache.update(cached_files)
+
+
+_sftp_clients = dict()
+
+_sftp_locks = dict()
+
+_sftp_locks_lock = threading.Lock()
+
+
+def _sftp_lock(host_string):
+    with _sftp_locks_lock:
+        return _sftp_locks.setdefault(host_string, threading.RLock())
+
+
+def _sftp():
+    host_string = env.host_string
+    with _sftp_lock(host_string):
+        client = _sftp_clients.get(host_string)
+        if client is not None:
+            channel = client.get_channel()
+            if channel is None or channel.closed or not channel.get_transport().is_active():
+                _close_sftp_session(host_string)
+                client = None
+        if client is None:
+            client = connections[host_string].open_sftp()
+            _sftp_clients[host_string] = client
+        return client
+
+
+def _close_sftp_session(host_string):
+    with _sftp_lock(host_string):
+        client = _sftp_clients.pop(host_string, None)
+        if client is not None:
+            try:
+                client.close()
+            except (IOError, EOFError, paramiko.SSHException):
+                pass
+
+
+def _sftp_path(client, remote_path):
+    # resolve remote path in the same way as fabric.api.get() and fabric.api.put() do it
+    if remote_path.startswith('~'):
+        remote_path = remote_path.replace('~', client.normalize('.'), 1)
+    if not posixpath.isabs(remote_path):
+        if env.get('cwd'):
+            remote_path = env.cwd.rstrip('/') + '/' + remote_path
+        else:
+            remote_path = posixpath.join(client.normalize('.'), remote_path)
+    return remote_path
+
+
+def _disconnect(host_string):
+    _close_sftp_session(host_string)
+    _stat_caches.pop(host_string, None)
+    _memo_caches.pop(host_string, None)
+    for scope in _content_caches.keys():
+        if scope[0] == host_string:
+            _content_caches.pop(scope, None)
+    with _sftp_locks_lock:
+        _sftp_locks.pop(host_string, None)
+    if host_string in connections:
+        connections[host_string].close()
+        del connections[host_string]
+
+
+def _close_sftp_sessions():
+    for host_string in _sftp_clients.keys():
+        _close_sftp_session(host_string)
+
+
+atexit.register(_close_sftp_sessions)
+
+
+def _sftp_get(local_path, remote_path):
+    with _timed('get', 'transfer', remote_path) as counter:
+        try:
+            with _sftp_lock(env.host_string):
+                client = _sftp()
+                client.getfo(_sftp_path(client, remote_path), local_path)
+        except (IOError, OSError, EOFError, paramiko.SSHException):
+            return False
+        counter['bytes'] = local_path.tell()
+    return True
+
+
+def _sftp_put(local_path, remote_path):
+    local_path.seek(0, os.SEEK_END)
+    size = local_path.tell()
+    local_path.seek(0)
+    with _timed('put', 'transfer', remote_path) as counter:
+        try:
+            with _sftp_lock(env.host_string):
+                client = _sftp()
+                client.putfo(local_path, _sftp_path(client, remote_path))
+        except (IOError, OSError, EOFError, paramiko.SSHException):
+            return False
+        counter['bytes'] = size
+    return True
 
 
 def write_local_file(local_filename, content):
@@ -128,25 +938,55 @@ def write_local_file(local_filename, content):
         return True
 
 
-def write_file(remote_filename, content):
+def write_file(remote_filename, content, checksum=False):
     """Write remote file.
 
+    By default old content of remote file is downloaded and compared with new content.
+    If ``checksum`` is True - only ``sha256sum`` of remote file is compared with sha256 digest of new content,
+    so old content of remote file is not downloaded at all. This is much faster for large files.
+
     Args:
         remote_filename: Remote file name, must be absolute.
         content: text which should be written in file, must be string.
+        checksum: Compare sha256 digests of old and new content instead of downloading old content.
 
     Returns:
         True if content differs from old file content and file changed,
         False if old contend == new content and file not changed at all.
     """
+    if checksum and content is not None:
+        if _remote_sha256(remote_filename) == hashlib.sha256(_utf8(content)).hexdigest():
+            return False
+        _atomic_write_file(remote_filename, content)
+        return True
     old_content = read_file(remote_filename, abort_on_error=False)
     if content == old_content:  # pylint: disable=no-else-return
         return False
     else:
-        _atomic_write_file(remote_filename, content)
+        _atomic_write_file(remote_filename, content, old_content)
         return True
 
 
+def _utf8(content):
+    if isinstance(content, unicode):
+        return content.encode('utf-8')
+    return content
+
+
+def _remote_sha256(remote_filename):
+    if not os.path.isabs(remote_filename):
+        abort('remote filename must be absolute, "%s" given' % remote_filename)
+    _flush_writes()
+    if _stat_cache().lookup(remote_filename) in (None, 'directory', 'other'):
+        return None
+    quoted_filename = pipes.quote(remote_filename)
+    with settings(warn_only=True), _keep_stat_cache():
+        stdout = run('if [ -f ' + quoted_filename + ' ] ; then sha256sum < ' + quoted_filename + ' ; fi')
+    if stdout.failed or not stdout:
+        return None
+    return stdout.split()[0]
+
+
 def is_file_exists(remote_filename):
     """Is file exists?
 
@@ -160,7 +1000,7 @@ def is_file_exists(remote_filename):
         fname = str(inspect.stack()[1][1])
         nline = str(inspect.stack()[1][2])
         abort('remote filename must be absolute, "%s" given in file %s line %s' % (remote_filename, fname, nline))
-    exists = run('if [ -f ' + remote_filename + ' ] ; then echo exists ; fi') == 'exists'
+    exists = _deferred(_stat(remote_filename, 'is_file_exists'), lambda kind: kind == 'file')
     return exists
 
 
@@ -177,7 +1017,7 @@ def is_file_not_exists(remote_filename):
         fname = str(inspect.stack()[1][1])
         nline = str(inspect.stack()[1][2])
         abort('remote filename must be absolute, "%s" given in file %s line %s' % (remote_filename, fname, nline))
-    exists = run('if [ ! -f ' + remote_filename + ' ] ; then echo notexists ; fi') == 'notexists'
+    exists = _deferred(_stat(remote_filename, 'is_file_not_exists'), lambda kind: kind != 'file')
     return exists
 
 
@@ -194,7 +1034,7 @@ def is_directory_exists(remote_dirname):
         fname = str(inspect.stack()[1][1])
         nline = str(inspect.stack()[1][2])
         abort('remote dirname must be absolute, "%s" given in file %s line %s' % (remote_dirname, fname, nline))
-    exists = run('if [ -d ' + remote_dirname + ' ] ; then echo exists ; fi') == 'exists'
+    exists = _deferred(_stat(remote_dirname, 'is_directory_exists'), lambda kind: kind == 'directory')
     return exists
 
 
@@ -211,7 +1051,7 @@ def is_directory_not_exists(remote_dirname):
         fname = str(inspect.stack()[1][1])
         nline = str(inspect.stack()[1][2])
         abort('remote dirname must be absolute, "%s" given in file %s line %s' % (remote_dirname, fname, nline))
-    exists = run('if [ ! -d ' + remote_dirname + ' ] ; then echo notexists ; fi') == 'notexists'
+    exists = _deferred(_stat(remote_dirname, 'is_directory_not_exists'), lambda kind: kind != 'directory')
     return exists
 
 
@@ -226,7 +1066,11 @@ def remove_file(remote_filename):
     """
     if not os.path.isabs(remote_filename):
         abort('remote filename must be absolute, "%s" given' % remote_filename)
-    changed = run('if [ -f ' + remote_filename + ' ] ; then rm -f -- ' + remote_filename + ' ; echo removed ; fi') == 'removed'
+    kind = _stat_cache().lookup(remote_filename)
+    if kind is not _UNKNOWN and kind != 'file':
+        return _immediate(False)
+    command = 'if [ -f ' + remote_filename + ' ] ; then rm -f -- ' + remote_filename + ' ; echo removed ; fi'
+    changed = _mutate(remote_filename, command, 'removed', None, _UNKNOWN)
     return changed
 
 
@@ -244,7 +1088,11 @@ def remove_directory(remote_dirname):
     """
     if not os.path.isabs(remote_dirname):
         abort('remote directory name must be absolute, "%s" given' % remote_dirname)
-    changed = run('if [ -d ' + remote_dirname + ' ] ; then rmdir -- ' + remote_dirname + ' ; echo removed ; fi') == 'removed'
+    kind = _stat_cache().lookup(remote_dirname)
+    if kind is not _UNKNOWN and kind != 'directory':
+        return _immediate(False)
+    command = 'if [ -d ' + remote_dirname + ' ] ; then rmdir -- ' + remote_dirname + ' ; echo removed ; fi'
+    changed = _mutate(remote_dirname, command, 'removed', None, _UNKNOWN)
     return changed
 
 
@@ -262,7 +1110,11 @@ def create_file(remote_filename):
     """
     if not os.path.isabs(remote_filename):
         abort('remote file name must be absolute, "%s" given' % remote_filename)
-    changed = run('if [ ! -f ' + remote_filename + ' ] ; then touch -- ' + remote_filename + ' ; echo created ; fi') == 'created'
+    kind = _stat_cache().lookup(remote_filename)
+    if kind == 'file':
+        return _immediate(False)
+    command = 'if [ ! -f ' + remote_filename + ' ] ; then touch -- ' + remote_filename + ' ; echo created ; fi'
+    changed = _mutate(remote_filename, command, 'created', 'file' if kind is None else _UNKNOWN, 'file')
     return changed
 
 
@@ -280,7 +1132,11 @@ def create_directory(remote_dirname):
     """
     if not os.path.isabs(remote_dirname):
         abort('remote directory name must be absolute, "%s" given' % remote_dirname)
-    changed = run('if [ ! -d ' + remote_dirname + ' ] ; then mkdir -- ' + remote_dirname + ' ; echo created ; fi') == 'created'
+    kind = _stat_cache().lookup(remote_dirname)
+    if kind == 'directory':
+        return _immediate(False)
+    command = 'if [ ! -d ' + remote_dirname + ' ] ; then mkdir -- ' + remote_dirname + ' ; echo created ; fi'
+    changed = _mutate(remote_dirname, command, 'created', 'directory', 'directory')
     return changed
 
 
@@ -334,59 +1190,154 @@ def _copy_local_file_selinux_context(old_filename, new_filename):
                     local('chcon --reference=' + old_filename + ' -- ' + new_filename)
 
 
-def _atomic_write_file(remote_filename, content):
-    with settings(fabric.api.hide('everything')):
-        old_filename = remote_filename
-        if not os.path.isabs(old_filename):
-            abort('remote filename must be absolute, "%s" given' % old_filename)
-        exists = run('if [ -e ' + old_filename + ' ] ; then echo exists ; fi') == 'exists'
-        if exists:
-            if run('if [ ! -f ' + old_filename + ' ] ; then echo isnotfile ; fi') == 'isnotfile':
-                abort('remote filename must be regular file, "%s" given' % old_filename)
-            nlink = int(run('stat --format "%h" -- ' + old_filename))
-            if nlink > 1:
-                abort('file "%s" has %d hardlinks, it can\'t be atomically written' % (old_filename, nlink))
-        new_filename = old_filename + '.tmp.' + uuid.uuid4().hex + '.tmp'
-        file_like_object = StringIO.StringIO()
-        file_like_object.write(content)
-        with settings(warn_only=True):
-            if put(local_path=file_like_object, remote_path=new_filename).failed:
-                abort('uploading file ' + new_filename + ' to host %s failed' % env.host_string)
-        file_like_object.close()
-        if exists:
-            _copy_file_owner_and_mode(old_filename, new_filename)
-            _copy_file_acl(old_filename, new_filename)
-            _copy_file_xattr(old_filename, new_filename)
-            _copy_file_selinux_context(old_filename, new_filename)
-        run('mv -f -- ' + new_filename + ' ' + old_filename)
-
-
-def _copy_file_owner_and_mode(old_filename, new_filename):
-    with settings(warn_only=True):
-        run('chown --reference=' + old_filename + ' -- ' + new_filename)
-        run('chmod --reference=' + old_filename + ' -- ' + new_filename)
-
-
-def _copy_file_acl(old_filename, new_filename):
-    with settings(warn_only=True):
-        if run('if [ -e /usr/bin/getfacl ] && [ -e /usr/bin/setfacl ] ; then echo exists ; fi') == 'exists':
-            run('getfacl --absolute-names -- ' + old_filename + ' | setfacl --set-file=- -- ' + new_filename)
-
+_INLINE_CONTENT_LIMIT = 32 * 1024
 
-def _copy_file_xattr(old_filename, new_filename):
-    with settings(warn_only=True):
-        run('cp --attributes-only --preserve=xattr -- ' + old_filename + ' ' + new_filename)
+_DELTA_MAX_SEGMENTS = 256
 
 
-def _copy_file_selinux_context(old_filename, new_filename):
-    with settings(warn_only=True):
-        if run('if [ -e /usr/sbin/getenforce ] ; then echo exists ; fi') == 'exists':
-            if run('getenforce') != 'Disabled':
-                if run('if [ -e /usr/bin/chcon ] ; then echo exists ; fi') == 'exists':
-                    run('chcon --reference=' + old_filename + ' -- ' + new_filename)
-
+def _atomic_write_file(remote_filename, content, old_content=None):
+    old_filename = remote_filename
+    if not os.path.isabs(old_filename):
+        abort('remote filename must be absolute, "%s" given' % old_filename)
+    normalized_filename = posixpath.normpath(remote_filename)
+    content_cache = _content_cache()
+    pending_writes = _write_backs.get(_prefetch_scope())
+    if pending_writes is not None and normalized_filename in content_cache:
+        pending_writes[normalized_filename] = content
+        content_cache[normalized_filename] = content
+        _stat_cache().store(normalized_filename, 'file')
+        return
+    _flush_batch()
+    new_filename = old_filename + '.tmp.' + uuid.uuid4().hex + '.tmp'
+    upload_command = None
+    delta = False
+    if len(content) <= _INLINE_CONTENT_LIMIT:
+        upload_command = "printf '%s' '" + base64.b64encode(_utf8(content)) + "' | base64 --decode > " + pipes.quote(new_filename)
+    elif old_content is not None:
+        upload_command = _delta_upload_command(old_filename, new_filename, old_content, content)
+        delta = upload_command is not None
+    if upload_command is None:
+        file_like_object = StringIO.StringIO()
+        file_like_object.write(content)
+        if not _sftp_put(local_path=file_like_object, remote_path=new_filename):
+            abort('uploading file ' + new_filename + ' to host %s failed' % env.host_string)
+        file_like_object.close()
+    script = _atomic_write_script(old_filename, new_filename, upload_command)
+    _memo_cache().clear()
+    with settings(warn_only=True), _keep_stat_cache(), _command_class('mutation'):
+        stdout = run(script)
+    status = stdout.strip().split('\n')[-1].strip()
+    if status == 'isnotfile':
+        abort('remote filename must be regular file, "%s" given' % old_filename)
+    elif status.startswith('hardlinks '):
+        nlink = int(status.split()[1])
+        abort('file "%s" has %d hardlinks, it can\'t be atomically written' % (old_filename, nlink))
+    elif status == 'uploadfailed' and delta:
+        # remote file changed after old content was read, so delta is not applicable
+        _atomic_write_file(remote_filename, content)
+        return
+    elif status == 'uploadfailed':
+        abort('uploading file ' + new_filename + ' to host %s failed' % env.host_string)
+    elif status != 'written':
+        abort('moving file %s to %s on host %s failed' % (new_filename, old_filename, env.host_string))
+    _stat_cache().store(old_filename, 'file')
+    if normalized_filename in content_cache:
+        content_cache[normalized_filename] = content
+
+
+def _delta_segments(old_content, new_content):
+    old_lines = old_content.splitlines(True)
+    new_lines = new_content.splitlines(True)
+    offsets = [0]
+    for line in old_lines:
+        offsets.append(offsets[-1] + len(line))
+    limit = min(len(old_lines), len(new_lines))
+    prefix = 0
+    while prefix < limit and old_lines[prefix] == new_lines[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and old_lines[-1 - suffix] == new_lines[-1 - suffix]:
+        suffix += 1
+    segments = list()
+
+    def copy(begin, end):
+        if begin == end:
+            return
+        if segments and segments[-1][0] == 'copy' and segments[-1][1] + segments[-1][2] == offsets[begin]:
+            segments[-1] = ('copy', segments[-1][1], offsets[end] - segments[-1][1])
+        else:
+            segments.append(('copy', offsets[begin], offsets[end] - offsets[begin]))
+
+    def literal(begin, end):
+        if begin == end:
+            return
+        text = ''.join(new_lines[begin:end])
+        if segments and segments[-1][0] == 'literal':
+            segments[-1] = ('literal', segments[-1][1] + text)
+        else:
+            segments.append(('literal', text))
 
-def copy_file(local_filename, remote_filename):
+    copy(0, prefix)
+    matcher = difflib.SequenceMatcher(None, old_lines[prefix:len(old_lines) - suffix], new_lines[prefix:len(new_lines) - suffix])
+    for tag, old_begin, old_end, new_begin, new_end in matcher.get_opcodes():
+        if tag == 'equal':
+            copy(prefix + old_begin, prefix + old_end)
+        else:
+            literal(prefix + new_begin, prefix + new_end)
+    copy(len(old_lines) - suffix, len(old_lines))
+    return segments
+
+
+def _delta_upload_command(old_filename, new_filename, old_content, new_content):
+    old_content, new_content = _utf8(old_content), _utf8(new_content)
+    segments = _delta_segments(old_content, new_content)
+    if len(segments) > _DELTA_MAX_SEGMENTS:
+        return None
+    if sum([len(segment[1]) for segment in segments if segment[0] == 'literal']) > _INLINE_CONTENT_LIMIT * 3 / 4:
+        return None
+    commands = list()
+    for segment in segments:
+        if segment[0] == 'copy':
+            commands.append('tail -c +%d -- %s | head -c %d' % (segment[1] + 1, pipes.quote(old_filename), segment[2]))
+        else:
+            commands.append("printf '%s' '" + base64.b64encode(segment[1]) + "' | base64 --decode")
+    digest = hashlib.sha256(new_content).hexdigest()
+    return '{ ' + ' ; '.join(commands) + ' ; } > ' + pipes.quote(new_filename) + \
+        ' && [ "$(sha256sum < ' + pipes.quote(new_filename) + ')" = "' + digest + '  -" ]'
+
+
+def _atomic_write_script(old_filename, new_filename, upload_command, extra_commands=None):
+    old_filename = pipes.quote(old_filename)
+    new_filename = pipes.quote(new_filename)
+    script = list()
+    script.append('exists=0')
+    script.append('if [ -e ' + old_filename + ' ] ; then')
+    script.append('  if [ ! -f ' + old_filename + ' ] ; then rm -f -- ' + new_filename + ' ; echo isnotfile ; exit 0 ; fi')
+    script.append('  nlink=$(stat --format "%h" -- ' + old_filename + ')')
+    script.append('  if [ "$nlink" -gt 1 ] ; then rm -f -- ' + new_filename + ' ; echo "hardlinks $nlink" ; exit 0 ; fi')
+    script.append('  exists=1')
+    script.append('fi')
+    if upload_command is not None:
+        script.append(upload_command + ' || { rm -f -- ' + new_filename + ' ; echo uploadfailed ; exit 0 ; }')
+    script.append('if [ ! -f ' + new_filename + ' ] ; then echo uploadfailed ; exit 0 ; fi')
+    script.append('if [ $exists -eq 1 ] ; then')
+    script.append('  chown --reference=' + old_filename + ' -- ' + new_filename)
+    script.append('  chmod --reference=' + old_filename + ' -- ' + new_filename)
+    script.append('  if [ -e /usr/bin/getfacl ] && [ -e /usr/bin/setfacl ] ; then')
+    script.append('    getfacl --absolute-names -- ' + old_filename + ' | setfacl --set-file=- -- ' + new_filename)
+    script.append('  fi')
+    script.append('  cp --attributes-only --preserve=xattr -- ' + old_filename + ' ' + new_filename)
+    script.append('  if [ -e /usr/sbin/getenforce ] && [ -e /usr/bin/chcon ] && [ "$(getenforce)" != "Disabled" ] ; then')
+    script.append('    chcon --reference=' + old_filename + ' -- ' + new_filename)
+    script.append('  fi')
+    script.append('fi > /dev/null 2>&1')
+    if extra_commands:
+        script.extend(extra_commands)
+    script.append('mv -f -- ' + new_filename + ' ' + old_filename + ' && echo written')
+    return '\n'.join(script)
+
+
+def copy_file(local_filename, remote_filename, checksum=False):
     """Copy file from ``local_filename`` on local host to ``remote_filename`` on remote host.
 
     If ``local_filename`` is relative it will be retrieved from directory ``files`` alongside with ``env.real_fabfile``.
@@ -397,6 +1348,8 @@ def copy_file(local_filename, remote_filename):
     Args:
         local_filename: Local file name on local host, copy file from it. Should be relative.
         remote_filename: Remote file name on remote host, copy file to it. Must be absolute.
+        checksum: Compare sha256 digests of local and remote files instead of downloading remote file,
+            see :func:`~write_file`.
 
     Returns:
         True if remote file changed, False otherwise.
@@ -412,11 +1365,241 @@ def copy_file(local_filename, remote_filename):
         nline = str(inspect.stack()[1][2])
         abort('copy_file: file \'%s\' not exists in file %s line %s' % (local_abs_filename, fname, nline))
     content = read_local_file(local_abs_filename)
-    changed = write_file(remote_filename, content)
+    changed = write_file(remote_filename, content, checksum=checksum)
     return changed
 
 
-def rsync(local_path, remote_path, extra_rsync_options=""):  # pylint: disable=too-many-locals
+def sync_files(manifest):  # pylint: disable=too-many-locals,too-many-branches,too-many-statements
+    """Sync many files from local host to remote host in few round trips.
+
+    All remote sha256 digests, modes and owners are compared in one remote command,
+    then only changed files are sent as one compressed tar stream and atomically installed in second remote command.
+
+    If ``local_filename`` is relative it will be retrieved from directory ``files`` alongside with ``env.real_fabfile``.
+
+    Args:
+        manifest: list of tuples ``(local_filename, remote_filename, mode, owner)``.
+            ``mode`` and ``owner`` are optional and can be None, ``mode`` is octal number or string of octal digits,
+            like ``'0644'``, symbolic modes, like ``'u+x'``, are not supported, ``owner`` is string ``'user'`` or ``'user:group'``.
+
+    Returns:
+        dict, which maps each ``remote_filename`` to True if remote file changed, False otherwise.
+    """
+    files_dir = os.path.join(os.path.dirname(env.real_fabfile), 'files')
+    entries = list()
+    for entry in manifest:
+        if not isinstance(entry, (tuple, list)) or not 2 <= len(entry) <= 4:
+            fname = str(inspect.stack()[1][1])
+            nline = str(inspect.stack()[1][2])
+            abort('sync_files: bad manifest entry %s in file %s line %s' % (repr(entry), fname, nline))
+        local_filename, remote_filename, mode, owner = (tuple(entry) + (None, None))[:4]
+        local_abs_filename = os.path.join(files_dir, local_filename)
+        if not os.path.isfile(local_abs_filename):
+            fname = str(inspect.stack()[1][1])
+            nline = str(inspect.stack()[1][2])
+            abort('sync_files: file \'%s\' not exists in file %s line %s' % (local_abs_filename, fname, nline))
+        if not os.path.isabs(remote_filename):
+            fname = str(inspect.stack()[1][1])
+            nline = str(inspect.stack()[1][2])
+            abort('sync_files: remote path \'%s\' must be absolute in file %s line %s' % (remote_filename, fname, nline))
+        if isinstance(mode, numbers.Number):
+            mode = '%o' % mode
+        elif mode is not None:
+            if not re.match(r'^[0-7]{1,4}$', mode.strip()):
+                fname = str(inspect.stack()[1][1])
+                nline = str(inspect.stack()[1][2])
+                abort('sync_files: mode \'%s\' must be octal in file %s line %s' % (mode, fname, nline))
+            mode = '%o' % int(mode, 8)
+        if owner is not None:
+            owner = owner.strip()
+        content = read_local_file(local_abs_filename)
+        entries.append((remote_filename, content, mode, owner))
+    changed = dict()
+    if not entries:
+        return changed
+    _flush_batch()
+    _flush_writes()
+    query = list()
+    for remote_filename, dummy_content, dummy_mode, dummy_owner in entries:
+        quoted_filename = pipes.quote(remote_filename)
+        query.append('if [ -f ' + quoted_filename + ' ] ; then ' +
+                     'echo "$(sha256sum < ' + quoted_filename + ' | cut -d " " -f 1) $(stat --format "%a %U:%G %u:%g" -- ' + quoted_filename + ')" ; ' +
+                     'elif [ -e ' + quoted_filename + ' ] ; then echo isnotfile ; else echo missing ; fi')
+    with settings(warn_only=True), _keep_stat_cache():
+        stdout = run(' ; '.join(query))
+    states = stdout.strip().split('\n')
+    if stdout.failed or len(states) != len(entries):
+        abort('sync_files: can\'t get state of remote files on host %s' % env.host_string)
+    uploads = list()
+    script = list()
+    for index, (remote_filename, content, mode, owner) in enumerate(entries):
+        state = states[index].strip().split()
+        if state == ['isnotfile']:
+            abort('remote filename must be regular file, "%s" given' % remote_filename)
+        metadata_commands = list()
+        if owner is not None and (state == ['missing'] or not _is_same_owner(owner, state[2], state[3])):
+            metadata_commands.append('chown ' + pipes.quote(owner) + ' -- %(filename)s')
+        if mode is not None and (state == ['missing'] or mode != state[1]):
+            metadata_commands.append('chmod ' + mode + ' -- %(filename)s')
+        if state == ['missing'] or state[0] != hashlib.sha256(_utf8(content)).hexdigest():
+            uploads.append((index, remote_filename, content, metadata_commands))
+        elif metadata_commands:
+            quoted_filename = pipes.quote(remote_filename)
+            script.append('status=written ; ' + ' ; '.join([command % {'filename': quoted_filename} + ' || status=chfailed'
+                                                            for command in metadata_commands]) + ' ; echo "%d $status"' % index)
+        else:
+            changed[remote_filename] = False
+    if not uploads and not script:
+        return changed
+    statuses = _install_files(uploads, script)
+    for index, (remote_filename, dummy_content, dummy_mode, dummy_owner) in enumerate(entries):
+        if remote_filename in changed:
+            continue
+        _check_install_status('sync_files', remote_filename, statuses.get(index, ''))
+        changed[remote_filename] = True
+    return changed
+
+
+def _is_same_owner(owner, names, ids):
+    # owner is 'user' or 'user:group', each part can be name or numeric id
+    for expected, name, numeric_id in zip(owner.split(':'), names.split(':'), ids.split(':')):
+        if expected != (numeric_id if expected.isdigit() else name):
+            return False
+    return True
+
+
+def _install_files(uploads, script):
+    """Upload files as one gzipped tar stream and install them atomically in one remote command.
+
+    Args:
+        uploads: list of tuples ``(index, remote_filename, content, metadata_commands)``,
+            each of metadata commands is applied to ``%(filename)s`` before file is installed.
+        script: list of additional shell commands, each of them should print line ``index status``.
+
+    Returns:
+        dict, which maps index to status of its file.
+    """
+    archive_filename = '/tmp/fabrix.' + uuid.uuid4().hex + '.tar.gz'
+    quoted_archive_filename = pipes.quote(archive_filename)
+    prologue = list()
+    prologue.append('tmpdir=$(mktemp -d)')
+    prologue.append('trap \'rm -rf -- "$tmpdir" ' + quoted_archive_filename + '\' EXIT')
+    script = list(script)
+    if uploads:
+        file_like_object = StringIO.StringIO()
+        archive = tarfile.open(fileobj=file_like_object, mode='w:gz')
+        for index, remote_filename, content, metadata_commands in uploads:
+            content = _utf8(content)
+            info = tarfile.TarInfo(str(index))
+            info.size = len(content)
+            archive.addfile(info, StringIO.StringIO(content))
+            new_filename = remote_filename + '.tmp.' + uuid.uuid4().hex + '.tmp'
+            quoted_new_filename = pipes.quote(new_filename)
+            upload_command = 'cat -- "$tmpdir"/%d > %s' % (index, quoted_new_filename)
+            extra_commands = [command % {'filename': quoted_new_filename} + ' || { rm -f -- ' + quoted_new_filename + ' ; echo chfailed ; exit 0 ; }'
+                              for command in metadata_commands]
+            install_script = _atomic_write_script(remote_filename, new_filename, upload_command, extra_commands)
+            script.append('status=$(' + install_script + '\n) ; echo "%d $status"' % index)
+        archive.close()
+        archive_content = file_like_object.getvalue()
+        if len(archive_content) <= _INLINE_CONTENT_LIMIT:
+            prologue.append("printf '%s' '" + base64.b64encode(archive_content) + "' | base64 --decode > " + quoted_archive_filename)
+        else:
+            file_like_object.seek(0)
+            if not _sftp_put(local_path=file_like_object, remote_path=archive_filename):
+                abort('uploading file ' + archive_filename + ' to host %s failed' % env.host_string)
+        file_like_object.close()
+        prologue.append('tar -xzf ' + quoted_archive_filename + ' -C "$tmpdir" > /dev/null 2>&1 || rm -rf -- "$tmpdir"/*')
+    _memo_cache().clear()
+    _content_cache().clear()
+    with settings(warn_only=True), _keep_stat_cache(), _command_class('mutation'):
+        stdout = run('\n'.join(prologue + script))
+    statuses = dict()
+    for line in stdout.strip().split('\n'):
+        fields = line.strip().split(' ', 1)
+        if len(fields) == 2 and fields[0].isdigit():
+            statuses[int(fields[0])] = fields[1].strip()
+    return statuses
+
+
+def _check_install_status(caller, remote_filename, status):
+    if status == 'isnotfile':
+        abort('remote filename must be regular file, "%s" given' % remote_filename)
+    elif status.startswith('hardlinks '):
+        nlink = int(status.split()[1])
+        abort('file "%s" has %d hardlinks, it can\'t be atomically written' % (remote_filename, nlink))
+    elif status == 'uploadfailed':
+        abort('uploading file ' + remote_filename + ' to host %s failed' % env.host_string)
+    elif status == 'chfailed':
+        abort('%s: changing owner or mode of file %s on host %s failed' % (caller, remote_filename, env.host_string))
+    elif status != 'written':
+        abort('%s: installing file %s on host %s failed' % (caller, remote_filename, env.host_string))
+    _stat_cache().store(remote_filename, 'file')
+
+
+class RsyncResult(object):
+    """Result of :func:`~rsync`, parsed from ``rsync --stats`` output.
+
+    ``RsyncResult`` object can be used in boolean context, in this case it is True if some files are changed.
+
+    Attributes:
+        local_path: Absolute local path, files/directories are copied from it.
+        remote_path: Remote path, files/directories are copied to it.
+        changed: True if some of remote files/directories are changed, False otherwise.
+        files_transferred: Number of regular files transferred.
+        total_transferred_file_size: Total size of transferred files in bytes.
+        literal_data: Number of bytes of unmatched data, which are sent to remote host.
+        matched_data: Number of bytes of data, which are matched with data already existing on remote host.
+        bytes_sent: Total number of bytes sent by rsync over network.
+        bytes_received: Total number of bytes received by rsync from network.
+        elapsed: Wall clock time of rsync in seconds.
+    """
+
+    def __init__(self, local_path, remote_path, stdout, elapsed):
+        self.local_path = local_path
+        self.remote_path = remote_path
+        self.elapsed = elapsed
+        self.files_transferred = 0
+        self.total_transferred_file_size = 0
+        self.literal_data = 0
+        self.matched_data = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        changed = None
+        for line in stdout.split('\n'):
+            if ':' not in line:
+                continue
+            key, value = line.split(':', 1)
+            key = key.strip()
+            match = re.match(r'^\s*([\d,]+)', value)
+            if key not in _RSYNC_STATS or match is None:
+                continue
+            setattr(self, _RSYNC_STATS[key], int(match.group(1).replace(',', '')))
+            if key == 'Total transferred file size':
+                changed = self.total_transferred_file_size != 0
+        self.changed = changed is not False
+
+    def __nonzero__(self):
+        return self.changed
+
+    def __repr__(self):
+        return '<RsyncResult %s -> %s changed=%s files=%d sent=%d received=%d literal=%d matched=%d elapsed=%.3f>' % (
+            self.local_path, self.remote_path, self.changed, self.files_transferred, self.bytes_sent, self.bytes_received,
+            self.literal_data, self.matched_data, self.elapsed)
+
+
+_RSYNC_STATS = {
+    'Number of files transferred': 'files_transferred',
+    'Number of regular files transferred': 'files_transferred',
+    'Total transferred file size': 'total_transferred_file_size',
+    'Literal data': 'literal_data',
+    'Matched data': 'matched_data',
+    'Total bytes sent': 'bytes_sent',
+    'Total bytes received': 'bytes_received',
+}
+
+
+def rsync(local_path, remote_path, extra_rsync_options="", stats=False):
     """Rsync files/directories from local path to remote_path.
 
     .. note::
@@ -426,34 +1609,101 @@ def rsync(local_path, remote_path, extra_rsync_options=""):  # pylint: disable=t
         local_path: Local path on local host, copy files/directories from it. Should be relative.
         remote_path: Remote path on remote host, copy files/directories to it. Must be absolute.
         extra_rsync_options: Additional rsync options added after default '-aH --stats --force --timeout=600'
+        stats: Return :class:`~RsyncResult` with transfer statistics instead of boolean.
 
     Returns:
         True if some of remote files/directories are changed, False otherwise.
+        If ``stats`` is True - :class:`~RsyncResult` object.
     """
-    files_dir = os.path.join(os.path.dirname(env.real_fabfile), 'files')
-    if not os.path.isdir(files_dir):
+    command, local_abs_path = _rsync_command('rsync', local_path, remote_path, extra_rsync_options)
+    _flush_batch()
+    _flush_writes()
+    _stat_cache().clear()
+    _memo_cache().clear()
+    _content_cache().clear()
+    start = time.time()
+    with settings(fabric.api.hide('everything')):
+        stdout = local(command, capture=True)
+    result = RsyncResult(local_abs_path, remote_path, stdout, time.time() - start)
+    _record('rsync', 'transfer', command, start, result.elapsed, (result.bytes_sent or 0) + (result.bytes_received or 0))
+    if stats:
+        return result
+    return result.changed
+
+
+def rsync_parallel(paths, max_processes=4, extra_rsync_options=""):  # pylint: disable=too-many-locals
+    """Rsync many local paths to remote paths concurrently.
+
+    Not more than ``max_processes`` rsync processes are running at the same time.
+
+    Args:
+        paths: list of tuples ``(local_path, remote_path)``, see :func:`~rsync`.
+        max_processes: Maximum number of concurrently running rsync processes.
+        extra_rsync_options: Additional rsync options, see :func:`~rsync`.
+
+    Returns:
+        list of :class:`~RsyncResult` objects, in the same order as ``paths``.
+    """
+    if max_processes < 1:
         fname = str(inspect.stack()[1][1])
         nline = str(inspect.stack()[1][2])
-        abort('rsync: files dir \'%s\' not exists in file %s line %s' % (files_dir, fname, nline))
+        abort('rsync_parallel: max_processes must be positive, %s given in file %s line %s' % (max_processes, fname, nline))
+    commands = list()
+    for local_path, remote_path in paths:
+        commands.append(_rsync_command('rsync_parallel', local_path, remote_path, extra_rsync_options))
+    _flush_batch()
+    _flush_writes()
+    _stat_cache().clear()
+    _memo_cache().clear()
+    _content_cache().clear()
+    results = [None] * len(commands)
+    pending = list(enumerate(commands))
+    running = list()
+    while pending or running:
+        while pending and len(running) < max_processes:
+            index, (command, dummy_local_abs_path) = pending.pop(0)
+            output = tempfile.TemporaryFile()
+            process = subprocess.Popen(command, shell=True, stdout=output, stderr=subprocess.STDOUT)
+            running.append((index, process, output, time.time()))
+        time.sleep(0.05)
+        for item in running[:]:
+            index, process, output, start = item
+            if process.poll() is None:
+                continue
+            running.remove(item)
+            output.seek(0)
+            stdout = output.read()
+            output.close()
+            command, local_abs_path = commands[index]
+            if process.returncode != 0:
+                for dummy_index, other_process, other_output, dummy_start in running:
+                    other_process.wait()
+                    other_output.close()
+                abort('rsync_parallel: command \'%s\' received nonzero return code %d:\n%s' % (command, process.returncode, stdout))
+            result = RsyncResult(local_abs_path, paths[index][1], stdout, time.time() - start)
+            _record('rsync', 'transfer', command, start, result.elapsed, (result.bytes_sent or 0) + (result.bytes_received or 0))
+            results[index] = result
+    return results
+
+
+def _rsync_command(caller, local_path, remote_path, extra_rsync_options):
+    files_dir = os.path.join(os.path.dirname(env.real_fabfile), 'files')
+    if not os.path.isdir(files_dir):
+        fname = str(inspect.stack()[2][1])
+        nline = str(inspect.stack()[2][2])
+        abort('%s: files dir \'%s\' not exists in file %s line %s' % (caller, files_dir, fname, nline))
     local_abs_path = os.path.join(files_dir, local_path)
     if not os.path.exists(local_abs_path):
-        fname = str(inspect.stack()[1][1])
-        nline = str(inspect.stack()[1][2])
-        abort('rsync: local path \'%s\' not exists in file %s line %s' % (local_abs_path, fname, nline))
+        fname = str(inspect.stack()[2][1])
+        nline = str(inspect.stack()[2][2])
+        abort('%s: local path \'%s\' not exists in file %s line %s' % (caller, local_abs_path, fname, nline))
     if not os.path.isabs(remote_path):
-        fname = str(inspect.stack()[1][1])
-        nline = str(inspect.stack()[1][2])
-        abort('rsync: remote path \'%s\' must be absolute in file %s line %s' % (remote_path, fname, nline))
-    # ssh keys
-    ssh_keys = ""
-    keys = key_filenames()
-    if keys:
-        ssh_keys = " -i " + " -i ".join(keys)
-    # ssh port
-    user, host, port = normalize(env.host_string)
-    ssh_port = "-p %s" % port
+        fname = str(inspect.stack()[2][1])
+        nline = str(inspect.stack()[2][2])
+        abort('%s: remote path \'%s\' must be absolute in file %s line %s' % (caller, remote_path, fname, nline))
+    user, host, dummy_port = normalize(env.host_string)
     # ssh options
-    ssh_options = "-e 'ssh %s%s'" % (ssh_port, ssh_keys)
+    ssh_options = "-e '%s'" % _ssh_command()
     # rsync options
     rsync_options = '-aH --stats --force --timeout=600 %s %s --' % (ssh_options, extra_rsync_options)
     # remote_prefix
@@ -463,18 +1713,54 @@ def rsync(local_path, remote_path, extra_rsync_options=""):  # pylint: disable=t
         remote_prefix = "%s@[%s]" % (user, host)
     else:
         remote_prefix = "%s@%s" % (user, host)
-    # execute command
     command = "rsync %s %s %s:%s" % (rsync_options, local_abs_path, remote_prefix, remote_path)
-    with settings(fabric.api.hide('everything')):
-        stdout = local(command, capture=True)
-    zero_transfer_regexp = re.compile(r'^Total transferred file size: 0 bytes$')
-    changed = True
-    for line in stdout.split('\n'):
-        line = line.strip()
-        if zero_transfer_regexp.match(line):
-            changed = False
-            break
-    return changed
+    return command, local_abs_path
+
+
+_ssh_control_dir = os.path.join(tempfile.gettempdir(), 'fabrix-ssh-%d' % os.getpid())
+
+_ssh_control_masters = set()
+
+
+def _ssh_command():
+    """Build command line for local ssh, which shares one multiplexed master connection per host.
+
+    Master connection is created lazily by first ssh process and closed at exit.
+    """
+    try:
+        os.makedirs(_ssh_control_dir, 0700)
+    except OSError as ex:
+        if ex.errno != errno.EEXIST:
+            raise
+        control_dir_stat = os.lstat(_ssh_control_dir)
+        if not stat.S_ISDIR(control_dir_stat.st_mode) or control_dir_stat.st_uid != os.getuid():
+            abort('ssh control directory %s is not a directory owned by current user' % _ssh_control_dir)
+    user, host, port = normalize(env.host_string)
+    _ssh_control_masters.add((user, host, port))
+    command = "ssh -p %s" % port
+    keys = key_filenames()
+    if keys:
+        command += " -i " + " -i ".join(keys)
+    command += " -o ControlMaster=auto -o ControlPath=%s/%%C -o ControlPersist=600" % _ssh_control_dir
+    return command
+
+
+def _close_ssh_masters():
+    if not _ssh_control_masters:
+        return
+    with open(os.devnull, 'w') as devnull:
+        for user, host, port in _ssh_control_masters:
+            control_path = os.path.join(_ssh_control_dir, '%C')
+            try:
+                subprocess.call(['ssh', '-p', str(port), '-o', 'ControlPath=' + control_path, '-O', 'exit', user + '@' + host],
+                                stdout=devnull, stderr=devnull)
+            except OSError:
+                pass
+    _ssh_control_masters.clear()
+    shutil.rmtree(_ssh_control_dir, ignore_errors=True)
+
+
+atexit.register(_close_ssh_masters)
 
 
 def chown(remote_filename, owner, group):
@@ -493,7 +1779,7 @@ def chown(remote_filename, owner, group):
         nline = str(inspect.stack()[1][2])
         abort('chown: remote path \'%s\' must be absolute in file %s line %s' % (remote_filename, fname, nline))
     stdout = run('chown --changes ' + owner.strip() + ':' + group.strip() + ' -- ' + remote_filename)
-    changed = stdout != ""
+    changed = _deferred(stdout, lambda out: out != "")
     return changed
 
 
@@ -518,5 +1804,5 @@ def chmod(remote_filename, mode):
     if isinstance(mode, numbers.Number):
         mode = oct(mode)
     stdout = run('chmod --changes ' + mode + ' -- ' + remote_filename)
-    changed = stdout != ""
+    changed = _deferred(stdout, lambda out: out != "")
     return changed
@@ -0,0 +1,264 @@
+import sys
+import inspect
+import functools
+import threading
+import Queue
+from fabric.api import env, abort
+from fabrix.context import host_context, _snapshot, _restore_context
+from fabrix.ioutil import _disconnect
+
+
+_DEFAULT_WORKERS = 10
+
+_DEFAULT_MAX_UNAVAILABLE = 10
+
+
+class ParallelResult(object):
+    """Result of :func:`~execute_parallel`.
+
+    Attributes:
+        results: dict, which maps host string to value returned by task on this host.
+        failures: dict, which maps host string to exception raised by task on this host.
+            :func:`~fabric.api.abort` raises :class:`~exceptions.SystemExit`, it is also collected here.
+    """
+
+    def __init__(self):
+        self.results = dict()
+        self.failures = dict()
+
+    def __repr__(self):
+        return '<ParallelResult results=%d failures=%d>' % (len(self.results), len(self.failures))
+
+
+def _role_hosts(roles):
+    role_hosts = dict()
+    for role in sorted(env.roledefs):
+        if roles is not None and role not in roles:
+            continue
+        hosts = env.roledefs[role]
+        if callable(hosts):
+            hosts = hosts()
+        if isinstance(hosts, dict):
+            hosts = hosts.get('hosts', list())
+        role_hosts[role] = list(hosts)
+    if roles is None and env.hosts:
+        role_hosts[None] = list(env.hosts)
+    return role_hosts
+
+
+def _inventory():
+    role_hosts = _role_hosts(None)
+    hosts = list()
+    seen = set()
+    for role in [None] + sorted([role for role in role_hosts if role is not None]):
+        for host in role_hosts.get(role, list()):
+            if host not in seen:
+                seen.add(host)
+                hosts.append(host)
+    return hosts
+
+
+def execute_parallel(task, *args, **kwargs):  # pylint: disable=too-many-locals
+    """Execute task on many hosts in parallel, in one process, by bounded pool of worker threads.
+
+    Each worker thread has own host context, see :func:`~fabrix.context.host_context`,
+    so all fabrix functions and :obj:`~fabrix.config.conf` work inside task as usual.
+    Worker threads start with Fabric settings of caller, for example, ``warn_only`` or ``cd()`` directory.
+
+    Connection to host is closed after task is finished on it, so number of open connections is bounded by number of workers.
+
+    Args:
+        task: function, which should be executed on each host.
+        *args: positional arguments of task.
+        **kwargs: keyword arguments of task, except special keyword arguments:
+
+            - ``hosts``: list of hosts, if not given - all hosts from ``env.hosts`` and ``env.roledefs``,
+              as they are defined by :func:`~fabrix.config.read_config`, are used.
+            - ``workers``: number of worker threads, default is ``env.pool_size`` if it is set, else 10.
+
+            These names are reserved, keyword arguments with these names are never passed to task.
+
+    Returns:
+        :class:`~ParallelResult` object with per-host results and failures.
+    """
+    hosts = kwargs.pop('hosts', None)
+    workers = kwargs.pop('workers', None)
+    if hosts is None:
+        hosts = _inventory()
+    if workers is None:
+        workers = env.pool_size or _DEFAULT_WORKERS
+    if workers < 1:
+        fname = str(inspect.stack()[1][1])
+        nline = str(inspect.stack()[1][2])
+        abort('execute_parallel: workers must be positive, %s given in file %s line %s' % (workers, fname, nline))
+    context = _snapshot()
+    result = ParallelResult()
+    lock = threading.Lock()
+    queue = Queue.Queue()
+    for host in hosts:
+        queue.put(host)
+
+    def worker():
+        while True:
+            try:
+                host = queue.get_nowait()
+            except Queue.Empty:
+                return
+            with _restore_context(context), host_context(host):
+                try:
+                    value = task(*args, **kwargs)
+                except (SystemExit, Exception):  # pylint: disable=broad-except
+                    exception = sys.exc_info()[1]
+                    with lock:
+                        result.failures[host] = exception
+                else:
+                    with lock:
+                        result.results[host] = value
+                finally:
+                    _disconnect(host)
+
+    threads = list()
+    for dummy_index in range(min(workers, len(hosts))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(0.1)
+    return result
+
+
+class RollingResult(ParallelResult):
+    """Result of :func:`~execute_rolling`.
+
+    Attributes:
+        results: dict, which maps host string to value returned by task on this host.
+        failures: dict, which maps host string to exception raised by task on this host.
+        waves: list of waves, each wave is list of host strings, in order of execution.
+        skipped: list of hosts, on which task was not executed, because deployment was stopped.
+    """
+
+    def __init__(self):
+        super(RollingResult, self).__init__()
+        self.waves = list()
+        self.skipped = list()
+
+    def __repr__(self):
+        return '<RollingResult results=%d failures=%d waves=%d skipped=%d>' % (
+            len(self.results), len(self.failures), len(self.waves), len(self.skipped))
+
+
+def _role_limit(role, count, wave_size, max_unavailable):
+    if isinstance(wave_size, dict):
+        wave_size = wave_size.get(role)
+    if isinstance(max_unavailable, dict):
+        max_unavailable = max_unavailable.get(role)
+    if wave_size is not None:
+        return max(1, int(wave_size))
+    if max_unavailable is None:
+        max_unavailable = _DEFAULT_MAX_UNAVAILABLE
+    if isinstance(max_unavailable, basestring):
+        max_unavailable = float(max_unavailable.strip().rstrip('%'))
+    return max(1, int(count * max_unavailable / 100.0))
+
+
+def _host_roles(role_hosts):
+    hosts = list()
+    host_roles = dict()
+    for role in sorted(role_hosts):
+        for host in role_hosts[role]:
+            if host not in host_roles:
+                host_roles[host] = list()
+                hosts.append(host)
+            host_roles[host].append(role)
+    return hosts, host_roles
+
+
+def _next_wave(hosts, host_roles, budgets):
+    wave = list()
+    counts = dict.fromkeys(budgets, 0)
+    remaining = list()
+    for host in hosts:
+        if all([counts[role] < budgets[role] for role in host_roles[host]]):
+            wave.append(host)
+            for role in host_roles[host]:
+                counts[role] += 1
+        else:
+            remaining.append(host)
+    return wave, remaining
+
+
+def execute_rolling(task, *args, **kwargs):  # pylint: disable=too-many-locals
+    """Execute task on hosts of roles in rolling waves.
+
+    Hosts are taken from ``env.roledefs`` and ``env.hosts``, as they are defined by :func:`~fabrix.config.read_config`.
+    First wave is canary wave. Each next wave contains not more than allowed number of hosts of each role.
+    Inside wave task is executed on all hosts concurrently, see :func:`~execute_parallel`.
+
+    Hosts, on which task failed, stay unavailable, so they are counted against allowed number of hosts of their roles
+    in all next waves. If task failed on some host of canary wave, or if failure rate after some wave exceeds ``max_failure_rate``,
+    or if failed hosts of some role used all allowed number of hosts of this role - deployment is stopped,
+    and hosts of next waves are skipped.
+
+    Args:
+        task: function, which should be executed on each host.
+        *args: positional arguments of task.
+        **kwargs: keyword arguments of task, except special keyword arguments:
+
+            - ``roles``: list of roles, default is all roles.
+            - ``wave_size``: maximum number of hosts of each role in one wave.
+              Can be number or dict, which maps role name to number.
+            - ``max_unavailable``: maximum percent of hosts of each role in one wave, used if ``wave_size`` is not given.
+              Can be number, string like ``'25%'`` or dict, which maps role name to number or string. Default is 10%.
+            - ``canary``: number of hosts in first canary wave, default is 1, 0 disables canary wave.
+            - ``max_failure_rate``: maximum allowed fraction of failed hosts from 0.0 to 1.0, default is 0.0.
+
+            These names are reserved, keyword arguments with these names are never passed to task.
+            All other keyword arguments, including ``hosts`` and ``workers``, are passed to task.
+
+    Returns:
+        :class:`~RollingResult` object with per-host results and failures, waves and skipped hosts.
+    """
+    roles = kwargs.pop('roles', None)
+    wave_size = kwargs.pop('wave_size', None)
+    max_unavailable = kwargs.pop('max_unavailable', None)
+    canary = kwargs.pop('canary', 1)
+    max_failure_rate = kwargs.pop('max_failure_rate', 0.0)
+    if roles is not None:
+        for role in roles:
+            if role not in env.roledefs:
+                fname = str(inspect.stack()[1][1])
+                nline = str(inspect.stack()[1][2])
+                abort('execute_rolling: role \'%s\' not defined in file %s line %s' % (role, fname, nline))
+    if not 0.0 <= max_failure_rate <= 1.0:
+        fname = str(inspect.stack()[1][1])
+        nline = str(inspect.stack()[1][2])
+        abort('execute_rolling: max_failure_rate must be from 0.0 to 1.0, %s given in file %s line %s' % (max_failure_rate, fname, nline))
+    task = functools.partial(task, *args, **kwargs)
+    role_hosts = _role_hosts(roles)
+    hosts, host_roles = _host_roles(role_hosts)
+    budgets = dict()
+    for role in role_hosts:
+        budgets[role] = _role_limit(role, len(role_hosts[role]), wave_size, max_unavailable)
+    result = RollingResult()
+    processed = 0
+    while hosts:
+        if canary and not result.waves:
+            wave, hosts = hosts[:canary], hosts[canary:]
+        else:
+            wave, hosts = _next_wave(hosts, host_roles, budgets)
+        wave_result = execute_parallel(task, hosts=wave, workers=len(wave))
+        result.waves.append(wave)
+        result.results.update(wave_result.results)
+        result.failures.update(wave_result.failures)
+        processed += len(wave)
+        for host in wave_result.failures:
+            for role in host_roles[host]:
+                budgets[role] -= 1
+        canary_failed = canary and len(result.waves) == 1 and wave_result.failures
+        exhausted = [host for host in hosts if not all([budgets[role] > 0 for role in host_roles[host]])]
+        if canary_failed or exhausted or float(len(result.failures)) / processed > max_failure_rate:
+            result.skipped.extend(hosts)
+            break
+    return result
@@ -0,0 +1,207 @@
+import sys
+import time
+import inspect
+import threading
+from fabric.api import abort
+from fabric.state import connections
+from fabrix.context import current_host, _snapshot, _restore_context
+
+
+_DEFAULT_WORKERS = 8
+
+
+def step(*depends):
+    """Decorator, which declares function as step with dependencies.
+
+    Steps are executed by :func:`~run_steps`. Each step is executed only after all steps it depends on are finished,
+    independent steps are executed concurrently, each over own ssh channel of the same connection.
+
+    Args:
+        *depends: steps, which must be finished before this step.
+
+    Example:
+
+    .. code-block:: python
+
+        @step()
+        def edit_grub():
+            edit_file('/etc/default/grub', replace_line(r'^GRUB_TIMEOUT=.*', 'GRUB_TIMEOUT=1'))
+
+        @step()
+        def edit_chrony():
+            edit_file('/etc/chrony.conf', replace_line(r'^server .*', 'server ntp.example.com iburst'))
+
+        @step(edit_grub, edit_chrony)
+        def reboot():
+            reboot_and_wait()
+
+        def tune_base_system():
+            run_steps(reboot)
+    """
+    for dependency in depends:
+        if not callable(dependency) or not hasattr(dependency, 'step_depends'):
+            fname = str(inspect.stack()[1][1])
+            nline = str(inspect.stack()[1][2])
+            abort('step: dependency %s is not step in file %s line %s' % (repr(dependency), fname, nline))
+
+    def decorator(function):
+        function.step_depends = tuple(depends)
+        return function
+    return decorator
+
+
+class StepsResult(object):
+    """Result of :func:`~run_steps`.
+
+    Attributes:
+        started: dict, which maps step name to time when step is started, in seconds from start of :func:`~run_steps`.
+        durations: dict, which maps step name to duration of step in seconds.
+        elapsed: Wall clock time of all steps in seconds.
+        critical_path: list of names of steps, which form longest chain of dependent steps.
+        critical_path_time: Sum of durations of steps of critical path in seconds.
+    """
+
+    def __init__(self):
+        self.started = dict()
+        self.durations = dict()
+        self.elapsed = 0.0
+        self.critical_path = list()
+        self.critical_path_time = 0.0
+
+    def report(self):
+        """Format time report.
+
+        Returns:
+            list of lines with time of each step, critical path and total time.
+        """
+        lines = list()
+        for step_name in sorted(self.started, key=lambda key: (self.started[key], key)):
+            lines.append('step %s started at %.3f, duration %.3f' % (step_name, self.started[step_name], self.durations[step_name]))
+        lines.append('critical path %s: %.3f' % (' -> '.join(self.critical_path), self.critical_path_time))
+        lines.append('elapsed %.3f, sum of steps %.3f' % (self.elapsed, sum(self.durations.values())))
+        return lines
+
+
+def _collect_steps(steps):
+    collected = list()
+    visiting = set()
+    visited = set()
+
+    def visit(function, chain):
+        if function in visited:
+            return
+        if function in visiting:
+            abort('run_steps: dependency cycle %s' % ' -> '.join([item.__name__ for item in chain + [function]]))
+        visiting.add(function)
+        for dependency in function.step_depends:
+            visit(dependency, chain + [function])
+        visiting.remove(function)
+        visited.add(function)
+        collected.append(function)
+
+    for function in steps:
+        visit(function, list())
+    return collected
+
+
+def _critical_path(steps, result):
+    finish = dict()
+    previous = dict()
+    for function in steps:
+        finish[function] = result.durations[function.__name__]
+        previous[function] = None
+        for dependency in function.step_depends:
+            if finish[dependency] + result.durations[function.__name__] > finish[function]:
+                finish[function] = finish[dependency] + result.durations[function.__name__]
+                previous[function] = dependency
+    function = max(steps, key=lambda item: finish[item])
+    result.critical_path_time = finish[function]
+    path = list()
+    while function is not None:
+        path.append(function.__name__)
+        function = previous[function]
+    result.critical_path = list(reversed(path))
+
+
+def run_steps(*steps, **kwargs):  # pylint: disable=too-many-locals
+    """Execute steps and all steps they depend on, on current host.
+
+    Independent steps are executed concurrently, see :func:`~step`, with Fabric settings of caller.
+    Steps are identified by function name in time report, so all steps must have different names.
+    If some step failed, no new steps are started, and exception of failed step is raised after all running steps are finished.
+
+    Args:
+        *steps: steps, decorated by :func:`~step`.
+        **kwargs: special keyword arguments:
+
+            - ``workers``: maximum number of concurrently running steps, default is 8.
+            - ``report``: print time report with critical path after all steps are finished, default is True.
+
+    Returns:
+        :class:`~StepsResult` object with time report.
+    """
+    workers = kwargs.pop('workers', _DEFAULT_WORKERS)
+    report = kwargs.pop('report', True)
+    for function in steps:
+        if not callable(function) or not hasattr(function, 'step_depends'):
+            fname = str(inspect.stack()[1][1])
+            nline = str(inspect.stack()[1][2])
+            abort('run_steps: %s is not step in file %s line %s' % (repr(function), fname, nline))
+    steps = _collect_steps(steps)
+    step_names = set()
+    for function in steps:
+        if function.__name__ in step_names:
+            fname = str(inspect.stack()[1][1])
+            nline = str(inspect.stack()[1][2])
+            abort('run_steps: duplicate step name \'%s\' in file %s line %s' % (function.__name__, fname, nline))
+        step_names.add(function.__name__)
+    context = _snapshot()
+    host_string = current_host()
+    if host_string is not None and len(steps) > 1:
+        connections[host_string]  # pylint: disable=pointless-statement
+    result = StepsResult()
+    condition = threading.Condition()
+    pending = list(steps)
+    running = set()
+    finished = set()
+    failures = list()
+    start = time.time()
+
+    def execute(function):
+        step_start = time.time()
+        try:
+            with _restore_context(context):
+                function()
+        except (SystemExit, Exception):  # pylint: disable=broad-except
+            exc_info = sys.exc_info()
+            with condition:
+                failures.append(exc_info)
+        with condition:
+            result.started[function.__name__] = step_start - start
+            result.durations[function.__name__] = time.time() - step_start
+            running.remove(function)
+            finished.add(function)
+            condition.notify_all()
+
+    with condition:
+        while running or (pending and not failures):
+            if not failures:
+                for function in pending[:]:
+                    if len(running) >= workers:
+                        break
+                    if all([dependency in finished for dependency in function.step_depends]):
+                        pending.remove(function)
+                        running.add(function)
+                        thread = threading.Thread(target=execute, args=(function,))
+                        thread.daemon = True
+                        thread.start()
+            condition.wait(0.1)
+    result.elapsed = time.time() - start
+    if failures:
+        exc_info = failures[0]
+        raise exc_info[0], exc_info[1], exc_info[2]
+    _critical_path(steps, result)
+    if report:
+        for line in result.report():
+            print "[%s] %s" % (host_string, line)
+    return result
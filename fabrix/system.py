@@ -1,11 +1,18 @@
 import re
 import time
+import socket
 import inspect
 import os.path
 from fabric.state import connections
+from fabric.network import normalize
 from fabric.api import env, abort, settings
 from fabrix.editor import edit_file, replace_line, strip_text
-from fabrix.ioutil import run, remove_file, remove_directory, create_directory, write_file
+from fabrix.ioutil import run, remove_file, remove_directory, create_directory, write_file, _close_sftp_session, _disconnect
+
+
+_REBOOT_MIN_DELAY = 0.5
+
+_REBOOT_MAX_DELAY = 5
 
 
 def is_reboot_required():
@@ -34,31 +41,53 @@ def is_reboot_required():
 def reboot_and_wait(wait=600, command='reboot'):
     """Reboot the remote system.
 
+    Boot id of remote system is saved before reboot. After reboot TCP port of ssh is polled with short exponential backoff,
+    ssh connection is established only when port accepts connections, and function returns as soon as new boot id is seen.
+
     Args:
         wait: Time to wait remote system after reboot in seconds.
         command: Command for rebooting remote system.
 
     Returns:
-        None
-    """
-    # Shorter timeout for a more granular cycle than the default.
-    timeout = 10
-    # Use 'wait' as max total wait time
-    attempts = int(round(float(wait) / float(timeout)))
-    # Don't bleed settings, since this is supposed to be self-contained.
-    # User adaptations will probably want to drop the "with settings()" and
-    # just have globally set timeout/attempts values.
-    with settings(timeout=timeout, connection_attempts=attempts, warn_only=True):
+        Measured downtime of remote system in seconds, from reboot command to reconnection.
+
+    Raises:
+        :class:`~exceptions.SystemExit`: When remote system is not rebooted in ``wait`` seconds.
+    """
+    old_boot_id = run('cat /proc/sys/kernel/random/boot_id').strip()
+    _close_sftp_session(env.host_string)
+    start = time.time()
+    deadline = start + wait
+    with settings(warn_only=True):
         run(command)
-        # Try to make sure we don't slip in before pre-reboot lockdown
-        time.sleep(10)
-        # This is actually an internal-ish API call, but users can simply drop
-        # it in real fabfile use -- the next run/sudo/put/get/etc call will
-        # automatically trigger a reconnect.
-        # We use it here to force the reconnect while this function is still in
-        # control and has the above timeout settings enabled.
-        connections.connect(env.host_string)
-    # At this point we should be reconnected to the newly rebooted server.
+    _disconnect(env.host_string)
+    dummy_user, host, port = normalize(env.host_string)
+    delay = _REBOOT_MIN_DELAY
+    while time.time() < deadline:
+        time.sleep(delay)
+        delay = min(delay * 2, _REBOOT_MAX_DELAY)
+        if not env.gateway and not _is_port_open(host, port, delay):
+            continue
+        try:
+            with settings(timeout=_REBOOT_MAX_DELAY, connection_attempts=1):
+                connections.connect(env.host_string)
+                boot_id = run('cat /proc/sys/kernel/random/boot_id').strip()
+        except (Exception, SystemExit):  # pylint: disable=broad-except
+            _disconnect(env.host_string)
+            continue
+        if boot_id != old_boot_id:
+            return time.time() - start
+        _disconnect(env.host_string)
+    abort('reboot_and_wait: host %s is not rebooted in %s seconds' % (env.host_string, wait))
+
+
+def _is_port_open(host, port, timeout):
+    try:
+        sock = socket.create_connection((host, int(port)), timeout)
+    except (socket.error, socket.timeout):
+        return False
+    sock.close()
+    return True
 
 
 def disable_selinux():
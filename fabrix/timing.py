@@ -0,0 +1,233 @@
+import re
+import sys
+import math
+import json
+import time
+import atexit
+import threading
+import contextlib
+from fabric.api import env
+from fabrix.tracing import _tracing, _add_span
+
+
+_timing = dict(enabled=False, json_filename=None, report=True, registered=False)
+
+_operations = list()
+
+_sections = list()
+
+_open_sections = dict()
+
+_lock = threading.Lock()
+
+_thread_local = threading.local()
+
+_REPORT_TOP = 5
+
+_COMMAND_MAX_LENGTH = 256
+
+_BASE64_REGEX = re.compile(r'[A-Za-z0-9+/]{64,}={0,2}')
+
+
+def enable_timing(json_filename=None, report=True):
+    """Enable timing of remote operations.
+
+    When timing is enabled, each :func:`~fabrix.ioutil.run` command, each file download and upload
+    and each rsync is timed and recorded per host, with command class, fabrix helper, which issued it,
+    current section and number of bytes moved. Section is part of task between two :func:`~fabrix.ioutil.name`
+    calls on the same host.
+
+    Command class is one of:
+
+        - ``query``: read-only command, for example, internal stat query or command registered by :func:`~fabrix.ioutil.memoize`.
+        - ``mutation``: command, which can change remote host.
+        - ``transfer``: file download, upload or rsync.
+
+    At exit summary is printed, see :func:`~timing_report`, and raw data are written to local JSON file,
+    see :func:`~write_timing_json`.
+
+    Args:
+        json_filename: Local file name for raw timing data, ``None`` means do not write file.
+        report: Print summary at exit.
+
+    Example:
+
+    .. code-block:: python
+
+        enable_timing(json_filename='timing.json')
+    """
+    _timing['enabled'] = True
+    _timing['json_filename'] = json_filename
+    _timing['report'] = report
+    if not _timing['registered']:
+        _timing['registered'] = True
+        atexit.register(_finish_timing)
+
+
+def _finish_timing():
+    if not _timing['enabled']:
+        return
+    if _timing['report']:
+        for line in timing_report():
+            print line
+    if _timing['json_filename'] is not None:
+        write_timing_json(_timing['json_filename'])
+
+
+def _close_sections(host_string=None):
+    now = time.time()
+    with _lock:
+        for host in list(_open_sections):
+            if host_string is not None and host != host_string:
+                continue
+            section = _open_sections.pop(host)
+            section['elapsed'] = now - section['start']
+            _sections.append(section)
+
+
+def _start_section(description):
+    if not _timing['enabled']:
+        return
+    host_string = env.host_string
+    _close_sections(host_string)
+    with _lock:
+        _open_sections[host_string] = dict(host=host_string, section=description, start=time.time(), elapsed=0.0)
+
+
+def _helper():
+    helper = None
+    frame = sys._getframe(1)  # pylint: disable=protected-access
+    while frame is not None:
+        module = frame.f_globals.get('__name__', '')
+        if module == 'contextlib' or module == __name__:
+            frame = frame.f_back
+            continue
+        if not module.startswith('fabrix.'):
+            break
+        if not frame.f_code.co_name.startswith('_'):
+            helper = frame.f_code.co_name
+        frame = frame.f_back
+    return helper
+
+
+def _current_command_class():
+    command_classes = _thread_local.__dict__.get('command_classes')
+    if command_classes:
+        return command_classes[-1]
+    return None
+
+
+@contextlib.contextmanager
+def _command_class(command_class):
+    command_classes = _thread_local.__dict__.setdefault('command_classes', list())
+    command_classes.append(command_class)
+    try:
+        yield
+    finally:
+        command_classes.pop()
+
+
+def _redact(command):
+    # inline file contents are sent as base64, they can be large and secret
+    if command is None:
+        return None
+    command = _BASE64_REGEX.sub(lambda match: '<%d bytes>' % (len(match.group(0)) * 3 / 4), command)
+    if len(command) > _COMMAND_MAX_LENGTH:
+        command = command[:_COMMAND_MAX_LENGTH] + '...'
+    return command
+
+
+def _record(kind, command_class, command, start, elapsed, size):
+    host_string = env.host_string
+    command = _redact(command)
+    if _tracing['enabled']:
+        _add_span(kind, command_class, host_string, start, elapsed, dict(host=host_string, command=command, bytes=size))
+    if not _timing['enabled']:
+        return
+    with _lock:
+        section = _open_sections.get(host_string)
+        _operations.append(dict(
+            host=host_string,
+            kind=kind,
+            command_class=command_class,
+            helper=_helper(),
+            section=section['section'] if section is not None else None,
+            command=command,
+            start=start,
+            elapsed=elapsed,
+            bytes=size,
+        ))
+
+
+@contextlib.contextmanager
+def _timed(kind, command_class, command):
+    counter = dict(bytes=0)
+    start = time.time()
+    try:
+        yield counter
+    finally:
+        _record(kind, command_class, command, start, time.time() - start, counter['bytes'])
+
+
+def _percentile(values, percent):
+    values = sorted(values)
+    index = int(math.ceil(percent / 100.0 * len(values))) - 1
+    return values[max(0, min(index, len(values) - 1))]
+
+
+def _totals(key):
+    totals = dict()
+    for operation in _operations:
+        total = totals.setdefault(operation[key], [0, 0.0, 0])
+        total[0] += 1
+        total[1] += operation['elapsed']
+        total[2] += operation['bytes']
+    return totals
+
+
+def timing_report():
+    """Format summary of timing data, see :func:`~enable_timing`.
+
+    Returns:
+        list of lines with slowest hosts, slowest sections, round trips per helper and latency of each command class.
+    """
+    _close_sections()
+    with _lock:
+        lines = list()
+        hosts = _totals('host')
+        lines.append('timing: %d round trips on %d hosts, %.3f seconds' % (
+            len(_operations), len(hosts), sum([operation['elapsed'] for operation in _operations])))
+        lines.append('slowest hosts:')
+        for host, (count, elapsed, size) in sorted(hosts.items(), key=lambda item: -item[1][1])[:_REPORT_TOP]:
+            lines.append('    %s: %.3f seconds, %d round trips, %d bytes' % (host, elapsed, count, size))
+        lines.append('slowest sections:')
+        for section in sorted(_sections, key=lambda item: -item['elapsed'])[:_REPORT_TOP]:
+            lines.append('    [%s] %s: %.3f seconds' % (section['host'], section['section'], section['elapsed']))
+        lines.append('round trips per helper:')
+        for helper, (count, elapsed, size) in sorted(_totals('helper').items(), key=lambda item: (-item[1][0], item[0])):
+            lines.append('    %s: %d round trips, %.3f seconds, %d bytes' % (helper, count, elapsed, size))
+        lines.append('latency per command class:')
+        for command_class in sorted(_totals('command_class')):
+            latencies = [operation['elapsed'] for operation in _operations if operation['command_class'] == command_class]
+            lines.append('    %s: %d round trips, p50 %.3f, p95 %.3f seconds' % (
+                command_class, len(latencies), _percentile(latencies, 50), _percentile(latencies, 95)))
+        return lines
+
+
+def write_timing_json(json_filename):
+    """Write raw timing data to local JSON file, see :func:`~enable_timing`.
+
+    File contains object with two lists: ``operations`` and ``sections``.
+    Each operation has ``host``, ``kind``, ``command_class``, ``helper``, ``section``, ``command``,
+    ``start``, ``elapsed`` and ``bytes`` fields. Each section has ``host``, ``section``, ``start`` and ``elapsed`` fields.
+    Times are in seconds, ``start`` is unix time. In ``command`` inline base64 data, for example, content of uploaded file,
+    is replaced by its size, and command is truncated to 256 characters.
+
+    Args:
+        json_filename: Local file name.
+    """
+    _close_sections()
+    with _lock:
+        data = dict(operations=list(_operations), sections=list(_sections))
+    with open(json_filename, 'w') as json_file:
+        json.dump(data, json_file, indent=4, sort_keys=True)
@@ -0,0 +1,228 @@
+import sys
+import json
+import time
+import atexit
+import inspect
+import threading
+import contextlib
+from fabric.api import env
+
+
+_tracing = dict(enabled=False, trace_filename=None, registered=False)
+
+_spans = list()
+
+_hooks = list()
+
+_lock = threading.Lock()
+
+_thread_local = threading.local()
+
+_TRACED_MODULES = frozenset(['fabrix.ioutil', 'fabrix.editor', 'fabrix.passwd', 'fabrix.render', 'fabrix.rpmyum', 'fabrix.system'])
+
+_UNTRACED_FUNCTIONS = frozenset(['run', 'name', 'warn', 'debug_print'])
+
+_CONTEXT_MANAGER_EXIT = contextlib.GeneratorContextManager.__exit__.im_func.func_code
+
+_previous_hooks = dict(installed=False, trace=None, thread_trace=None)
+
+
+def enable_tracing(trace_filename=None):
+    """Enable tracing of fabrix operations.
+
+    When tracing is enabled, each call of public fabrix function, for example, :func:`~fabrix.editor.edit_file`,
+    :func:`~fabrix.ioutil.write_file`, :func:`~fabrix.rpmyum.yum_install` or :func:`~fabrix.system.systemctl_restart`,
+    is recorded as span, and each remote command, file download and upload, issued by this function,
+    is recorded as child span. Span has ``host`` and ``changed`` attributes, child span also has ``command`` attribute.
+
+    Calls are traced in current thread and in all threads started after this call,
+    so tracing should be enabled before :func:`~fabrix.parallel.execute_parallel` or other concurrent execution is started.
+    Tracing uses :func:`~sys.settrace`, trace functions installed before, for example, by debugger or coverage, are still called.
+    Trace function is called only when python function is entered, not for calls of builtin functions,
+    like regular expressions, but interpreter still runs slower while trace function is installed,
+    for example, :func:`~fabrix.editor.edit_text` on big text is about 1.5 times slower.
+
+    At exit spans are written to local trace-event JSON file, see :func:`~write_trace`.
+
+    Args:
+        trace_filename: Local file name for trace, ``None`` means do not write file.
+
+    Example:
+
+    .. code-block:: python
+
+        enable_tracing(trace_filename='trace.json')
+        execute_parallel(deploy)
+    """
+    _tracing['enabled'] = True
+    _tracing['trace_filename'] = trace_filename
+    if not _previous_hooks['installed']:
+        _previous_hooks['installed'] = True
+        _previous_hooks['trace'] = sys.gettrace()
+        _previous_hooks['thread_trace'] = threading._trace_hook  # pylint: disable=protected-access
+        sys.settrace(_chained_trace(_previous_hooks['trace']))
+        threading.settrace(_chained_trace(_previous_hooks['thread_trace']))
+    if not _tracing['registered']:
+        _tracing['registered'] = True
+        atexit.register(_finish_tracing)
+
+
+def disable_tracing():
+    """Disable tracing of fabrix operations, already recorded spans are preserved."""
+    _tracing['enabled'] = False
+    if _previous_hooks['installed']:
+        _previous_hooks['installed'] = False
+        sys.settrace(_previous_hooks['trace'])
+        threading.settrace(_previous_hooks['thread_trace'])
+
+
+def add_trace_hook(hook):
+    """Register function, which is called with each finished span.
+
+    Span is dict with ``name``, ``category``, ``host``, ``thread``, ``start``, ``elapsed`` and ``attributes`` keys.
+    Times are in seconds, ``start`` is unix time. Hook is called in thread, which executed operation.
+
+    Args:
+        hook: function with one argument.
+    """
+    with _lock:
+        _hooks.append(hook)
+
+
+def _finish_tracing():
+    if _tracing['trace_filename'] is not None:
+        write_trace(_tracing['trace_filename'])
+
+
+def _add_span(name, category, host_string, start, elapsed, attributes):
+    span = dict(
+        name=name,
+        category=category,
+        host=host_string,
+        thread=threading.current_thread().ident,
+        start=start,
+        elapsed=elapsed,
+        attributes=attributes,
+    )
+    with _lock:
+        _spans.append(span)
+        hooks = list(_hooks)
+    for hook in hooks:
+        hook(span)
+
+
+def _chained_trace(previous):
+    if previous is None:
+        return _trace_call
+
+    def chained_trace(frame, event, arg):
+        return _chained_local_trace(_trace_call(frame, event, arg), previous(frame, event, arg))
+    return chained_trace
+
+
+def _chained_local_trace(local_trace, previous_local_trace):
+    if local_trace is None:
+        return previous_local_trace
+    if previous_local_trace is None:
+        return local_trace
+
+    def chained_local_trace(frame, event, arg):
+        return _chained_local_trace(local_trace(frame, event, arg), previous_local_trace(frame, event, arg))
+    return chained_local_trace
+
+
+def _public_function(frame):
+    code = frame.f_code
+    if code.co_name.startswith('_') or code.co_name in _UNTRACED_FUNCTIONS:
+        return False
+    function = frame.f_globals.get(code.co_name)
+    if getattr(function, 'func_code', None) is code:
+        return True
+    # function, decorated by contextlib.contextmanager, is stored in closure of decorator
+    for cell in getattr(function, 'func_closure', None) or ():
+        if getattr(cell.cell_contents, 'func_code', None) is code:
+            return True
+    return False
+
+
+def _finish_call(frame, host_string, start, changed):
+    name = frame.f_globals['__name__'].split('.')[-1] + '.' + frame.f_code.co_name
+    _add_span(name, 'call', host_string, start, time.time() - start, dict(host=host_string, changed=changed))
+
+
+def _trace_call(frame, event, dummy_arg):
+    # global trace function is called only when python frame is entered, local trace function gets its return
+    if not _tracing['enabled'] or event != 'call':
+        return None
+    if frame.f_code is _CONTEXT_MANAGER_EXIT:
+        generator_frame = frame.f_locals['self'].gen.gi_frame
+        generators = _thread_local.__dict__.get('generators')
+        if generators and generator_frame in generators:
+            _thread_local.__dict__.setdefault('exits', dict())[frame] = generator_frame
+            return _trace_return
+        return None
+    if frame.f_globals.get('__name__') not in _TRACED_MODULES or not _public_function(frame):
+        return None
+    if frame.f_code.co_flags & inspect.CO_GENERATOR:
+        # context manager is finished, when its __exit__ returns, see above
+        if frame.f_lasti == -1:
+            _thread_local.__dict__.setdefault('generators', dict())[frame] = (env.host_string, time.time())
+        return None
+    calls = _thread_local.__dict__.setdefault('calls', list())
+    calls.append((frame, env.host_string, time.time()))
+    return _trace_return
+
+
+def _trace_return(frame, event, arg):
+    if event != 'return':
+        return _trace_return
+    exits = _thread_local.__dict__.get('exits')
+    if exits and frame in exits:
+        generator_frame = exits.pop(frame)
+        host_string, start = _thread_local.generators.pop(generator_frame)
+        _finish_call(generator_frame, host_string, start, None)
+        return None
+    calls = _thread_local.__dict__.get('calls')
+    if not calls or calls[-1][0] is not frame:
+        return None
+    dummy_frame, host_string, start = calls.pop()
+    if callable(arg):
+        return None
+    _finish_call(frame, host_string, start, arg if isinstance(arg, bool) else None)
+    return None
+
+
+def _trace_events():
+    events = list()
+    pids = dict()
+    for span in sorted(_spans, key=lambda item: (item['start'], -item['elapsed'])):
+        host_string = span['host'] or 'local'
+        if host_string not in pids:
+            pids[host_string] = len(pids) + 1
+            events.append(dict(name='process_name', ph='M', pid=pids[host_string], tid=0, args=dict(name=host_string)))
+        events.append(dict(
+            name=span['name'],
+            cat=span['category'],
+            ph='X',
+            ts=int(span['start'] * 1000000),
+            dur=int(span['elapsed'] * 1000000),
+            pid=pids[host_string],
+            tid=span['thread'],
+            args=span['attributes'],
+        ))
+    return events
+
+
+def write_trace(trace_filename):
+    """Write recorded spans to local file in trace-event JSON format, see :func:`~enable_tracing`.
+
+    File can be opened in ``chrome://tracing`` or in Perfetto UI. Each host is shown as separate process,
+    so serialization and idle gaps of each host are visible on one timeline.
+
+    Args:
+        trace_filename: Local file name.
+    """
+    with _lock:
+        events = _trace_events()
+    with open(trace_filename, 'w') as trace_file:
+        json.dump(dict(traceEvents=events, displayTimeUnit='ms'), trace_file, indent=1, sort_keys=True)
@@ -1,5 +1,8 @@
 import re
 import pytest
+import fabrix.ioutil
+import fabrix.timing
+import fabrix.tracing
 from fabric.api import env
 
 
@@ -9,6 +12,21 @@ def clear_fabric_config():
     env.roledefs = dict()
     env.host_string = None
     env.real_fabfile = None
+    fabrix.ioutil._stat_caches.clear()
+    fabrix.ioutil._sftp_clients.clear()
+    fabrix.ioutil._memo_caches.clear()
+    fabrix.ioutil._memoized_commands.clear()
+    fabrix.ioutil._memo_stats.update(hits=0, misses=0)
+    fabrix.ioutil._content_caches.clear()
+    fabrix.ioutil._write_backs.clear()
+    fabrix.ioutil._prefetch_depths.clear()
+    fabrix.timing._timing.update(enabled=False, json_filename=None, report=True)
+    del fabrix.timing._operations[:]
+    del fabrix.timing._sections[:]
+    fabrix.timing._open_sections.clear()
+    fabrix.tracing._tracing.update(enabled=False, trace_filename=None)
+    del fabrix.tracing._spans[:]
+    del fabrix.tracing._hooks[:]
     yield
     env.hosts = list()
     env.roledefs = dict()
@@ -87,9 +105,7 @@ def mock_put_factory(put_state):  # put_state == { pattern : boolean, pattern: .
         remote_path = kwargs['remote_path']
         for pattern, failed in put_state.items():
             if re.match(pattern, remote_path):
-                out = _AttributeString(list(('a', 'b', 'c')))
-                out.failed = failed
-                return out
+                return not failed
         assert 0, 'remote_path does not match any pattern'
     return mock_put
 
@@ -103,8 +119,21 @@ def mock_get_factory(get_state):  # get_state == { pattern : { content: text, fa
             if re.match(pattern, remote_path):
                 file_like_object.seek(0)
                 file_like_object.write(config['content'])
-                out = _AttributeString(list(('a', 'b', 'c')))
-                out.failed = config['failed']
-                return out
+                return not config['failed']
         assert 0, 'remote_path does not match any pattern'
     return mock_get
+
+
+def mock_run_shell_factory(commands):  # commands == list, each executed command appended to it
+
+    def mock_run_shell(command, **kwargs):
+        import subprocess
+        commands.append(command)
+        process = subprocess.Popen(['/bin/bash', '-c', command], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        stdout, dummy_stderr = process.communicate()
+        out = _AttributeString(stdout.strip())
+        out.return_code = process.returncode
+        out.failed = process.returncode != 0 and not kwargs.get('warn_only', env.warn_only)
+        out.succeeded = not out.failed
+        return out
+    return mock_run_shell
@@ -0,0 +1,63 @@
+import time
+import threading
+import pytest
+import fabric.state
+import fabrix.aio
+import fabrix.ioutil
+import fabrix.system
+from conftest import abort
+from fabric.api import env, settings, hide, cd, abort as fabric_abort
+from fabrix.context import host_context
+
+
+def test_aio(monkeypatch):
+    lock = threading.Lock()
+    state = {'running': 0, 'max_running': 0}
+    commands = list()
+
+    def mock_run(command):
+        with lock:
+            state['running'] += 1
+            state['max_running'] = max(state['max_running'], state['running'])
+        time.sleep(0.02)
+        with lock:
+            state['running'] -= 1
+        commands.append((env.host_string, command))
+        if command == 'fail':
+            fabric_abort('command failed on host %s' % env.host_string)
+        return env.host_string + ': ' + command
+    monkeypatch.setattr(fabrix.ioutil, 'run', mock_run)
+    monkeypatch.setattr(fabrix.system, 'run', mock_run)
+    monkeypatch.setitem(env, 'fabrix_aio_workers', 4)
+    futures = list()
+    for index in range(12):
+        with host_context('10.10.10.%d' % index):
+            futures.append(fabrix.aio.run('uptime'))
+    assert fabrix.aio.gather(*futures) == ['10.10.10.%d: uptime' % index for index in range(12)]
+    assert all([future.done() for future in futures])
+    assert state['max_running'] <= 4
+    assert len(fabrix.aio._workers) <= 4
+    monkeypatch.setitem(env, 'host_string', '10.10.10.100')
+    future = fabrix.aio.systemctl_restart('nginx')
+    assert future.result(timeout=5) is None
+    assert commands[-1] == ('10.10.10.100', 'systemctl daemon-reload ; systemctl restart nginx ; systemctl daemon-reload')
+    assert future.exception() is None
+    callbacks = list()
+    future.add_done_callback(callbacks.append)
+    assert callbacks == [future]
+    failed = fabrix.aio.run('fail')
+    assert isinstance(failed.exception(), SystemExit)
+    with abort('command failed on host 10.10.10.100'):
+        failed.result()
+    with abort('command failed on host 10.10.10.100'):
+        fabrix.aio.gather(fabrix.aio.run('ok'), fabrix.aio.run('fail'))
+    event = threading.Event()
+    slow = fabrix.aio.submit(event.wait)
+    with pytest.raises(RuntimeError):
+        slow.result(timeout=0.05)
+    event.set()
+    slow.result(timeout=5)
+    with settings(hide('running'), cd('/srv'), warn_only=True):
+        future = fabrix.aio.submit(lambda: (env.host_string, env.cwd, env.warn_only, fabric.state.output.running))
+    assert future.result(timeout=5) == ('10.10.10.100', '/srv', True, False)
+    assert fabrix.aio.run.__doc__ == 'Asynchronous version of :func:`~fabrix.ioutil.run`, returns :class:`~Future` object.'
@@ -0,0 +1,64 @@
+import threading
+import fabric.state
+from fabric.api import env, settings, hide
+from fabric.utils import _AttributeDict
+from fabrix.config import conf
+from fabrix.context import host_context, current_host
+from fabrix.render import render
+
+
+def test_host_context(monkeypatch):
+    conf.__super__setitem__('10.10.10.10', {'name': 'first'})
+    conf.__super__setitem__('10.10.10.11', {'name': 'second'})
+    monkeypatch.setitem(env, "host_string", '10.10.10.10')
+    assert current_host() == '10.10.10.10'
+    assert conf.name == 'first'
+    with host_context('10.10.10.11'):
+        assert current_host() == '10.10.10.11'
+        assert env.host_string == '10.10.10.11'
+        assert conf.name == 'second'
+        assert conf['name'] == 'second'
+        assert render('{{ name }}') == 'second\n'
+        with host_context('10.10.10.10'):
+            assert conf.name == 'first'
+        assert conf.name == 'second'
+        with settings(hide('everything'), warn_only=True):
+            assert env.warn_only is True
+            assert fabric.state.output.running is False
+        env.fabrix_context_test = 'inner'
+    assert current_host() == '10.10.10.10'
+    assert conf.name == 'first'
+    assert type(env) is _AttributeDict
+    assert 'fabrix_context_test' not in env
+    assert fabric.state.output.running is True
+    monkeypatch.setitem(env, "host_string", None)
+    assert current_host() is None
+    assert conf['name'] is None
+    dict.__delitem__(conf, '10.10.10.10')
+    dict.__delitem__(conf, '10.10.10.11')
+
+
+def test_host_context_threads():
+    hosts = ['10.10.10.%d' % index for index in range(8)]
+    for host in hosts:
+        conf.__super__setitem__(host, {'name': 'name-' + host})
+    barrier = threading.Semaphore(0)
+    results = dict()
+
+    def worker(host):
+        with host_context(host):
+            with settings(warn_only=(host == hosts[0])):
+                barrier.acquire()
+                results[host] = (current_host(), conf.name, env.warn_only)
+
+    threads = [threading.Thread(target=worker, args=(host,)) for host in hosts]
+    for thread in threads:
+        thread.start()
+    for dummy_thread in threads:
+        barrier.release()
+    for thread in threads:
+        thread.join()
+    assert results == dict([(host, (host, 'name-' + host, host == hosts[0])) for host in hosts])
+    assert env.host_string is None
+    for host in hosts:
+        dict.__delitem__(conf, host)
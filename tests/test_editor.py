@@ -1,9 +1,14 @@
-from conftest import abort
-from fabric.api import env
+import re
+import time
+import fabric.api
+import fabrix.steps
+from conftest import abort, mock_run_shell_factory
+from fabric.api import env, abort as fabric_abort
+from fabrix.steps import step, run_steps
 from fabrix.editor import edit_text, edit_ini_section, edit_local_file, edit_file
 from fabrix.editor import _apply_editors, append_line, prepend_line, strip_line
 from fabrix.editor import substitute_line, replace_line, delete_line, insert_line
-from fabrix.editor import strip_text
+from fabrix.editor import strip_text, set_ini_value, IniDocument, edit_files, _combined_regex
 
 
 def test_empty_list_of_editors():
@@ -84,6 +89,9 @@ def test_delete_line():
     assert edit_text("text", delete_line("line")) == "text"
     assert edit_text("text\nxxx", delete_line("xxx")) == "text"
     assert edit_text("text\nxxx\n", delete_line("xxx")) == "text\n"
+    assert edit_text("foo=1", delete_line("foo=.*"), append_line("foo=2")) == "foo=2\n"
+    assert edit_text("foo=1\n", delete_line("foo=.*"), prepend_line("foo=2")) == "foo=2\n"
+    assert edit_text("foo=1\nbar=1", delete_line("foo=.*"), delete_line("bar=.*")) == ""
 
 
 def test_insert_line():
@@ -120,6 +128,9 @@ def test_edit_ini_section():
         edit_text("[section]\n[section]\n", edit_ini_section("[section]", append_line("append")))
     assert edit_text("[remi-php70]\nenabled=0\n", edit_ini_section("[remi-php70]", replace_line("enabled=0", "enabled=1"))) == "[remi-php70]\nenabled=1\n"
     assert edit_text("[remi]\nenabled=0\n[x]\n", edit_ini_section("[remi]", replace_line("enabled=0", "enabled=1"))) == "[remi]\nenabled=1\n[x]\n"
+    assert edit_text("[a]", edit_ini_section("[a]", append_line("x"))) == "[a]\nx\n"
+    assert edit_text("[a]\n[b]\ny=1\n", edit_ini_section("[a]", prepend_line("x"))) == "[a]\nx\n\n[b]\ny=1\n"
+    assert edit_text("[a]\nx=1\n[b]\n", edit_ini_section("[a]", delete_line("x=1"))) == "[a]\n\n[b]\n"
     assert edit_text("# php\n[remi-php70]\nenabled=0\n", edit_ini_section(None, substitute_line("php", "PHP"))) == "# PHP\n[remi-php70]\nenabled=0\n"
 
 
@@ -142,7 +153,7 @@ def test_edit_file(tmpdir, monkeypatch):
         assert filename
         return file['content']
 
-    def patch__atomic_write_file(filename, new_content):
+    def patch__atomic_write_file(filename, new_content, old_content):
         assert filename
         file['content'] = new_content
 
@@ -169,3 +180,180 @@ def test_strip_test():
         other text
 
     """) == "some text\n\nother text\n"
+
+
+def test_line_editor_protocol():
+    editor = replace_line('a=.*', 'a=1')
+    assert editor("a=0\nb=0") == "a=1\nb=0"
+    lines = ["a=0", "b=0"]
+    editor.edit_lines(lines)
+    assert lines == ["a=1", "b=0"]
+
+    def upper_editor(text):
+        return text.upper()
+    assert edit_text("a=0\nb=0\n", replace_line('a=.*', 'a=x'), upper_editor, delete_line('B=.*')) == "A=X\n"
+    assert edit_text("a=0\nb=0\n", replace_line('a=.*', r'a=1\nc=1'), delete_line('c=.*')) == "a=1\nb=0\n"
+    assert edit_text("a=0\n", substitute_line('0', r'0\nc=0'), delete_line('c=.*')) == "a=0\n"
+    assert edit_text("[s]\na=0\n", edit_ini_section('[s]', replace_line('a=.*', 'a=1'), upper_editor)) == "[s]\nA=1\n"
+
+
+def test_fused_line_editors():
+    text = "a=0\nb=0\nc=0\nd=0\n"
+    editors = [replace_line('a=.*', 'a=1'), replace_line('a=1', 'b=1'), delete_line('c=.*'), substitute_line('=0', '=2')]
+    expected = text
+    for editor in editors:
+        expected = editor(expected)
+    assert expected == "b=1\nb=2\nd=2\n"
+    assert edit_text(text, *editors) == expected
+    assert edit_text("a=0\nb=0\n", replace_line('a=0', r'a=1\nc=1'), replace_line('c=.*', 'c=2'), delete_line('b=.*')) == "a=1\nc=2\n"
+    assert edit_text("aa=0\nA=0\n", replace_line(r'(a)\1=.*', 'x=1'), replace_line('a=.*', 'y=1', re.I)) == "x=1\ny=1\n"
+    assert edit_text("a=0\n", replace_line('(?P<k>a)=.*', r'\g<k>=1'), replace_line('(?P<k>a)=1', r'\g<k>=2')) == "a=2\n"
+    rules = [replace_line('a=.*', 'a=1').line_rule, delete_line('b=.*').line_rule]
+    assert _combined_regex(rules).pattern == '(?:^a=.*$)|(?:^b=.*$)'
+    assert _combined_regex([replace_line(r'(a)\1', 'a').line_rule, delete_line('b').line_rule]) is None
+
+
+def test_idempotence_verification(monkeypatch):
+    calls = list()
+
+    def counting_editor(text):
+        calls.append(text)
+        return text.replace('x', 'y')
+    assert edit_text("a\n", counting_editor) == "a\n"
+    assert len(calls) == 1
+    assert edit_text("x\n", counting_editor) == "y\n"
+    assert len(calls) == 3
+    assert edit_text("y\n", counting_editor, delete_line('z')) == "y\n"
+    assert len(calls) == 4
+    monkeypatch.setitem(env, 'fabrix_strict_editors', True)
+    assert edit_text("y\n", counting_editor, delete_line('z')) == "y\n"
+    assert len(calls) == 6
+    monkeypatch.setitem(env, 'fabrix_strict_editors', False)
+    assert edit_text("x\n", replace_line('x', 'y'), delete_line('z')) == "y\n"
+    with abort("editors is not idempotent"):
+        edit_text("x\n", append_line('a'), replace_line('a', 'b'))
+    with abort("editors is not idempotent"):
+        edit_text("[s]\nx\n", edit_ini_section('[s]', append_line('a'), replace_line('a', 'b')))
+    with abort("editors is not idempotent"):
+        edit_text("[s]\na = 1\n", set_ini_value('[s]', 'a', '2'), edit_ini_section('[s]', replace_line('a = 2', 'b = 2')))
+    with abort("editors is not idempotent"):
+        edit_text("a\n", replace_line('b', 'c'), replace_line('a', 'b'))
+    with abort("editors is not idempotent"):
+        edit_text("abb\n", substitute_line('ab', 'a'))
+    assert edit_text("a\nb\n", replace_line('a', 'b'), replace_line('b', 'c')) == "c\nc\n"
+
+
+def test_ini_document(monkeypatch):
+    text = "# repo\n[zfs]\nname = ZFS\nenabled = 1\n\n[zfs-kmod]\n; kmod\nenabled=0\n\n[ empty ]\n"
+    document = IniDocument(text)
+    assert document.sections() == ['[zfs]', '[zfs-kmod]', '[ empty ]']
+    assert document.has_section('[zfs]') and not document.has_section('[other]')
+    assert document.get('[zfs]', 'enabled') == '1'
+    assert document.get('[zfs-kmod]', 'enabled') == '0'
+    assert document.get('[zfs-kmod]', 'name', 'none') == 'none'
+    assert document.get('[other]', 'name') is None
+    assert document.text() == text
+    assert document.set('[zfs]', 'enabled', '1') is False
+    assert document.set('[zfs]', 'enabled', '0') is True
+    assert document.set('[zfs-kmod]', 'gpgcheck', '1') is True
+    assert document.set('[ empty ]', 'key', 'value') is True
+    assert document.edit_section('[zfs-kmod]', replace_line('enabled=0', 'enabled=1')) is True
+    assert document.get('[zfs-kmod]', 'enabled') == '1'
+    assert document.text() == "# repo\n[zfs]\nname = ZFS\nenabled = 0\n\n[zfs-kmod]\n; kmod\nenabled=1\ngpgcheck=1\n\n[ empty ]\nkey=value\n"
+    with abort(r"IniDocument.set: section '\[other\]' not found"):
+        document.set('[other]', 'key', 'value')
+    with abort(r"IniDocument: bad ini file, section '\[a\]' duplicated"):
+        IniDocument("[a]\n[a]\n")
+
+    parses = list()
+    original_parse = IniDocument._parse
+
+    def counting_parse(self, lines, caller):
+        parses.append(caller)
+        original_parse(self, lines, caller)
+    monkeypatch.setattr(IniDocument, '_parse', counting_parse)
+    editors = [
+        edit_ini_section("[zfs]", replace_line("enabled = 1", "enabled = 0")),
+        edit_ini_section("[zfs-kmod]", replace_line("enabled=0", "enabled=1")),
+        set_ini_value("[zfs-kmod]", "gpgcheck", "1"),
+    ]
+    assert edit_text(text, *editors) == "# repo\n[zfs]\nname = ZFS\nenabled = 0\n\n[zfs-kmod]\n; kmod\nenabled=1\ngpgcheck=1\n\n[ empty ]\n"
+    # one parse for all ini editors in each of two passes, second pass verifies idempotence
+    assert parses == ['edit_ini_section', 'edit_ini_section']
+    assert set_ini_value("[zfs]", "enabled", "0")(text) == text.replace("enabled = 1", "enabled = 0")
+    with abort(r"set_ini_value: section '\[other\]' not found"):
+        edit_text(text, set_ini_value("[other]", "key", "value"))
+    with abort(r"set_ini_value: section name must be in form \[section_name\]"):
+        set_ini_value("other", "key", "value")
+
+
+def test_edit_files(tmpdir, monkeypatch):
+    commands = list()
+    monkeypatch.setattr(fabric.api, 'run', mock_run_shell_factory(commands))
+    monkeypatch.setitem(env, "host_string", '11.11.11.11')
+    remote_dir = tmpdir.mkdir("remote")
+    remote_dir.join("first").write("a=0\nb=0\n")
+    remote_dir.join("second").write("c=0\n")
+    remote_dir.join("third").write("d=0\n")
+    first, second, third = [str(remote_dir.join(name)) for name in ("first", "second", "third")]
+    files = {
+        first: [replace_line('a=.*', 'a=1'), delete_line('b=.*')],
+        second: [replace_line('c=.*', 'c=1')],
+        third: [replace_line('d=.*', 'd=0')],
+    }
+    assert edit_files(files) == {first: True, second: True, third: False}
+    assert len(commands) == 2
+    assert remote_dir.join("first").read() == "a=1\n"
+    assert remote_dir.join("second").read() == "c=1\n"
+    assert remote_dir.join("third").read() == "d=0\n"
+    assert edit_files(files) == {first: False, second: False, third: False}
+    assert len(commands) == 3
+    files[third] = [replace_line('d=.*', 'd=1')]
+    assert edit_files(files) == {first: False, second: False, third: True}
+    assert remote_dir.join("third").read() == "d=1\n"
+
+    def not_idempotent_editor(text):
+        return text + "x"
+    files[second] = [replace_line('c=.*', 'c=2')]
+    files[third] = [not_idempotent_editor]
+    with abort("editors is not idempotent in file .*test_editor.py line"):
+        edit_files(files)
+    assert remote_dir.join("second").read() == "c=1\n"
+    with abort('edit_files: remote filename must be absolute, "relative" given'):
+        edit_files({'relative': [strip_line()]})
+    with abort("editors can't be empty"):
+        edit_files({first: []})
+    with abort('edit_files: dict expected'):
+        edit_files([first])
+
+
+def test_edit_files_concurrent_steps(tmpdir, monkeypatch):
+    commands = list()
+    monkeypatch.setattr(fabric.api, 'run', mock_run_shell_factory(commands))
+    monkeypatch.setitem(env, "host_string", '11.11.11.11')
+    monkeypatch.setattr(fabrix.steps, 'connections', {'11.11.11.11': object()})
+    remote_dir = tmpdir.mkdir("remote")
+    remote_dir.join("one").write("a=1\n")
+    remote_dir.join("two").write("b=1\n")
+    one, two = str(remote_dir.join("one")), str(remote_dir.join("two"))
+    results = dict()
+
+    def slow_failed_editor(text):
+        time.sleep(0.5)
+        fabric_abort('step failed')
+        return text
+
+    @step()
+    def first():
+        edit_files({one: [slow_failed_editor]})
+
+    @step()
+    def second():
+        time.sleep(0.1)
+        results['two'] = edit_files({two: [replace_line('b=.*', 'b=2')]})
+
+    with abort('step failed'):
+        run_steps(first, second, report=False)
+    assert results['two'] == {two: True}
+    assert remote_dir.join("two").read() == "b=2\n"
+    assert remote_dir.join("one").read() == "a=1\n"
@@ -1,15 +1,20 @@
+import StringIO
+import hashlib
 import os.path
 import fabric.api
 import fabrix.ioutil
 from conftest import abort, mock_get_factory, mock_put_factory, mock_run_factory
-from conftest import mock_local_factory, mock_os_path_exists_factory
-from fabric.api import env, settings
+from conftest import mock_local_factory, mock_os_path_exists_factory, mock_run_shell_factory
+from fabric.api import env, settings, cd
 from fabrix.ioutil import name, warn, debug_print, read_local_file, write_local_file, _atomic_write_local_file
-from fabrix.ioutil import read_file, write_file, _atomic_write_file, copy_file, rsync
+from fabrix.ioutil import read_file, write_file, _atomic_write_file, copy_file, sync_files, rsync, rsync_parallel
 from fabrix.ioutil import _copy_local_file_acl, _copy_local_file_selinux_context, chown, chmod
-from fabrix.ioutil import _copy_file_owner_and_mode, _copy_file_acl, _copy_file_selinux_context
 from fabrix.ioutil import remove_file, remove_directory, create_file, create_directory, run
 from fabrix.ioutil import is_file_exists, is_directory_exists, is_file_not_exists, is_directory_not_exists
+from fabrix.ioutil import _sftp_put, _close_sftp_session, _disconnect, iter_file_lines
+from fabrix.ioutil import _delta_segments, batch, fill_stat_cache, clear_stat_cache
+from fabrix.ioutil import memoize, clear_memo_cache, memo_cache_stats, prefetch_files
+from fabrix.editor import edit_file, replace_line
 
 
 def test_name():
@@ -183,7 +188,7 @@ def test_read_file(monkeypatch):
     }
     mock_get = mock_get_factory(get_state)
     monkeypatch.setitem(env, "host_string", '11.11.11.11')
-    monkeypatch.setattr(fabrix.ioutil, 'get', mock_get)
+    monkeypatch.setattr(fabrix.ioutil, '_sftp_get', mock_get)
     with abort('downloading file ' + '/failed' + ' from host %s failed' % '11.11.11.11'):
         read_file('/failed', abort_on_error=True)
     assert read_file('/failed', abort_on_error=False) is None
@@ -191,6 +196,128 @@ def test_read_file(monkeypatch):
     assert read_file('/ok', abort_on_error=False) == 'ok-text'
 
 
+def test_sftp_session(monkeypatch):
+    class Transport(object):
+        active = True
+
+        def is_active(self):
+            return self.active
+
+    class Channel(object):
+        closed = False
+
+        def __init__(self, transport):
+            self.transport = transport
+
+        def get_transport(self):
+            return self.transport
+
+    class Client(object):
+        def __init__(self, transport):
+            self.channel = Channel(transport)
+
+        def get_channel(self):
+            return self.channel
+
+        def close(self):
+            self.channel.closed = True
+
+        def getfo(self, remote_path, file_like_object):
+            if remote_path == '/failed':
+                raise IOError('No such file')
+            file_like_object.write('content of ' + remote_path)
+
+        def putfo(self, file_like_object, remote_path):
+            assert file_like_object.read() == 'content'
+            if remote_path == '/failed':
+                raise IOError('Permission denied')
+            puts.append(remote_path)
+
+        def normalize(self, remote_path):
+            assert remote_path == '.'
+            return '/home/user'
+
+    class Connection(object):
+        def __init__(self):
+            self.transport = Transport()
+            self.clients = list()
+
+        def open_sftp(self):
+            self.clients.append(Client(self.transport))
+            return self.clients[-1]
+    connection = Connection()
+    puts = list()
+    monkeypatch.setattr(fabrix.ioutil, 'connections', {'11.11.11.11': connection})
+    monkeypatch.setitem(env, "host_string", '11.11.11.11')
+    assert read_file('/first') == 'content of /first'
+    assert read_file('/second') == 'content of /second'
+    assert read_file('/failed', abort_on_error=False) is None
+    assert len(connection.clients) == 1
+    assert _sftp_put(StringIO.StringIO('content'), '/file') is True
+    assert _sftp_put(StringIO.StringIO('content'), '/failed') is False
+    assert len(connection.clients) == 1
+    assert read_file('~/.bashrc') == 'content of /home/user/.bashrc'
+    assert read_file('relative') == 'content of /home/user/relative'
+    with cd('/etc'):
+        assert read_file('hosts') == 'content of /etc/hosts'
+        assert _sftp_put(StringIO.StringIO('content'), 'file') is True
+    assert _sftp_put(StringIO.StringIO('content'), '~/file') is True
+    assert puts == ['/file', '/etc/file', '/home/user/file']
+    connection.clients[0].channel.closed = True
+    assert read_file('/third') == 'content of /third'
+    assert len(connection.clients) == 2
+    connection.transport.active = False
+    assert read_file('/fourth') == 'content of /fourth'
+    assert len(connection.clients) == 3
+    assert connection.clients[1].channel.closed is True
+    _close_sftp_session('11.11.11.11')
+    assert connection.clients[2].channel.closed is True
+    assert fabrix.ioutil._sftp_clients == {}
+    assert read_file('/fifth') == 'content of /fifth'
+    connection.close = lambda: None
+    fabrix.ioutil._stat_cache().store('/fifth', 'file')
+    fabrix.ioutil._memo_cache()['hostname'] = 'host'
+    fabrix.ioutil._content_caches[fabrix.ioutil._prefetch_scope()] = {'/fifth': 'content of /fifth'}
+    _disconnect('11.11.11.11')
+    assert connection.clients[3].channel.closed is True
+    assert fabrix.ioutil.connections == {}
+    assert fabrix.ioutil._sftp_clients == {}
+    assert fabrix.ioutil._stat_caches == {}
+    assert fabrix.ioutil._memo_caches == {}
+    assert fabrix.ioutil._content_caches == {}
+
+
+def test_iter_file_lines(monkeypatch):
+    class RemoteFile(StringIO.StringIO):
+        def stat(self):
+            class Attributes(object):
+                st_size = len(self.getvalue())
+            return Attributes()
+
+    class Client(object):
+        def open(self, remote_path, mode):
+            assert mode == 'r'
+            if remote_path == '/failed':
+                raise IOError('No such file')
+            return RemoteFile('first\nsecond line\n\nfourth\nlast')
+    monkeypatch.setattr(fabrix.ioutil, '_sftp', lambda: Client())
+    monkeypatch.setitem(env, "host_string", '11.11.11.11')
+    lines = ['first', 'second line', '', 'fourth', 'last']
+    for chunk_size in (1, 2, 3, 7, 100):
+        assert list(iter_file_lines('/file', chunk_size=chunk_size)) == lines
+        assert list(iter_file_lines('/file', chunk_size=chunk_size, offset=6)) == lines[1:]
+        assert list(iter_file_lines('/file', chunk_size=chunk_size, offset=-10)) == lines[4:]
+        assert list(iter_file_lines('/file', chunk_size=chunk_size, offset=-11)) == lines[3:]
+        assert list(iter_file_lines('/file', chunk_size=chunk_size, offset=-12)) == lines[2:]
+        assert list(iter_file_lines('/file', chunk_size=chunk_size, offset=-4)) == lines[4:]
+        assert list(iter_file_lines('/file', chunk_size=chunk_size, offset=-3)) == []
+        assert list(iter_file_lines('/file', chunk_size=chunk_size, offset=-1000)) == lines
+    with abort(r'iter_file_lines: remote filename must be absolute, "relative" given in file .* line .*'):
+        iter_file_lines('relative')
+    with abort(r'downloading file /failed from host 11.11.11.11 failed'):
+        list(iter_file_lines('/failed'))
+
+
 def test_write_file(monkeypatch):
     get_state = {
         r'/ok': {'content': "ok-text", 'failed': False},
@@ -198,123 +325,210 @@ def test_write_file(monkeypatch):
     }
     mock_get = mock_get_factory(get_state)
     monkeypatch.setitem(env, "host_string", '11.11.11.11')
-    monkeypatch.setattr(fabrix.ioutil, 'get', mock_get)
-    monkeypatch.setattr(fabrix.ioutil, '_atomic_write_file', lambda x, y: None)
+    monkeypatch.setattr(fabrix.ioutil, '_sftp_get', mock_get)
+    monkeypatch.setattr(fabrix.ioutil, '_atomic_write_file', lambda x, y, z: None)
     assert write_file('/ok', 'ok-text') is False
     assert write_file('/ok', 'other-text') is True
     assert write_file('/failed', "text") is True
     assert write_file('/failed', None) is False
 
 
-def test__atomic_write_file(monkeypatch):
-    put_state = {
-        r'/newfile-put-ok\.tmp\.\w+\.tmp$': False,
-        r'/newfile-put-failed\.tmp\.\w+\.tmp$': True,
-        r'/1hardlink\.tmp\.\w+\.tmp$': False,
-    }
-    mock_put = mock_put_factory(put_state)
-    monkeypatch.setattr(fabrix.ioutil, 'put', mock_put)
+def test_write_file_checksum(monkeypatch):
+    digest = hashlib.sha256('ok-text').hexdigest()
+    unicode_digest = hashlib.sha256(u'\u0442\u0435\u043a\u0441\u0442'.encode('utf-8')).hexdigest()
     run_state = {
-            r'if \[ -e /isnotfile \] ; then echo exists ; fi': {'stdout': 'exists', 'failed': False},
-            r'if \[ ! -f /isnotfile \] ; then echo isnotfile ; fi': {'stdout': 'isnotfile', 'failed': False},
-
-            r'if \[ -e /7hardlinks \] ; then echo exists ; fi': {'stdout': 'exists', 'failed': False},
-            r'if \[ ! -f /7hardlinks \] ; then echo isnotfile ; fi': {'stdout': '', 'failed': False},
-            r'stat --format "%h" -- /7hardlinks': {'stdout': '7', 'failed': False},
-
-            r'if \[ -e /newfile-put-ok \] ; then echo exists ; fi': {'stdout': '', 'failed': False},
-            r'mv -f -- /newfile-put-ok\.tmp\.\w+\.tmp /newfile-put-ok': {'stdout': '', 'failed': False},
-            r'if \[ -e /newfile-put-failed \] ; then echo exists ; fi': {'stdout': '', 'failed': False},
-
-            r'if \[ -e /1hardlink \] ; then echo exists ; fi': {'stdout': 'exists', 'failed': False},
-            r'if \[ ! -f /1hardlink \] ; then echo isnotfile ; fi': {'stdout': '', 'failed': False},
-            r'stat --format "%h" -- /1hardlink': {'stdout': '1', 'failed': False},
-            r'mv -f -- /1hardlink\.tmp\.\w+\.tmp /1hardlink': {'stdout': '', 'failed': False},
-            r'cp --attributes-only --preserve=xattr -- .* .*': {'stdout': '', 'failed': False},
+        r'if \[ -f /ok \] ; then sha256sum < /ok ; fi': {'stdout': digest + '  -', 'failed': False},
+        r'if \[ -f /none \] ; then sha256sum < /none ; fi': {'stdout': '', 'failed': False},
+        r'if \[ -f /failed \] ; then sha256sum < /failed ; fi': {'stdout': 'Permission denied', 'failed': True},
+        r'if \[ -f /unicode \] ; then sha256sum < /unicode ; fi': {'stdout': unicode_digest + '  -', 'failed': False},
     }
-    mock_run = mock_run_factory(run_state)
-    monkeypatch.setattr(fabrix.ioutil, 'run', mock_run)
+    monkeypatch.setattr(fabrix.ioutil, 'run', mock_run_factory(run_state))
+    monkeypatch.setattr(fabrix.ioutil, '_sftp_get', None)
+    monkeypatch.setattr(fabrix.ioutil, '_atomic_write_file', lambda x, y: None)
+    with abort('remote filename must be absolute, "ok" given'):
+        write_file('ok', 'ok-text', checksum=True)
+    assert write_file('/ok', 'ok-text', checksum=True) is False
+    assert write_file('/ok', 'other-text', checksum=True) is True
+    assert write_file('/none', 'ok-text', checksum=True) is True
+    assert write_file('/failed', 'ok-text', checksum=True) is True
+    assert write_file('/unicode', u'\u0442\u0435\u043a\u0441\u0442', checksum=True) is False
+
+
+def test__atomic_write_file(tmpdir, monkeypatch):
+    commands = list()
+    monkeypatch.setattr(fabric.api, 'run', mock_run_shell_factory(commands))
+    monkeypatch.setitem(env, "host_string", '11.11.11.11')
     with abort('remote filename must be absolute, "%s" given' % 'not-absolute-path'):
         _atomic_write_file('not-absolute-path', 'text')
-    with abort('remote filename must be regular file, "%s" given' % '/isnotfile'):
-        _atomic_write_file('/isnotfile', 'text')
-    with abort('file "%s" has %d hardlinks, it can\'t be atomically written' % ('/7hardlinks', 7)):
-        _atomic_write_file('/7hardlinks', 'text')
-    assert _atomic_write_file('/newfile-put-ok', 'text') is None
-    with abort(r'uploading file /newfile-put-failed\.tmp\.\w+\.tmp to host .* failed'):
-        _atomic_write_file('/newfile-put-failed', 'text')
-
-    def mock__copy_file_owner_and_mode(old_filename, new_filename):
-        pass
-    monkeypatch.setattr(fabrix.ioutil, '_copy_file_owner_and_mode', mock__copy_file_owner_and_mode)
-
-    def mock__copy_file_acl(old_filename, new_filename):
-        pass
-    monkeypatch.setattr(fabrix.ioutil, '_copy_file_acl', mock__copy_file_acl)
-
-    def mock__copy_file_selinux_context(old_filename, new_filename):
-        pass
-    monkeypatch.setattr(fabrix.ioutil, '_copy_file_selinux_context', mock__copy_file_selinux_context)
-    assert _atomic_write_file('/1hardlink', 'text') is None
-
-
-def test__copy_file_owner_and_mode(monkeypatch):
-    run_state = {
-            r'chown --reference=.* -- .*': {'stdout': '', 'failed': False},
-            r'chmod --reference=.* -- .*': {'stdout': '', 'failed': False},
-    }
-    mock_run = mock_run_factory(run_state)
-    monkeypatch.setattr(fabrix.ioutil, 'run', mock_run)
-    assert _copy_file_owner_and_mode('/old', '/new') is None
-
-
-def test__copy_file_acl(monkeypatch):
-    run_state = {
-            r'if \[ -e /usr/bin/getfacl \] && \[ -e /usr/bin/setfacl \] ; then echo exists ; fi': {'stdout': '', 'failed': False},
-    }
-    mock_run = mock_run_factory(run_state)
-    monkeypatch.setattr(fabrix.ioutil, 'run', mock_run)
-    assert _copy_file_acl('/old', '/new') is None
-    run_state = {
-            r'if \[ -e /usr/bin/getfacl \] && \[ -e /usr/bin/setfacl \] ; then echo exists ; fi': {'stdout': 'exists', 'failed': False},
-            r'getfacl --absolute-names -- .* | setfacl --set-file=- -- .*': {'stdout': '', 'failed': False},
-    }
-    mock_run = mock_run_factory(run_state)
-    monkeypatch.setattr(fabrix.ioutil, 'run', mock_run)
-    assert _copy_file_acl('/old', '/new') is None
-
-
-def test__copy_file_selinux_context(monkeypatch):
-    run_state = {
-            r'if \[ -e /usr/sbin/getenforce \] ; then echo exists ; fi': {'stdout': '', 'failed': False},
-    }
-    mock_run = mock_run_factory(run_state)
-    monkeypatch.setattr(fabrix.ioutil, 'run', mock_run)
-    assert _copy_file_selinux_context('/old', '/new') is None
-    run_state = {
-            r'if \[ -e /usr/sbin/getenforce \] ; then echo exists ; fi': {'stdout': 'exists', 'failed': False},
-            r'getenforce': {'stdout': 'Disabled', 'failed': False},
-    }
-    mock_run = mock_run_factory(run_state)
-    monkeypatch.setattr(fabrix.ioutil, 'run', mock_run)
-    assert _copy_file_selinux_context('/old', '/new') is None
-    run_state = {
-            r'if \[ -e /usr/sbin/getenforce \] ; then echo exists ; fi': {'stdout': 'exists', 'failed': False},
-            r'getenforce': {'stdout': 'Enabled', 'failed': False},
-            r'if \[ -e /usr/bin/chcon \] ; then echo exists ; fi': {'stdout': '', 'failed': False},
-    }
-    mock_run = mock_run_factory(run_state)
-    monkeypatch.setattr(fabrix.ioutil, 'run', mock_run)
-    assert _copy_file_selinux_context('/old', '/new') is None
-    run_state = {
-            r'if \[ -e /usr/sbin/getenforce \] ; then echo exists ; fi': {'stdout': 'exists', 'failed': False},
-            r'getenforce': {'stdout': 'Enabled', 'failed': False},
-            r'if \[ -e /usr/bin/chcon \] ; then echo exists ; fi': {'stdout': 'exists', 'failed': False},
-            r'chcon --reference=.* -- .*': {'stdout': '', 'failed': False},
-    }
-    mock_run = mock_run_factory(run_state)
-    monkeypatch.setattr(fabrix.ioutil, 'run', mock_run)
-    assert _copy_file_selinux_context('/old', '/new') is None
+    directory = tmpdir.mkdir("directory")
+    with abort('remote filename must be regular file, "%s" given' % str(directory)):
+        _atomic_write_file(str(directory), 'text')
+    regular_file = tmpdir.join("regular-file")
+    regular_file.write("text")
+    tmpdir.join("hardlink").mklinkto(regular_file)
+    with abort('file "%s" has %d hardlinks, it can\'t be atomically written' % (str(regular_file), 2)):
+        _atomic_write_file(str(regular_file), 'text')
+    assert len(commands) == 2
+    assert sorted(tmpdir.listdir()) == sorted([directory, regular_file, tmpdir.join("hardlink")])
+    new_file = tmpdir.join("new-file")
+    assert _atomic_write_file(str(new_file), 'new text') is None
+    assert new_file.read() == 'new text'
+    old_file = tmpdir.join("old-file")
+    old_file.write("old text")
+    old_file.chmod(0640)
+    assert _atomic_write_file(str(old_file), '') is None
+    assert old_file.read() == ''
+    assert old_file.stat().mode & 0777 == 0640
+    assert len(commands) == 4
+    put_state = {
+        r'.*/old-file\.tmp\.\w+\.tmp$': False,
+        r'.*/put-failed\.tmp\.\w+\.tmp$': True,
+    }
+    monkeypatch.setattr(fabrix.ioutil, '_sftp_put', mock_put_factory(put_state))
+    large_content = 'x' * (fabrix.ioutil._INLINE_CONTENT_LIMIT + 1)
+    with abort(r'uploading file .*/put-failed\.tmp\.\w+\.tmp to host .* failed'):
+        _atomic_write_file(str(tmpdir.join("put-failed")), large_content)
+    with abort(r'uploading file .*/old-file\.tmp\.\w+\.tmp to host .* failed'):
+        _atomic_write_file(str(old_file), large_content)
+    assert old_file.read() == ''
+    assert len(commands) == 5
+
+
+def test_sync_files(tmpdir, monkeypatch):
+    import grp
+    import pwd
+    commands = list()
+    monkeypatch.setattr(fabric.api, 'run', mock_run_shell_factory(commands))
+    monkeypatch.setitem(env, "host_string", '11.11.11.11')
+    fabfile = tmpdir.join("fabfile.py")
+    fabfile.write("")
+    monkeypatch.setitem(env, "real_fabfile", str(fabfile))
+    files_dir = tmpdir.mkdir("files")
+    files_dir.join("first").write("first content")
+    files_dir.join("second").write("second content")
+    files_dir.join("large").write("x" * (fabrix.ioutil._INLINE_CONTENT_LIMIT * 4))
+    remote_dir = tmpdir.mkdir("remote")
+    owner = pwd.getpwuid(os.getuid()).pw_name + ':' + grp.getgrgid(os.getgid()).gr_name
+    remote_dir.join("second").write("second content")
+    remote_dir.join("second").chmod(0600)
+    manifest = [
+        ('first', str(remote_dir.join("first")), 0640, owner),
+        ('second', str(remote_dir.join("second")), '0644'),
+        ('second', str(remote_dir.join("third"))),
+    ]
+    assert sync_files(manifest) == {str(remote_dir.join(name)): True for name in ('first', 'second', 'third')}
+    assert len(commands) == 2
+    assert remote_dir.join("first").read() == "first content"
+    assert remote_dir.join("first").stat().mode & 0777 == 0640
+    assert remote_dir.join("second").stat().mode & 0777 == 0644
+    assert remote_dir.join("third").read() == "second content"
+    assert sorted([path.basename for path in remote_dir.listdir()]) == ['first', 'second', 'third']
+    assert sync_files(manifest) == {str(remote_dir.join(name)): False for name in ('first', 'second', 'third')}
+    assert len(commands) == 3
+    numeric_owner = '%d:%d' % (os.getuid(), os.getgid())
+    assert sync_files([('first', str(remote_dir.join("first")), 0640, numeric_owner)]) == {str(remote_dir.join("first")): False}
+    assert sync_files([('first', str(remote_dir.join("first")), 0640, str(os.getuid()))]) == {str(remote_dir.join("first")): False}
+    assert len(commands) == 5
+    assert sync_files([]) == {}
+    assert len(commands) == 5
+
+    def mock_put(local_path, remote_path):
+        with open(remote_path, 'wb') as remote_file:
+            remote_file.write(local_path.read())
+        return True
+    monkeypatch.setattr(fabrix.ioutil, '_sftp_put', mock_put)
+    files_dir.join("first").write("new first content")
+    manifest = [('first', str(remote_dir.join("first"))), ('large', str(remote_dir.join("large")))]
+    assert sync_files(manifest) == {str(remote_dir.join("first")): True, str(remote_dir.join("large")): True}
+    assert len(commands) == 7
+    assert remote_dir.join("first").read() == "new first content"
+    assert remote_dir.join("first").stat().mode & 0777 == 0640
+    assert remote_dir.join("large").read() == "x" * (fabrix.ioutil._INLINE_CONTENT_LIMIT * 4)
+    assert not [name for name in os.listdir('/tmp') if name.startswith('fabrix.') and name.endswith('.tar.gz')]
+    with abort(r'sync_files: file \'.*/files/not-exists\' not exists in file .* line .*'):
+        sync_files([('not-exists', '/remote')])
+    with abort(r'sync_files: remote path \'relative\' must be absolute in file .* line .*'):
+        sync_files([('first', 'relative')])
+    with abort(r'sync_files: bad manifest entry .* in file .* line .*'):
+        sync_files(['first'])
+    with abort(r'sync_files: mode \'u\+x\' must be octal in file .*test_ioutil.py line .*'):
+        sync_files([('first', '/remote', 'u+x')])
+    with abort('remote filename must be regular file, "%s" given' % str(files_dir)):
+        sync_files([('first', str(files_dir))])
+
+
+def test_memoize(monkeypatch):
+    commands = list()
+
+    def mock_run(command, **kwargs):
+        commands.append((env.host_string, command))
+        result = fabric.operations._AttributeString(command + ' output %d' % len(commands))
+        result.succeeded = command != 'failed'
+        result.failed = not result.succeeded
+        return result
+    monkeypatch.setattr(fabric.api, 'run', mock_run)
+    monkeypatch.setitem(env, "host_string", '11.11.11.11')
+    memoize('getent passwd', 'getent group', 'failed')
+    assert run('getent passwd') == 'getent passwd output 1'
+    assert run('getent passwd') == 'getent passwd output 1'
+    assert run('getent group') == 'getent group output 2'
+    assert memo_cache_stats() == {'hits': 1, 'misses': 2}
+    monkeypatch.setitem(env, "host_string", '11.11.11.12')
+    assert run('getent passwd') == 'getent passwd output 3'
+    monkeypatch.setitem(env, "host_string", '11.11.11.11')
+    assert run('getent group') == 'getent group output 2'
+    assert run('useradd user') == 'useradd user output 4'
+    assert run('getent passwd') == 'getent passwd output 5'
+    assert run('getent passwd', warn_only=True) == 'getent passwd output 6'
+    assert run('getent passwd') == 'getent passwd output 5'
+    clear_memo_cache()
+    assert run('getent passwd') == 'getent passwd output 7'
+    with settings(fabric.api.cd('/tmp')):
+        assert run('getent passwd') == 'getent passwd output 8'
+    assert run('failed') == 'failed output 9'
+    assert run('failed') == 'failed output 10'
+    monkeypatch.setitem(env, "host_string", '11.11.11.12')
+    assert run('getent passwd') == 'getent passwd output 3'
+    assert memo_cache_stats() == {'hits': 4, 'misses': 7}
+    create_file('/new')
+    assert run('getent passwd') == 'getent passwd output %d' % len(commands)
+    assert memo_cache_stats() == {'hits': 4, 'misses': 8}
+
+
+def test__delta_segments():
+    old = "line1\nline2\nline3\nline4\n"
+    assert _delta_segments(old, old) == [('copy', 0, 24)]
+    assert _delta_segments(old, "line1\nline2\nnew\nline3\nline4\n") == [('copy', 0, 12), ('literal', 'new\n'), ('copy', 12, 12)]
+    assert _delta_segments(old, "line1\nline4\n") == [('copy', 0, 6), ('copy', 18, 6)]
+    assert _delta_segments(old, "LINE1\nline2\nline3\nLINE4") == [('literal', 'LINE1\n'), ('copy', 6, 12), ('literal', 'LINE4')]
+    assert _delta_segments("", "text") == [('literal', 'text')]
+
+
+def test__atomic_write_file_delta(tmpdir, monkeypatch):
+    commands = list()
+    monkeypatch.setattr(fabric.api, 'run', mock_run_shell_factory(commands))
+    monkeypatch.setitem(env, "host_string", '11.11.11.11')
+    uploads = list()
+
+    def mock_put(local_path, remote_path):
+        uploads.append(remote_path)
+        with open(remote_path, 'w') as remote_file:
+            remote_file.write(local_path.getvalue())
+        return True
+    monkeypatch.setattr(fabrix.ioutil, '_sftp_put', mock_put)
+    old_content = ''.join(['line %d\n' % index for index in range(10000)])
+    new_content = old_content.replace('line 10\n', 'line ten\n').replace('line 9000\n', '') + 'last line\n'
+    remote_file = tmpdir.join("remote-file")
+    remote_file.write(old_content)
+    _atomic_write_file(str(remote_file), new_content, old_content)
+    assert remote_file.read() == new_content
+    assert not uploads
+    assert len(commands) == 1
+    assert len(commands[0]) < 5000
+    _atomic_write_file(str(remote_file), new_content + 'one more line\n', old_content)
+    assert remote_file.read() == new_content + 'one more line\n'
+    assert len(uploads) == 1
+    assert len(commands) == 3
 
 
 def test_copy_file(tmpdir, monkeypatch):
@@ -330,10 +544,11 @@ def test_copy_file(tmpdir, monkeypatch):
     monkeypatch.setattr(fabrix.ioutil, 'read_file', lambda remote_filename, abort_on_error: "old content")
     with abort('remote filename must be absolute, ".*" given'):
         copy_file("file", "remote-file-name")
-    monkeypatch.setattr(fabrix.ioutil, 'write_file', lambda remote_filename, new_content: True)
+    monkeypatch.setattr(fabrix.ioutil, 'write_file', lambda remote_filename, new_content, checksum: True)
     assert copy_file("file", "/path/to/remote/file") is True
-    monkeypatch.setattr(fabrix.ioutil, 'write_file', lambda remote_filename, new_content: False)
+    monkeypatch.setattr(fabrix.ioutil, 'write_file', lambda remote_filename, new_content, checksum: checksum)
     assert copy_file("file", "/path/to/remote/file") is False
+    assert copy_file("file", "/path/to/remote/file", checksum=True) is True
 
 
 def test_rsync(tmpdir, monkeypatch):
@@ -350,13 +565,13 @@ def test_rsync(tmpdir, monkeypatch):
     with abort('rsync: remote path \'.*\' must be absolute in file .* line .*'):
         rsync("file", "remote-file-name")
     local_state = {
-        r'rsync -aH --stats --force --timeout=600 -e \'ssh -p 2222\' .* -- .* \w+@11.11.11.11:/path/to/changed':
+        r'rsync -aH --stats --force --timeout=600 -e \'ssh -p 2222 -o ControlMaster=auto .*\' .* -- .* \w+@11.11.11.11:/path/to/changed':
             {'stdout': 'Total transferred file size: 12345 bytes', 'failed': False},
-        r'rsync -aH --stats --force --timeout=600 -e \'ssh -p 22\' .* -- .* \w+@11.11.11.11:/path/to/not-changed':
+        r'rsync -aH --stats --force --timeout=600 -e \'ssh -p 22 -o ControlMaster=auto .*\' .* -- .* \w+@11.11.11.11:/path/to/not-changed':
             {'stdout': 'Total transferred file size: 0 bytes', 'failed': False},
-        r'rsync -aH --stats --force --timeout=600 -e \'ssh -p 7723\' .* -- .* \w+@\[fdff::ffff:ffff:ffff\]:/path/to/not-changed-ipv6':
+        r'rsync -aH --stats --force --timeout=600 -e \'ssh -p 7723 -o ControlMaster=auto .*\' .* -- .* \w+@\[fdff::ffff:ffff:ffff\]:/path/to/not-changed-ipv6':
             {'stdout': 'Total transferred file size: 0 bytes', 'failed': False},
-        r'rsync -aH --stats --force --timeout=600 -e \'ssh -p 22 -i /path/to/id_rsa\' .* -- .* \w+@11.11.11.11:/path/to/not-changed-with-ssh-key':
+        r'rsync -aH --stats --force --timeout=600 -e \'ssh -p 22 -i /path/to/id_rsa -o .*\' .* -- .* \w+@11.11.11.11:/path/to/not-changed-with-ssh-key':
             {'stdout': 'Total transferred file size: 0 bytes', 'failed': False},
     }
     mock_local = mock_local_factory(local_state)
@@ -370,6 +585,95 @@ def test_rsync(tmpdir, monkeypatch):
     with settings(key_filename="/path/to/id_rsa"):
         monkeypatch.setitem(env, "host_string", '11.11.11.11')
         assert rsync("file", "/path/to/not-changed-with-ssh-key") is False
+    control_dir = fabrix.ioutil._ssh_control_dir
+    assert os.path.isdir(control_dir)
+    user = env.user
+    assert fabrix.ioutil._ssh_control_masters == set([(user, '11.11.11.11', '2222'), (user, '11.11.11.11', '22'),
+                                                      ('root', 'fdff::ffff:ffff:ffff', '7723')])
+    calls = list()
+    monkeypatch.setattr(fabrix.ioutil.subprocess, 'call', lambda args, **kwargs: calls.append(args))
+    fabrix.ioutil._close_ssh_masters()
+    assert len(calls) == 3
+    assert ['ssh', '-p', '2222', '-o', 'ControlPath=' + control_dir + '/%C', '-O', 'exit', user + '@11.11.11.11'] in calls
+    assert not os.path.exists(control_dir)
+    assert fabrix.ioutil._ssh_control_masters == set()
+
+
+RSYNC_STATS = """
+Number of files: 3 (reg: 2, dir: 1)
+Number of created files: 0
+Number of deleted files: 0
+Number of regular files transferred: 2
+Total file size: 12,345 bytes
+Total transferred file size: 1,234 bytes
+Literal data: 1,000 bytes
+Matched data: 234 bytes
+File list size: 0
+Total bytes sent: 1,189
+Total bytes received: 35
+
+sent 1,189 bytes  received 35 bytes  2,448.00 bytes/sec
+total size is 12,345  speedup is 10.09
+"""
+
+
+def test_rsync_stats(tmpdir, monkeypatch):
+    fabfile = tmpdir.join("fabfile.py")
+    monkeypatch.setitem(env, "real_fabfile", str(fabfile))
+    monkeypatch.setitem(env, "host_string", '11.11.11.11')
+    tmpdir.mkdir("files").join("file").write("content")
+    local_state = {
+        r'rsync .*:/path/to/changed': {'stdout': RSYNC_STATS, 'failed': False},
+        r'rsync .*:/path/to/not-changed': {'stdout': 'Number of files transferred: 0\nTotal transferred file size: 0 bytes', 'failed': False},
+    }
+    monkeypatch.setattr(fabrix.ioutil, 'local', mock_local_factory(local_state))
+    result = rsync("file", "/path/to/changed", stats=True)
+    assert result
+    assert result.changed is True
+    assert result.local_path == str(tmpdir.join("files").join("file"))
+    assert result.remote_path == "/path/to/changed"
+    assert result.files_transferred == 2
+    assert result.total_transferred_file_size == 1234
+    assert result.literal_data == 1000
+    assert result.matched_data == 234
+    assert result.bytes_sent == 1189
+    assert result.bytes_received == 35
+    assert result.elapsed >= 0
+    assert 'changed=True' in repr(result)
+    result = rsync("file", "/path/to/not-changed", stats=True)
+    assert not result
+    assert result.files_transferred == 0
+    assert rsync("file", "/path/to/changed") is True
+
+
+def test_rsync_parallel(tmpdir, monkeypatch):
+    fabfile = tmpdir.join("fabfile.py")
+    monkeypatch.setitem(env, "real_fabfile", str(fabfile))
+    monkeypatch.setitem(env, "host_string", '11.11.11.11')
+    files_dir = tmpdir.mkdir("files")
+    for filename in ('first', 'second', 'third'):
+        files_dir.join(filename).write(filename)
+    bin_dir = tmpdir.mkdir("bin")
+    fake_rsync = bin_dir.join("rsync")
+    fake_rsync.write('#!/bin/bash\n'
+                     'for arg ; do remote="$arg" ; done\n'
+                     'if [ "${remote##*:}" = /failed ] ; then echo failure ; exit 23 ; fi\n'
+                     'echo "Number of regular files transferred: ${#remote}"\n'
+                     'echo "Total transferred file size: 0 bytes"\n')
+    fake_rsync.chmod(0755)
+    monkeypatch.setenv('PATH', str(bin_dir) + ':' + os.environ['PATH'])
+    paths = [('first', '/path/to/first'), ('second', '/path/second'), ('third', '/third')]
+    results = rsync_parallel(paths, max_processes=2)
+    assert [result.remote_path for result in results] == ['/path/to/first', '/path/second', '/third']
+    assert [result.files_transferred for result in results] == [len('11.11.11.11:' + path[1]) + len(env.user) + 1 for path in paths]
+    assert [result.changed for result in results] == [False, False, False]
+    assert rsync_parallel([]) == []
+    with abort(r'rsync_parallel: command \'rsync .*:/failed\' received nonzero return code 23:\nfailure'):
+        rsync_parallel([('first', '/failed'), ('second', '/second')], max_processes=1)
+    with abort(r'rsync_parallel: max_processes must be positive, 0 given in file .* line .*'):
+        rsync_parallel(paths, max_processes=0)
+    with abort(r'rsync_parallel: local path \'.*/not-exists\' not exists in file .*test_ioutil.py line .*'):
+        rsync_parallel([('not-exists', '/path')])
 
 
 def test_chown(tmpdir, monkeypatch):
@@ -458,8 +762,8 @@ def test_is_file_exists(monkeypatch):
     with abort('remote filename must be absolute, .*'):
         is_file_exists("file")
     run_state = {
-        r'if \[ -f /path/to/file \] ; then echo exists ; fi': {'stdout': 'exists', 'failed': False},
-        r'if \[ -f /path/to/none \] ; then echo exists ; fi': {'stdout': '', 'failed': False},
+        r'if \[ -f /path/to/file \] ; then echo f ; elif \[ -d /path/to/file \] ; .*': {'stdout': 'f', 'failed': False},
+        r'if \[ -f /path/to/none \] ; then echo f ; elif \[ -d /path/to/none \] ; .*': {'stdout': 'n', 'failed': False},
     }
     mock_run = mock_run_factory(run_state)
     monkeypatch.setattr(fabrix.ioutil, 'run', mock_run)
@@ -471,8 +775,8 @@ def test_is_file_not_exists(monkeypatch):
     with abort('remote filename must be absolute, .*'):
         is_file_not_exists("file")
     run_state = {
-        r'if \[ ! -f /path/to/none \] ; then echo notexists ; fi': {'stdout': 'notexists', 'failed': False},
-        r'if \[ ! -f /path/to/file \] ; then echo notexists ; fi': {'stdout': '', 'failed': False},
+        r'if \[ -f /path/to/none \] ; then echo f ; elif \[ -d /path/to/none \] ; .*': {'stdout': 'n', 'failed': False},
+        r'if \[ -f /path/to/file \] ; then echo f ; elif \[ -d /path/to/file \] ; .*': {'stdout': 'f', 'failed': False},
     }
     mock_run = mock_run_factory(run_state)
     monkeypatch.setattr(fabrix.ioutil, 'run', mock_run)
@@ -484,8 +788,8 @@ def test_is_directory_exists(monkeypatch):
     with abort('remote dirname must be absolute, .*'):
         is_directory_exists("dir")
     run_state = {
-        r'if \[ -d /path/to/dire \] ; then echo exists ; fi': {'stdout': 'exists', 'failed': False},
-        r'if \[ -d /path/to/none \] ; then echo exists ; fi': {'stdout': '', 'failed': False},
+        r'if \[ -f /path/to/dire \] ; then echo f ; elif \[ -d /path/to/dire \] ; .*': {'stdout': 'd', 'failed': False},
+        r'if \[ -f /path/to/none \] ; then echo f ; elif \[ -d /path/to/none \] ; .*': {'stdout': 'n', 'failed': False},
     }
     mock_run = mock_run_factory(run_state)
     monkeypatch.setattr(fabrix.ioutil, 'run', mock_run)
@@ -497,10 +801,202 @@ def test_is_directory_not_exists(monkeypatch):
     with abort('remote dirname must be absolute, .*'):
         is_directory_not_exists("dir")
     run_state = {
-        r'if \[ ! -d /path/to/none \] ; then echo notexists ; fi': {'stdout': 'notexists', 'failed': False},
-        r'if \[ ! -d /path/to/dire \] ; then echo notexists ; fi': {'stdout': '', 'failed': False},
+        r'if \[ -f /path/to/none \] ; then echo f ; elif \[ -d /path/to/none \] ; .*': {'stdout': 'n', 'failed': False},
+        r'if \[ -f /path/to/dire \] ; then echo f ; elif \[ -d /path/to/dire \] ; .*': {'stdout': 'd', 'failed': False},
     }
     mock_run = mock_run_factory(run_state)
     monkeypatch.setattr(fabrix.ioutil, 'run', mock_run)
     assert is_directory_not_exists('/path/to/none') is True
     assert is_directory_not_exists('/path/to/dire') is False
+
+
+def test_stat_cache(tmpdir, monkeypatch):
+    commands = list()
+    monkeypatch.setattr(fabric.api, 'run', mock_run_shell_factory(commands))
+    monkeypatch.setitem(env, "host_string", '11.11.11.11')
+    with abort('fill_stat_cache: remote path \'dir\' must be absolute in file .* line .*'):
+        fill_stat_cache('dir')
+    tmpdir.join("file").write("text")
+    tmpdir.mkdir("dir").join("file").write("text")
+    directory = str(tmpdir.join("dir"))
+    fill_stat_cache(str(tmpdir), str(tmpdir.join("none")))
+    assert len(commands) == 1
+    assert is_file_exists(str(tmpdir.join("file"))) is True
+    assert is_directory_exists(directory) is True
+    assert is_file_not_exists(str(tmpdir.join("none"))) is True
+    assert is_file_not_exists(str(tmpdir.join("other"))) is True
+    assert is_directory_not_exists(str(tmpdir.join("none").join("file"))) is True
+    assert len(commands) == 2
+    assert is_directory_not_exists(str(tmpdir.join("none").join("file"))) is True
+    assert remove_file(str(tmpdir.join("none"))) is False
+    assert create_directory(directory) is False
+    assert remove_directory(str(tmpdir.join("file"))) is False
+    assert len(commands) == 2
+    assert create_directory(str(tmpdir.join("new"))) is True
+    assert create_file(str(tmpdir.join("new").join("file"))) is True
+    assert is_directory_exists(str(tmpdir.join("new"))) is True
+    assert is_file_exists(str(tmpdir.join("new").join("file"))) is True
+    assert len(commands) == 4
+    assert remove_file(str(tmpdir.join("file"))) is True
+    assert is_file_exists(str(tmpdir.join("file"))) is False
+    assert len(commands) == 5
+    run('touch ' + str(tmpdir.join("file")))
+    assert is_file_exists(str(tmpdir.join("file"))) is True
+    assert len(commands) == 7
+    clear_stat_cache()
+    assert is_file_exists(str(tmpdir.join("file"))) is True
+    assert len(commands) == 8
+    fill_stat_cache(directory)
+    with batch():
+        created = create_file(str(tmpdir.join("dir").join("new")))
+        exists = is_file_exists(str(tmpdir.join("dir").join("new")))
+        not_changed = create_directory(directory)
+    assert created.value is True
+    assert exists.value is True
+    assert not_changed.value is False
+    assert len(commands) == 10
+    assert is_file_exists(str(tmpdir.join("dir").join("new"))) is True
+    assert len(commands) == 10
+
+
+def test_batch(tmpdir, monkeypatch):
+    commands = list()
+    monkeypatch.setattr(fabric.api, 'run', mock_run_shell_factory(commands))
+    monkeypatch.setitem(env, "host_string", '11.11.11.11')
+    directory = str(tmpdir.join("dir"))
+    filename = str(tmpdir.join("dir").join("file"))
+    with batch():
+        created1 = create_directory(directory)
+        created2 = create_file(filename)
+        exists = is_file_exists(filename)
+        changed = chmod(filename, 0600)
+        stdout = run('echo one ; echo two')
+        assert not commands
+    assert len(commands) == 1
+    assert created1.value is True
+    assert created2.value is True
+    assert exists.value is True
+    assert changed.value is True
+    assert stdout.value == 'one\ntwo'
+    assert stdout.value.succeeded is True
+    assert os.path.isfile(filename)
+    with batch():
+        created = create_directory(directory)
+        if created:
+            pass
+        assert len(commands) == 2
+        removed = remove_file(filename)
+        assert len(commands) == 2
+    assert len(commands) == 3
+    assert created.value is False
+    assert removed.value is True
+    with batch():
+        with settings(warn_only=True):
+            failed = run('exit 3')
+        not_executed = run('false')
+        with abort(r'batch: command \'false\' received nonzero return code 1 on host 11\.11\.11\.11'):
+            assert not_executed.value is None
+    assert failed.value.failed is True
+    assert failed.value.return_code == 3
+    with batch():
+        first = run('echo one')
+        second = run('echo two')
+        assert 'on' in first
+        assert len(commands) == 5
+    assert first + second == 'onetwo'
+    assert 'x' + first == 'xone'
+    assert list(first) == ['o', 'n', 'e']
+    assert len(first) == 3 and first[0] == 'o' and first < second and first.upper() == 'ONE'
+    assert '%s!' % first == 'one!'
+    assert {first: 1}['one'] == 1
+    with batch():
+        number = run('echo 3')
+    assert int(number) + 1 == 4
+    with batch():
+        assert is_file_exists(filename) == is_file_exists(directory)
+    with batch():
+        with settings(warn_only=True):
+            run('echo queued')
+        assert len(commands) == 7
+        assert run('echo direct', pty=False) == 'direct'
+        assert len(commands) == 9
+
+
+def test_prefetch_files(tmpdir, monkeypatch):
+    commands = list()
+    monkeypatch.setattr(fabric.api, 'run', mock_run_shell_factory(commands))
+    monkeypatch.setitem(env, "host_string", '11.11.11.11')
+    remote_dir = tmpdir.mkdir("remote")
+    remote_dir.join("first").write("first=1\n")
+    remote_dir.join("second").write("second=2\n")
+    first, second, missing = str(remote_dir.join("first")), str(remote_dir.join("second")), str(remote_dir.join("missing"))
+    with prefetch_files(first, second, missing):
+        assert len(commands) == 1
+        assert read_file(first) == "first=1\n"
+        assert read_file(second) == "second=2\n"
+        assert len(commands) == 1
+        assert edit_file(first, replace_line(r'first=.*', 'first=10')) is True
+        assert len(commands) == 2
+        assert remote_dir.join("first").read() == "first=10\n"
+        assert read_file(first) == "first=10\n"
+        assert len(commands) == 2
+    assert fabrix.ioutil._content_caches == {}
+    with prefetch_files(first, second, write_back=True):
+        assert edit_file(first, replace_line(r'first=.*', 'first=100')) is True
+        assert edit_file(second, replace_line(r'second=.*', 'second=200')) is True
+        assert edit_file(second, replace_line(r'second=.*', 'second=200')) is False
+        assert read_file(second) == "second=200\n"
+        assert remote_dir.join("first").read() == "first=10\n"
+        assert len(commands) == 3
+    assert len(commands) == 4
+    assert remote_dir.join("first").read() == "first=100\n"
+    assert remote_dir.join("second").read() == "second=200\n"
+    with prefetch_files(first, write_back=True):
+        write_file(first, "first=1000\n")
+        run('true')
+        assert remote_dir.join("first").read() == "first=1000\n"
+        assert len(commands) == 7
+        assert fabrix.ioutil._content_cache() == {}
+    try:
+        with prefetch_files(first, write_back=True):
+            write_file(first, "discarded\n")
+            raise RuntimeError()
+    except RuntimeError:
+        pass
+    assert remote_dir.join("first").read() == "first=1000\n"
+    assert fabrix.ioutil._write_backs == {}
+
+    def mock_get(local_path, remote_path):
+        if not os.path.isfile(remote_path):
+            return False
+        with open(remote_path) as remote_file:
+            local_path.write(remote_file.read())
+        return True
+    monkeypatch.setattr(fabrix.ioutil, '_sftp_get', mock_get)
+    with prefetch_files(first, second):
+        assert remove_file(second) is True
+        assert read_file(second, abort_on_error=False) is None
+    remote_dir.join("second").write("second=2\n")
+    with prefetch_files(first, second, write_back=True):
+        write_file(second, "second=20\n")
+        assert remove_file(second) is True
+        assert read_file(second, abort_on_error=False) is None
+        write_file(first, "first=1\n")
+        assert write_file(first, "first=1\n", checksum=True) is False
+        assert remote_dir.join("first").read() == "first=1\n"
+        write_file(first, "first=2\n")
+        with prefetch_files(second):
+            assert read_file(first) == "first=2\n"
+        assert read_file(first) == "first=2\n"
+        count = len(commands)
+        assert read_file(first) == "first=2\n"
+        assert len(commands) == count
+    assert not remote_dir.join("second").exists()
+    assert remote_dir.join("first").read() == "first=2\n"
+    with prefetch_files(first, write_back=True):
+        write_file(first, u'\u043f\u0440\u0438\u0432\u0435\u0442\n')
+    assert remote_dir.join("first").read() == u'\u043f\u0440\u0438\u0432\u0435\u0442\n'.encode('utf-8')
+    assert fabrix.ioutil._content_caches == {} and fabrix.ioutil._prefetch_depths == {}
+    with abort('prefetch_files: remote filename must be absolute, "relative" given'):
+        with prefetch_files('relative'):
+            pass
@@ -0,0 +1,125 @@
+import time
+import threading
+import fabric.state
+from conftest import abort
+from fabric.api import env, settings, hide, cd, abort as fabric_abort
+from fabric.thread_handling import ThreadHandler
+from fabric.utils import _AttributeDict, _AliasDict
+from fabrix.config import conf
+from fabrix.parallel import execute_parallel, execute_rolling, ParallelResult
+
+
+def test_execute_parallel(monkeypatch):
+    monkeypatch.setitem(env, "hosts", ['10.10.10.10', '10.10.10.11'])
+    monkeypatch.setitem(env, "roledefs", {'web': ['10.10.10.11', '10.10.10.12'], 'db': ['10.10.10.13']})
+    for host in ['10.10.10.10', '10.10.10.11', '10.10.10.12', '10.10.10.13']:
+        conf.__super__setitem__(host, {'name': 'host-' + host})
+    lock = threading.Lock()
+    state = {'running': 0, 'max_running': 0}
+
+    def task(suffix, separator='-'):
+        with lock:
+            state['running'] += 1
+            state['max_running'] = max(state['max_running'], state['running'])
+        host_string = env.host_string
+        with settings(hide('everything'), warn_only=True):
+            time.sleep(0.05)
+            assert env.host_string == host_string
+            assert env.warn_only is True
+            assert fabric.state.output.running is False
+        with lock:
+            state['running'] -= 1
+        if host_string == '10.10.10.12':
+            fabric_abort('task failed on host %s' % host_string)
+        if host_string == '10.10.10.13':
+            raise ValueError('bad value')
+        return conf.name + separator + suffix
+
+    warn_only = env.warn_only
+    result = execute_parallel(task, 'suffix', separator='+', workers=2)
+    assert isinstance(result, ParallelResult)
+    assert result.results == {'10.10.10.10': 'host-10.10.10.10+suffix', '10.10.10.11': 'host-10.10.10.11+suffix'}
+    assert sorted(result.failures) == ['10.10.10.12', '10.10.10.13']
+    assert isinstance(result.failures['10.10.10.12'], SystemExit)
+    assert result.failures['10.10.10.12'].message == 'task failed on host 10.10.10.12'
+    assert isinstance(result.failures['10.10.10.13'], ValueError)
+    assert repr(result) == '<ParallelResult results=2 failures=2>'
+    assert state['max_running'] == 2
+    assert env.host_string is None
+    assert env.warn_only == warn_only
+    assert fabric.state.output.running is True
+    result = execute_parallel(lambda: env.host_string, hosts=['10.10.10.20'])
+    assert result.results == {'10.10.10.20': '10.10.10.20'}
+    with settings(cd('/srv'), warn_only=True):
+        result = execute_parallel(lambda: (env.host_string, env.cwd, env.warn_only), hosts=['10.10.10.20'])
+    assert result.results == {'10.10.10.20': ('10.10.10.20', '/srv', True)}
+
+    def io_thread_task():
+        seen = list()
+        with hide('everything'):
+            handler = ThreadHandler('out', lambda: seen.append((env.host_string, fabric.state.output.stdout)))
+            handler.thread.join()
+        return seen
+    result = execute_parallel(io_thread_task, hosts=['10.10.10.20', '10.10.10.21'])
+    assert result.results == {'10.10.10.20': [('10.10.10.20', False)], '10.10.10.21': [('10.10.10.21', False)]}
+    assert fabric.state.output.stdout is True
+    assert ThreadHandler.__init__.__module__ == 'fabric.thread_handling'
+    assert type(env) is _AttributeDict
+    assert type(fabric.state.output) is _AliasDict
+    assert execute_parallel(task, 'suffix', hosts=[]).results == {}
+    with abort(r'execute_parallel: workers must be positive, 0 given in file .* line .*'):
+        execute_parallel(task, workers=0)
+    for host in ['10.10.10.10', '10.10.10.11', '10.10.10.12', '10.10.10.13']:
+        dict.__delitem__(conf, host)
+
+
+def test_execute_rolling(monkeypatch):
+    web = ['10.10.1.%d' % index for index in range(10)]
+    db = ['10.10.2.%d' % index for index in range(4)]
+    monkeypatch.setitem(env, "roledefs", {'web': web, 'db': db + [web[0]]})
+    lock = threading.Lock()
+    state = {'running': 0, 'max_running': 0}
+
+    def task(failed_hosts=()):
+        with lock:
+            state['running'] += 1
+            state['max_running'] = max(state['max_running'], state['running'])
+        time.sleep(0.02)
+        with lock:
+            state['running'] -= 1
+        if env.host_string in failed_hosts:
+            raise ValueError(env.host_string)
+        return env.host_string
+
+    result = execute_rolling(task, max_unavailable='20%')
+    assert result.waves[0] == ['10.10.2.0']
+    assert sorted(sum(result.waves, [])) == sorted(db + web)
+    for wave in result.waves[1:]:
+        assert len([host for host in wave if host in web]) <= 2
+        assert len([host for host in wave if host in db + [web[0]]]) <= 1
+    assert sorted(result.results) == sorted(db + web)
+    assert result.failures == {} and result.skipped == []
+    assert state['max_running'] <= 3
+    result = execute_rolling(task, roles=['web'], wave_size={'web': 4}, canary=2)
+    assert result.waves == [web[:2], web[2:6], web[6:10]]
+    result = execute_rolling(task, roles=['web'], wave_size=3, failed_hosts=[web[0]])
+    assert result.waves == [web[:1]]
+    assert result.skipped == web[1:]
+    assert sorted(result.failures) == [web[0]]
+    result = execute_rolling(task, roles=['web'], wave_size=3, canary=0, max_failure_rate=0.4, failed_hosts=[web[0], web[4], web[5]])
+    assert result.waves == [web[:3], web[3:5], web[5:6]]
+    assert result.skipped == web[6:]
+    assert repr(result) == '<RollingResult results=3 failures=3 waves=3 skipped=4>'
+    result = execute_rolling(task, roles=['web'], max_unavailable=50, max_failure_rate=1.0, failed_hosts=web[1:3])
+    assert result.waves == [web[:1], web[1:6], web[6:9], web[9:]]
+    assert result.skipped == []
+    assert len(result.results) == 8
+    result = execute_rolling(task, roles=['web'], wave_size=2, canary=0, max_failure_rate=1.0, failed_hosts=web[:2])
+    assert result.waves == [web[:2]]
+    assert result.skipped == web[2:]
+    result = execute_rolling(lambda prefix, hosts, workers: prefix + hosts + workers, 'x', roles=['db'], hosts='-h', workers='-w')
+    assert result.results == dict((host, 'x-h-w') for host in db + [web[0]])
+    with abort(r'execute_rolling: role \'unknown\' not defined in file .* line .*'):
+        execute_rolling(task, roles=['unknown'])
+    with abort(r'execute_rolling: max_failure_rate must be from 0.0 to 1.0, 2 given in file .* line .*'):
+        execute_rolling(task, max_failure_rate=2)
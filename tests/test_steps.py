@@ -0,0 +1,97 @@
+import time
+import threading
+import fabrix.steps
+from conftest import abort
+from fabric.api import env, settings, cd, abort as fabric_abort
+from fabrix.steps import step, run_steps
+
+
+def test_run_steps(monkeypatch, capsys):
+    monkeypatch.setitem(env, "host_string", '11.11.11.11')
+    monkeypatch.setattr(fabrix.steps, 'connections', {'11.11.11.11': object()})
+    lock = threading.Lock()
+    events = list()
+    state = {'running': 0, 'max_running': 0}
+
+    def work(step_name, delay):
+        with lock:
+            events.append(('start', step_name, env.host_string))
+            state['running'] += 1
+            state['max_running'] = max(state['max_running'], state['running'])
+        time.sleep(delay)
+        with lock:
+            state['running'] -= 1
+            events.append(('finish', step_name, env.host_string))
+
+    @step()
+    def grub():
+        work('grub', 0.05)
+
+    @step()
+    def chrony():
+        work('chrony', 0.02)
+
+    @step()
+    def postfix():
+        work('postfix', 0.02)
+
+    @step(grub, chrony)
+    def reboot():
+        work('reboot', 0.02)
+
+    result = run_steps(reboot, postfix)
+    assert state['max_running'] == 3
+    assert events.index(('start', 'reboot', '11.11.11.11')) > events.index(('finish', 'grub', '11.11.11.11'))
+    assert events.index(('start', 'reboot', '11.11.11.11')) > events.index(('finish', 'chrony', '11.11.11.11'))
+    assert sorted(result.durations) == ['chrony', 'grub', 'postfix', 'reboot']
+    assert result.critical_path == ['grub', 'reboot']
+    assert result.critical_path_time == result.durations['grub'] + result.durations['reboot']
+    assert result.elapsed < sum(result.durations.values())
+    out, dummy_err = capsys.readouterr()
+    assert '[11.11.11.11] critical path grub -> reboot: ' in out
+    assert ' * ' not in out
+    state['max_running'] = 0
+    run_steps(reboot, postfix, workers=1, report=False)
+    assert state['max_running'] == 1
+
+    @step(grub)
+    def failed():
+        fabric_abort('step failed')
+
+    @step(failed)
+    def never():
+        work('never', 0)
+
+    with abort('step failed'):
+        run_steps(never, postfix)
+    assert ('start', 'never', '11.11.11.11') not in events
+    with abort(r'step: dependency .* is not step in file .* line .*'):
+        step(work)
+    with abort(r'run_steps: .* is not step in file .* line .*'):
+        run_steps(work)
+
+    @step()
+    def first():
+        pass
+
+    @step(first)
+    def second():
+        pass
+    first.step_depends = (second,)
+    with abort(r'run_steps: dependency cycle (first -> second -> first|second -> first -> second)'):
+        run_steps(second)
+
+    def make_step(value):
+        @step()
+        def closure():
+            events.append(('closure', value))
+        return closure
+    with abort(r'run_steps: duplicate step name \'closure\' in file .* line .*'):
+        run_steps(make_step(1), make_step(2))
+
+    @step()
+    def settings_step():
+        events.append(('settings', env.host_string, env.cwd, env.warn_only))
+    with settings(cd('/srv'), warn_only=True):
+        run_steps(settings_step, report=False)
+    assert events[-1] == ('settings', '11.11.11.11', '/srv', True)
@@ -30,14 +30,42 @@ def test_is_reboot_required(monkeypatch):
 
 def test_reboot_and_wait(monkeypatch):
     monkeypatch.setitem(env, "host_string", '11.11.11.11')
-    run_state = {
-        r'reboot': {'stdout': '', 'failed': False},
-    }
-    mock_run = mock_run_factory(run_state)
+    clock = {'now': 1000.0}
+    sleeps = list()
+
+    def mock_sleep(delay):
+        sleeps.append(delay)
+        clock['now'] += delay
+    monkeypatch.setattr(time, 'sleep', mock_sleep)
+    monkeypatch.setattr(time, 'time', lambda: clock['now'])
+    boot_ids = ['old-boot-id', 'old-boot-id', 'new-boot-id']
+    commands = list()
+
+    def mock_run(command):
+        commands.append(command)
+        if command == 'cat /proc/sys/kernel/random/boot_id':
+            return boot_ids.pop(0)
+        return ''
     monkeypatch.setattr(fabrix.system, 'run', mock_run)
-    monkeypatch.setattr(fabrix.system.connections, 'connect', lambda x: None)
-    monkeypatch.setattr(time, 'sleep', lambda x: None)
-    assert reboot_and_wait() is None
+    port_states = [False, False, True, True]
+    probes = list()
+
+    def mock_is_port_open(host, port, timeout):
+        probes.append((host, port))
+        return port_states.pop(0)
+    monkeypatch.setattr(fabrix.system, '_is_port_open', mock_is_port_open)
+    connects = list()
+    monkeypatch.setattr(fabrix.system.connections, 'connect', connects.append)
+    assert reboot_and_wait() == 0.5 + 1 + 2 + 4
+    assert sleeps == [0.5, 1, 2, 4]
+    assert probes == [('11.11.11.11', '22')] * 4
+    assert connects == ['11.11.11.11', '11.11.11.11']
+    assert commands == ['cat /proc/sys/kernel/random/boot_id', 'reboot', 'cat /proc/sys/kernel/random/boot_id', 'cat /proc/sys/kernel/random/boot_id']
+    boot_ids[:] = ['old-boot-id'] + ['old-boot-id'] * 100
+    port_states[:] = [True] * 100
+    with abort('reboot_and_wait: host 11.11.11.11 is not rebooted in 30 seconds'):
+        reboot_and_wait(wait=30, command='shutdown -r now')
+    assert 'shutdown -r now' in commands
 
 
 def test_disable_selinux(monkeypatch):
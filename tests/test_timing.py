@@ -0,0 +1,73 @@
+import json
+import base64
+import fabric.api
+import fabrix.timing
+from conftest import mock_run_factory
+from fabric.api import env
+from fabrix.ioutil import name, run, is_file_exists, memoize
+from fabrix.timing import enable_timing, timing_report, write_timing_json
+
+
+def test_timing(tmpdir, monkeypatch):
+    monkeypatch.setattr(fabrix.timing.atexit, 'register', lambda function: None)
+    monkeypatch.setitem(fabrix.timing._timing, 'registered', False)
+    mock_run = mock_run_factory({
+        r'^uname': {'stdout': 'Linux', 'failed': False},
+        r'^yum': {'stdout': 'installed', 'failed': False},
+        r'^if \[ -f': {'stdout': 'f', 'failed': False},
+    })
+
+    def mock_succeeded_run(command):
+        out = mock_run(command)
+        out.succeeded = not out.failed
+        return out
+    monkeypatch.setattr(fabric.api, 'run', mock_succeeded_run)
+    monkeypatch.setitem(env, "host_string", '10.10.10.10')
+    run('uname')
+    assert fabrix.timing._operations == list()
+    json_filename = str(tmpdir.join("timing.json"))
+    enable_timing(json_filename=json_filename, report=False)
+    assert fabrix.timing._timing['registered'] is True
+    name('install packages')
+    memoize('uname')
+    assert run('uname') == 'Linux'
+    assert run('uname') == 'Linux'
+    assert run('yum install nginx') == 'installed'
+    name('check files')
+    assert is_file_exists('/etc/nginx/nginx.conf') is True
+    operations = fabrix.timing._operations
+    assert [(item['kind'], item['command_class'], item['helper'], item['section']) for item in operations] == [
+        ('run', 'query', 'run', 'install packages'),
+        ('run', 'mutation', 'run', 'install packages'),
+        ('run', 'query', 'is_file_exists', 'check files'),
+    ]
+    assert operations[0]['bytes'] == len('uname') + len('Linux')
+    assert all([item['host'] == '10.10.10.10' for item in operations])
+    lines = timing_report()
+    assert lines[0].startswith('timing: 3 round trips on 1 hosts, ')
+    assert lines[1] == 'slowest hosts:'
+    assert lines[2].startswith('    10.10.10.10: ')
+    assert lines[2].endswith(' seconds, 3 round trips, %d bytes' % sum([item['bytes'] for item in operations]))
+    assert lines[3] == 'slowest sections:'
+    assert sorted([line.split(':')[0] for line in lines[4:6]]) == ['    [10.10.10.10] check files', '    [10.10.10.10] install packages']
+    assert lines[6] == 'round trips per helper:'
+    assert lines[7].startswith('    run: 2 round trips, ')
+    assert lines[8].startswith('    is_file_exists: 1 round trips, ')
+    assert lines[9] == 'latency per command class:'
+    assert lines[10].startswith('    mutation: 1 round trips, p50 ')
+    assert lines[11].startswith('    query: 2 round trips, p50 ')
+    fabrix.timing._finish_timing()
+    with open(json_filename) as json_file:
+        data = json.load(json_file)
+    write_timing_json(str(tmpdir.join("copy.json")))
+    with open(str(tmpdir.join("copy.json"))) as json_file:
+        assert json.load(json_file) == data
+    assert len(data['operations']) == 3
+    assert data['operations'][1]['command'] == 'yum install nginx'
+    assert [item['section'] for item in data['sections']] == ['install packages', 'check files']
+    assert fabrix.timing._percentile([5, 1, 4, 2, 3], 50) == 3
+    assert fabrix.timing._percentile([float(value) for value in range(1, 101)], 95) == 95.0
+    command = "printf '%s' '" + base64.b64encode('secret' * 100) + "' | base64 --decode > /etc/secret"
+    assert fabrix.timing._redact(command) == "printf '%s' '<600 bytes>' | base64 --decode > /etc/secret"
+    assert fabrix.timing._redact('echo ' + 'x ' * 200) == 'echo ' + 'x ' * 125 + 'x...'
+    assert fabrix.timing._redact(None) is None
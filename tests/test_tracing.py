@@ -0,0 +1,91 @@
+import sys
+import json
+import threading
+import fabric.api
+import fabrix.tracing
+from conftest import mock_run_shell_factory
+from fabric.api import env
+from fabrix.context import host_context
+from fabrix.ioutil import create_file, remove_file, prefetch_files
+from fabrix.tracing import enable_tracing, disable_tracing, add_trace_hook, write_trace
+
+
+def test_tracing(tmpdir, monkeypatch):
+    commands = list()
+    monkeypatch.setattr(fabric.api, 'run', mock_run_shell_factory(commands))
+    monkeypatch.setattr(fabrix.tracing.atexit, 'register', lambda function: None)
+    monkeypatch.setitem(fabrix.tracing._tracing, 'registered', False)
+    monkeypatch.setitem(env, "host_string", '10.10.10.10')
+    filename = str(tmpdir.join("file"))
+    create_file(filename)
+    assert fabrix.tracing._spans == list()
+    hooked = list()
+    add_trace_hook(hooked.append)
+    try:
+        enable_tracing()
+        assert create_file(filename) is False
+        assert remove_file(filename) is True
+
+        def worker():
+            with host_context('10.10.10.11'):
+                create_file(filename)
+        thread = threading.Thread(target=worker)
+        thread.start()
+        thread.join()
+    finally:
+        disable_tracing()
+    assert tmpdir.join("file").check(file=1)
+    spans = fabrix.tracing._spans
+    assert hooked == spans
+    assert [(span['name'], span['category'], span['host']) for span in spans] == [
+        ('run', 'mutation', '10.10.10.10'),
+        ('ioutil.create_file', 'call', '10.10.10.10'),
+        ('run', 'mutation', '10.10.10.10'),
+        ('ioutil.remove_file', 'call', '10.10.10.10'),
+        ('run', 'mutation', '10.10.10.11'),
+        ('ioutil.create_file', 'call', '10.10.10.11'),
+    ]
+    assert spans[1]['attributes'] == {'host': '10.10.10.10', 'changed': False}
+    assert spans[3]['attributes'] == {'host': '10.10.10.10', 'changed': True}
+    assert 'rm -f -- ' + filename in spans[2]['attributes']['command']
+    assert spans[1]['start'] <= spans[0]['start'] and spans[0]['start'] + spans[0]['elapsed'] <= spans[1]['start'] + spans[1]['elapsed']
+    assert spans[5]['thread'] != spans[1]['thread']
+    trace_filename = str(tmpdir.join("trace.json"))
+    write_trace(trace_filename)
+    with open(trace_filename) as trace_file:
+        events = json.load(trace_file)['traceEvents']
+    assert [(event['name'], event['ph'], event['pid']) for event in events] == [
+        ('process_name', 'M', 1),
+        ('ioutil.create_file', 'X', 1),
+        ('run', 'X', 1),
+        ('ioutil.remove_file', 'X', 1),
+        ('run', 'X', 1),
+        ('process_name', 'M', 2),
+        ('ioutil.create_file', 'X', 2),
+        ('run', 'X', 2),
+    ]
+    assert events[0]['args'] == {'name': '10.10.10.10'}
+    del fabrix.tracing._spans[:]
+    previous_events = list()
+
+    def previous_trace(frame, event, arg):
+        previous_events.append(event)
+        return previous_trace
+    previous_settrace = sys.gettrace()
+    sys.settrace(previous_trace)
+    try:
+        enable_tracing()
+        with prefetch_files(filename):
+            assert create_file(filename) is False
+        disable_tracing()
+        assert sys.gettrace() is previous_trace
+    finally:
+        sys.settrace(previous_settrace)
+    assert 'call' in previous_events and 'line' in previous_events and 'return' in previous_events
+    assert [(span['name'], span['category']) for span in fabrix.tracing._spans] == [
+        ('run', 'query'),
+        ('run', 'mutation'),
+        ('ioutil.create_file', 'call'),
+        ('ioutil.prefetch_files', 'call'),
+    ]
+    assert fabrix.tracing._spans[3]['attributes'] == {'host': '10.10.10.10', 'changed': None}